@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+from builtins import range
+from array import array
+import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class PricingError(ValueError):
+    pass
+
+
+class Pricing(object):
+
+    """
+    Snapshots storage prices per GB and month, read from a json file :
+
+    {
+      "default": 0.05,
+      "volume_types": {"io1": 0.05},
+      "regions": {"us-west-2": {"default": 0.05, "volume_types": {"gp3": 0.05}}}
+    }
+
+    The most specific price applies : region and volume type, region,
+    volume type, then default.
+    """
+
+    def __init__(self, document):
+        if not isinstance(document, dict):
+            raise PricingError("a pricing table must be a mapping")
+
+        self.default = document.get("default")
+        self.volume_types = document.get("volume_types") or {}
+        self.regions = document.get("regions") or {}
+
+        prices = [self.default] + list(self.volume_types.values())
+        for region in self.regions.values():
+            prices.append(region.get("default"))
+            prices.extend((region.get("volume_types") or {}).values())
+        if any(p is not None and not isinstance(p, (int, float)) for p in prices):
+            raise PricingError("prices must be numbers")
+
+    @staticmethod
+    def load(path):
+        with open(path) as pricing_file:
+            try:
+                return Pricing(json.load(pricing_file))
+            except ValueError as e:
+                raise PricingError("invalid pricing {0} : {1}".format(path, e))
+
+    def price(self, region, volume_type):
+        region_prices = self.regions.get(region) or {}
+        for price in ((region_prices.get("volume_types") or {}).get(volume_type),
+                      region_prices.get("default"),
+                      self.volume_types.get(volume_type),
+                      self.default):
+            if price is not None:
+                return price
+        return 0
+
+
+class StorageReport(object):
+
+    """
+    Reclaimable snapshots storage (GB) and monthly cost of groups of AMIs
+    to remove. A snapshot is reclaimable when every AMI referencing it is
+    removed, snapshots shared by several groups are counted once.
+    VolumeSize is the size of the source volume, an upper bound of the
+    incremental snapshot storage actually billed.
+    """
+
+    def __init__(self, pricing=None):
+        self.pricing = pricing
+        self.keys = []
+        self.sizes = []
+        self.costs = []
+        self.snapshots = []
+
+    @staticmethod
+    def from_groups(groups, region, snapshot_index=None, pricing=None):
+
+        """
+        Builds the report of groups (group name: AMIs) in region in one
+        pass over the block devices, sums are computed by group code
+        """
+
+        report = StorageReport(pricing)
+        removed_ids = set(ami.id for amis in groups.values() for ami in amis)
+        seen = set()
+
+        codes = array('l')
+        sizes = array('d')
+        prices = array('d')
+        price_cache = dict()
+
+        for code, (group_name, amis) in enumerate(groups.items()):
+            report.keys.append((region, group_name))
+            for ami in amis:
+                for block_device in ami.block_device_mappings:
+                    snap = block_device.snapshot_id
+                    if snap is None or snap in seen:
+                        continue
+                    if snapshot_index is not None and not removed_ids.issuperset(snapshot_index.used_by(snap)):
+                        continue
+                    seen.add(snap)
+
+                    codes.append(code)
+                    sizes.append(block_device.volume_size or 0)
+                    volume_type = block_device.volume_type
+                    price = price_cache.get(volume_type)
+                    if price is None:
+                        price = pricing.price(region, volume_type) if pricing is not None else 0.0
+                        price_cache[volume_type] = price
+                    prices.append(price)
+
+        report._aggregate(codes, sizes, prices)
+        return report
+
+    def _aggregate(self, codes, sizes, prices):
+        count = len(self.keys)
+
+        if numpy is not None and len(codes):
+            codes_np = numpy.frombuffer(codes, dtype=numpy.dtype(codes.typecode))
+            sizes_np = numpy.frombuffer(sizes, dtype=numpy.float64)
+            costs_np = sizes_np * numpy.frombuffer(prices, dtype=numpy.float64)
+            self.snapshots = numpy.bincount(codes_np, minlength=count).tolist()
+            self.sizes = numpy.bincount(codes_np, weights=sizes_np, minlength=count).tolist()
+            self.costs = numpy.bincount(codes_np, weights=costs_np, minlength=count).tolist()
+            return
+
+        self.snapshots = [0] * count
+        self.sizes = [0.0] * count
+        self.costs = [0.0] * count
+        for code, size, price in zip(codes, sizes, prices):
+            self.snapshots[code] += 1
+            self.sizes[code] += size
+            self.costs[code] += size * price
+
+    def merge(self, other):
+
+        """ adds the groups of another report (another region) """
+
+        self.keys.extend(other.keys)
+        self.snapshots.extend(other.snapshots)
+        self.sizes.extend(other.sizes)
+        self.costs.extend(other.costs)
+        self.pricing = self.pricing or other.pricing
+        return self
+
+    @property
+    def priced(self):
+        return self.pricing is not None
+
+    def groups(self):
+
+        """ (region, group name, snapshots, size, cost) of every group """
+
+        return [key + (snapshots, size, cost)
+                for key, snapshots, size, cost in zip(self.keys, self.snapshots, self.sizes, self.costs)]
+
+    def by_group(self):
+        return dict((group_name, (snapshots, size, cost))
+                    for _, group_name, snapshots, size, cost in self.groups())
+
+    def by_region(self):
+        regions = dict()
+        for region, _, snapshots, size, cost in self.groups():
+            total = regions.get(region, (0, 0.0, 0.0))
+            regions[region] = (total[0] + snapshots, total[1] + size, total[2] + cost)
+        return regions
+
+    def total(self):
+        return sum(self.snapshots), sum(self.sizes), sum(self.costs)
+
+    def ranked_groups(self):
+
+        """ group names from the largest payoff (cost, or size) to the smallest """
+
+        payoffs = self.costs if self.priced else self.sizes
+        ranked = sorted(range(len(self.keys)), key=lambda i: -payoffs[i])
+        return [self.keys[i][1] for i in ranked]
@@ -7,12 +7,10 @@ from builtins import input
 from builtins import object
 import sys
 
-from botocore.config import Config
 from amicleaner import __version__
-from .core import AMICleaner, OrphanSnapshotCleaner
-from .fetch import Fetcher
 from .resources.config import MAPPING_KEY, MAPPING_VALUES, EXCLUDED_MAPPING_VALUES
-from .resources.config import TERM, BOTO3_RETRIES
+from .resources.config import TERM, BOTO3_RETRIES, PENDING_DELETE_TAG, WATCH_BATCH
+from .resources.models import PlanResult, VerificationReport
 from .utils import Printer, parse_args
 
 
@@ -31,6 +29,39 @@ class App(object):
         self.force_delete = args.force_delete
         self.ami_min_days = args.ami_min_days
         self.aws_region = args.aws_region
+        self.aws_regions = args.aws_regions
+        self.keep_shared = args.keep_shared
+        self.diff_state = args.diff_state
+        self.inventory = args.inventory
+        self.queue = args.queue
+        self.report_max_rows = args.report_max_rows
+        self.queue_rate = args.queue_rate
+        self.verify = args.verify
+        self.watch = args.watch
+        self.daemon = args.daemon
+        self.interval = args.interval
+        self.metrics_port = args.metrics_port
+        self.columnar = args.columnar
+        self.policy = args.policy
+        self.mark = args.mark
+        self.sweep = args.sweep
+        self.workers = args.workers
+        self.pricing = args.pricing
+        self.max_duration = args.max_duration
+        self.max_deletes = args.max_deletes
+        self.priority = args.priority
+        self.checkpoint = args.checkpoint
+        self.processes = args.processes
+        self.usage_history = args.usage_history
+        self.keep_used_days = args.keep_used_days
+        self.sample_usage = args.sample_usage
+
+        self._engine = None
+        self.last_report = dict()
+        self.last_storage = None
+        self.last_schedule = None
+        self.last_removed = []
+        self.last_verification = None
 
         self.mapping_strategy = {
             "key": self.mapping_key,
@@ -38,10 +69,74 @@ class App(object):
             "excluded": self.excluded_mapping_values,
         }
 
+    # labels of the engine exclusion rules in the full report
+    EXCLUSION_LABELS = {
+        "instances": "Excluded from not terminated EC2 instances",
+        "unattached launch configurations": "Excluded from launch configurations",
+        "unattached launch templates": "Excluded from launch templates",
+        "zeroed autoscaling groups launch configurations":
+            "Excluded from launch configurations in autoscaling groups with 0 capacity",
+        "zeroed autoscaling groups launch templates":
+            "Excluded from launch templates in autoscaling groups with 0 capacity",
+        "launch templates default versions": "Excluded from launch target's default version",
+        "aws backup": "Excluded from AWS Backup",
+        "recently used": "Excluded from AMIs used recently (usage history)",
+        "lineage in use": "Excluded from copies of AMIs in use in another region",
+        "shared": "Excluded from AMIs shared with other accounts",
+    }
+
     @property
     def aws_config(self):
+        from botocore.config import Config
         return Config(retries={'max_attempts': BOTO3_RETRIES}, region_name=self.aws_region)
 
+    @property
+    def engine(self):
+
+        """ Engine kept for the whole life of the app, so its caches stay warm """
+
+        if self._engine is None:
+            from .engine import Engine
+            self._engine = Engine(
+                mapping_strategy=self.mapping_strategy,
+                keep_previous=self.keep_previous,
+                ami_min_days=self.ami_min_days,
+                policy=self.policy,
+                columnar=self.columnar,
+                workers=self.workers,
+                processes=self.processes,
+                usage_history=self.usage_history,
+                keep_used_days=self.keep_used_days,
+                regions=self.aws_regions,
+                keep_shared=self.keep_shared,
+                config=self.aws_config,
+            )
+        return self._engine
+
+    @property
+    def fetcher(self):
+        return self.engine.fetcher
+
+    @property
+    def cleaner(self):
+        return self.engine.cleaner
+
+    @property
+    def available_amis(self):
+        return self.engine.available_amis if self._engine is not None else dict()
+
+    @available_amis.setter
+    def available_amis(self, amis):
+        self.engine.available_amis = amis
+
+    @property
+    def snapshot_index(self):
+        return self.engine.snapshot_index
+
+    @property
+    def tag_index(self):
+        return self.engine.tag_index
+
     def fetch_candidates(self, available_amis=None, excluded_amis=None):
 
         """
@@ -49,93 +144,75 @@ class App(object):
         AMIs from ec2 instances, launch configurations, autoscaling groups
         and returns unused AMIs.
         """
-        f = Fetcher(config=self.aws_config)
 
-        available_amis = available_amis or f.fetch_available_amis()
-        excluded_amis = excluded_amis or []
+        results = list(self.engine.scan(available_amis, excluded_amis))
 
-        if not excluded_amis:
-            fetch_instances = set(f.fetch_instances())
-            fetch_unattached_lc = set(f.fetch_unattached_lc())
-            fetch_unattached_lt = set(f.fetch_unattached_lt())
-            fetch_zeroed_asg_lc = set(f.fetch_zeroed_asg_lc())
-            fetch_zeroed_asg_lt = set(f.fetch_zeroed_asg_lt())
-            fetch_default_lt = set(f.fetch_default_lt())
-            fetch_aws_backup = set(f.fetch_aws_backup())
+        if self.full_report and not excluded_amis:
+            self.print_exclusions()
 
-            if self.full_report:
-                Printer.print_ami_ids_group("Excluded from not terminated EC2 instances",
-                                            available_amis, fetch_instances)
-                Printer.print_ami_ids_group("Excluded from launch configurations",
-                                            available_amis, fetch_unattached_lc)
-                Printer.print_ami_ids_group("Excluded from launch templates",
-                                            available_amis, fetch_unattached_lt)
-                Printer.print_ami_ids_group("Excluded from launch configurations in autoscaling groups with 0 capacity",
-                                            available_amis, fetch_zeroed_asg_lc)
-                Printer.print_ami_ids_group("Excluded from launch templates in autoscaling groups with 0 capacity",
-                                            available_amis, fetch_zeroed_asg_lt)                                
-                Printer.print_ami_ids_group("Excluded from launch target's default version",
-                                            available_amis, fetch_zeroed_asg_lt)   
-                Printer.print_ami_ids_group("Excluded from AWS Backup",
-                                            available_amis, fetch_aws_backup) 
-                            
-            excluded_amis += fetch_instances
-            excluded_amis += fetch_unattached_lc
-            excluded_amis += fetch_unattached_lt
-            excluded_amis += fetch_zeroed_asg_lc
-            excluded_amis += fetch_zeroed_asg_lt
-            excluded_amis += fetch_default_lt
-            excluded_amis += fetch_aws_backup
-            
-        candidates = [v
-                      for k, v
-                      in available_amis.items()
-                      if k not in excluded_amis]
-        return candidates
+        return [r.ami for r in results if r.excluded_by is None]
 
-    def prepare_candidates(self, candidates_amis=None):
+    def print_exclusions(self):
 
-        """ From an AMI list apply mapping strategy and filters """
+        """ Prints the AMIs excluded by each rule of the last scan """
 
-        candidates_amis = candidates_amis or self.fetch_candidates()
+        for name, ami_ids in self.engine.exclusions.items():
+            Printer.print_ami_ids_group(self.EXCLUSION_LABELS.get(name, name),
+                                        self.available_amis, ami_ids, self.engine.instance_index,
+                                        self.report_max_rows)
 
-        if not candidates_amis:
-            return None
+    def prepare_candidates(self, candidates_amis=None):
 
-        
-        c = AMICleaner(config=self.aws_config)
+        """ From an AMI list apply mapping strategy and filters """
 
-        mapped_amis = c.map_candidates(
-            candidates_amis=candidates_amis,
-            mapping_strategy=self.mapping_strategy,
-        )
+        if self.inventory and candidates_amis is None:
+            results = list(self.engine.plan_inventory(self.inventory))
+            if self.full_report:
+                self.print_exclusions()
+        else:
+            candidates_amis = candidates_amis or self.fetch_candidates()
 
-        if not mapped_amis:
+            if not candidates_amis:
+                return None
+
+            results = list(self.engine.plan(candidates_amis))
+        if not results:
             return None
 
-        candidates = []
-        report = dict()
+        candidates = [r.ami for r in results if r.removed]
+        self.report_candidates(results)
 
-        for group_name, amis in mapped_amis.items():
-            group_name = group_name or ""
+        return candidates
 
-            if not group_name:
-                report["Excluded (by mapping strategy)"] = amis
-            else:
-                reduced, keep_previous, keep_min_day = c.reduce_candidates(amis, self.keep_previous, self.ami_min_days)
-                if reduced:
-                    report[group_name] = reduced
-                    candidates.extend(reduced)
+    def report_candidates(self, results):
 
-                if keep_previous:
-                    report[f"Excluded {group_name} (by keep previous)"] = keep_previous
+        """ Prints the report of PlanResults with the storage reclaimed by their groups of candidates """
 
-                if keep_min_day:
-                    report[f"Excluded {group_name} (by min day)"] = keep_min_day
+        from .accounting import StorageReport
 
-        Printer.print_report(report, self.full_report)
+        report = PlanResult.report(results)
+        groups = dict()
+        for result in results:
+            if result.removed:
+                groups.setdefault(result.group, []).append(result.ami)
+        self.last_report = report
 
-        return candidates
+        snapshot_index = self.snapshot_index
+        if not self.aws_regions:
+            self.last_storage = StorageReport.from_groups(
+                groups, self.aws_region, snapshot_index, self.pricing)
+        else:
+            # groups of a lineage span regions, each region is priced on its own
+            self.last_storage = StorageReport(self.pricing)
+            for region in self.aws_regions:
+                region_groups = dict()
+                for group_name, amis in groups.items():
+                    region_amis = [ami for ami in amis if ami.region == region]
+                    if region_amis:
+                        region_groups[group_name] = region_amis
+                self.last_storage.merge(StorageReport.from_groups(
+                    region_groups, region, snapshot_index, self.pricing))
+        Printer.print_report(report, self.full_report, self.last_storage, self.report_max_rows)
 
     def prepare_delete_amis(self, candidates, from_ids=False):
 
@@ -147,19 +224,187 @@ class App(object):
             print(TERM.bold("\nCleaning from {} AMI id(s) ...".format(
                 len(candidates))
             ))
-            failed = AMICleaner(config=self.aws_config).remove_amis_from_ids(candidates)
+            failed = self.cleaner.remove_amis_from_ids(candidates, queue=self.queue_deleter)
         else:
             print(TERM.bold("\nCleaning {} AMIs ...".format(len(candidates))))
-            failed = AMICleaner(config=self.aws_config).remove_amis(candidates)
+            failed = self.delete_candidates(candidates)
 
         if failed:
             print(TERM.red("\n{0} failed snapshots".format(len(failed))))
             Printer.print_failed_snapshots(failed)
 
+    @property
+    def queue_deleter(self):
+
+        """ removals through the --queue work queue, None without it """
+
+        if not self.queue:
+            return None
+        from .workqueue import QueueDeleter
+        return QueueDeleter(self.queue, processes=self.processes, rate=self.queue_rate,
+                            config=self.aws_config, progress=Printer.print_queue_progress)
+
+    @property
+    def scheduled(self):
+        return any(option is not None for option in
+                   (self.max_duration, self.max_deletes, self.priority, self.checkpoint))
+
+    def delete_candidates(self, candidates):
+
+        """
+        Removes candidates AMIs, through the scheduler when a budget or a
+        priority is set. Returns the snapshots which could not be deleted,
+        the ids of the AMIs deregistered are kept in last_removed.
+        """
+
+        self.last_removed = []
+        self.last_verification = None
+
+        if not self.scheduled:
+            failed = []
+            snapshot_index = self.snapshot_index
+            verifiers = dict()
+            regions = dict((ami.id, ami.region) for ami in candidates) if self.verify else None
+            if self.queue:
+                results = self.queue_deleter.remove_amis(candidates, snapshot_index)
+            else:
+                results = self.engine.execute(candidates, snapshot_index)
+            for result in results:
+                if not result.deregistered:
+                    print(TERM.red("{0} deregistration failed : {1}".format(result.ami_id, result.error)))
+                    continue
+                self.last_removed.append(result.ami_id)
+                if self.verify:
+                    self.verifier_for(regions.get(result.ami_id), verifiers).submit(result)
+                self.cleaner.print_removal(result, snapshot_index)
+                failed.extend(result.failed_snapshots)
+            if self.verify:
+                self.last_verification = self.close_verifiers(verifiers)
+                Printer.print_verification(self.last_verification)
+            return failed
+
+        from .scheduler import DeletionScheduler
+
+        scheduler = DeletionScheduler(
+            self.cleaner,
+            snapshot_index=self.snapshot_index,
+            workers=self.workers,
+            max_duration=self.max_duration,
+            max_deletes=self.max_deletes,
+            priority=self.priority or "oldest",
+            checkpoint=self.checkpoint,
+            cleaner_for=self.engine.cleaner_for,
+        )
+        storage = self.last_storage
+        summary = scheduler.run(
+            candidates,
+            groups=dict((name, self.last_report[name]) for name in storage.by_group()) if storage else None,
+            ranked_groups=storage.ranked_groups() if storage else None,
+        )
+        self.last_schedule = summary
+        self.last_removed = list(summary.deleted)
+        Printer.print_schedule_summary(summary)
+
+        return summary.failed_snapshots
+
+    def verifier_for(self, region, verifiers):
+
+        """ DeletionVerifier of a region, started with its first removal """
+
+        verifier = verifiers.get(region)
+        if verifier is None:
+            from .verify import DeletionVerifier
+            verifier = verifiers[region] = DeletionVerifier(self.engine.cleaner_for(region).ec2).start()
+        return verifier
+
+    @staticmethod
+    def close_verifiers(verifiers):
+
+        """ waits for the checks of every region, returns their VerificationReport """
+
+        reports = [verifier.close() for verifier in verifiers.values()]
+        return VerificationReport(
+            sum(report.verified_amis for report in reports),
+            sum(report.verified_snapshots for report in reports),
+            sorted(ami_id for report in reports for ami_id in report.lingering_amis),
+            sorted(snapshot_id for report in reports for snapshot_id in report.lingering_snapshots))
+
+    def prepare_mark_amis(self, candidates):
+
+        """ Tags candidates AMIs for a later sweep, returns the number of AMIs tagged """
+
+        print(TERM.bold("\nMarking {} AMIs ...".format(len(candidates))))
+        by_region = dict()
+        for ami in candidates:
+            by_region.setdefault(ami.region, []).append(ami)
+        count = sum(self.engine.cleaner_for(region).mark_amis(amis) for region, amis in by_region.items())
+        print("{0} AMIs marked with {1}, {2} already marked".format(
+            count, PENDING_DELETE_TAG, len(candidates) - count))
+        return count
+
+    def sweep_marked_amis(self):
+
+        """ Removes the AMIs marked by a previous run, in every region scanned """
+
+        print(TERM.bold("\nRetrieving AMIs marked with {} ...".format(PENDING_DELETE_TAG)))
+        marked = []
+        for region in self.engine.regions or [None]:
+            fetcher = self.engine.fetcher_for(region) if region is not None else self.fetcher
+            region_marked = fetcher.fetch_marked_amis()
+            if region_marked and self.keep_shared:
+                shared = fetcher.fetch_shared_amis([ami.id for ami in region_marked])
+                region_marked = [ami for ami in region_marked if ami.id not in shared]
+            for ami in region_marked:
+                ami.region = region or ami.region
+            marked.extend(region_marked)
+
+        if not marked:
+            return
+
+        # snapshots shared with unmarked AMIs are refused by aws and kept
+        self.available_amis = dict((ami.id, ami) for ami in marked)
+        Printer.print_report({"Marked for deletion": marked}, self.full_report, max_rows=self.report_max_rows)
+
+        delete = self.force_delete
+        if not delete:
+            answer = input(
+                "Do you want to continue and remove {} AMIs "
+                "[y/N] ? : ".format(len(marked)))
+            delete = (answer.lower() == "y")
+
+        if delete:
+            self.prepare_delete_amis(marked)
+
+    def print_diff(self):
+
+        """
+        Dry run printing only the changes since the previous run, diff_state
+        loaded from its file, then stores this run in the same file
+        """
+
+        from .diff import RunState
+
+        scanned = list(self.engine.scan())
+        candidates = [r.ami for r in scanned if r.excluded_by is None]
+        planned = list(self.engine.plan(candidates)) if candidates else []
+
+        state = RunState.from_results(scanned, planned)
+        previous = self.diff_state
+        Printer.print_diff(previous.diff(state), self.available_amis, len(state), self.report_max_rows)
+        state.save(previous.path)
+
+    def record_usage(self):
+
+        """ Samples the AMIs used by instances into the usage history """
+
+        history = self.engine.record_usage()
+        print("{0} AMIs in usage history {1}".format(len(history.amis), history.path))
+
     def clean_orphans(self):
 
         """ Find and removes orphan snapshots """
 
+        from .core import OrphanSnapshotCleaner
         cleaner = OrphanSnapshotCleaner(config=self.aws_config)
         snaps = cleaner.fetch()
 
@@ -175,7 +420,7 @@ class App(object):
 
         if confirm:
             print("Removing orphan snapshots... ")
-            count = cleaner.clean(snaps)
+            count = cleaner.clean(snaps, queue=self.queue_deleter)
             print("\n{0} orphan snapshots successfully removed !".format(count))
 
     def print_defaults(self):
@@ -191,14 +436,74 @@ class App(object):
     def print_version():
         print(__version__)
 
+    def run_watch(self):
+
+        """
+        Keeps the inventory up to date from the --watch events feed, and
+        removes AMIs (with --force-delete, reports them otherwise) as their
+        group exceeds the retention
+        """
+
+        from .watch import Watcher, read_feed
+
+        self.print_defaults()
+
+        print(TERM.bold("\nRetrieving AMIs to clean ..."))
+        watcher = Watcher(self.engine)
+        watcher.start()
+        self.remove_queued(watcher)
+
+        print(TERM.bold("\nWatching {0} ...".format(self.watch)))
+        try:
+            for event in read_feed(self.watch):
+                if event is not None:
+                    watcher.process(event)
+                if watcher.pending and (event is None or len(watcher.pending) >= WATCH_BATCH):
+                    self.remove_queued(watcher)
+        except KeyboardInterrupt:
+            pass
+
+    def remove_queued(self, watcher):
+
+        """
+        Reports and removes (or marks with --mark) the AMIs queued by
+        watcher. They leave its inventory once deregistered, those which
+        failed are queued again by the next reduction of their group.
+        Marked AMIs stay queued, they are not marked twice.
+        """
+
+        results = watcher.drain()
+        if not results:
+            return
+        candidates = [r.ami for r in results]
+        self.report_candidates(results)
+        if self.force_delete and self.mark:
+            self.prepare_mark_amis(candidates)
+        elif self.force_delete:
+            self.prepare_delete_amis(candidates)
+            removed = set(self.last_removed)
+            for ami in candidates:
+                if ami.id in removed:
+                    watcher.forget(ami.id)
+                else:
+                    watcher.queued.discard(ami.id)
+
     def run_cli(self):
 
         if self.check_orphans:
             self.clean_orphans()
             return
 
+        if self.sample_usage:
+            self.record_usage()
+            return
+
         if self.from_ids:
             self.prepare_delete_amis(self.from_ids, from_ids=True)
+        elif self.sweep:
+            self.sweep_marked_amis()
+        elif self.diff_state is not None:
+            self.print_diff()
         else:
             # print defaults
             self.print_defaults()
@@ -213,13 +518,15 @@ class App(object):
 
             if not self.force_delete:
                 answer = input(
-                    "Do you want to continue and remove {} AMIs "
-                    "[y/N] ? : ".format(len(candidates)))
+                    "Do you want to continue and {} {} AMIs "
+                    "[y/N] ? : ".format("mark" if self.mark else "remove", len(candidates)))
                 delete = (answer.lower() == "y")
             else:
                 delete = True
 
-            if delete:
+            if delete and self.mark:
+                self.prepare_mark_amis(candidates)
+            elif delete:
                 self.prepare_delete_amis(candidates)
 
 
@@ -233,6 +540,11 @@ def main():
 
     if app.version is True:
         app.print_version()
+    elif app.daemon:
+        from .daemon import Daemon
+        Daemon(app).run()
+    elif app.watch:
+        app.run_watch()
     else:
         app.run_cli()
 
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+from array import array
+from datetime import datetime, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class AMIColumns(object):
+
+    """
+    Column oriented view of mapped AMIs. Each AMI is a row index into
+    parallel columns (creation dates, group codes, protection flags), so
+    keep previous and min days rules run for every group at once.
+    Uses numpy when installed, plain python otherwise.
+    """
+
+    # digits positions in an AWS creation date
+    ISO_DIGITS = (0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18, 20, 21, 22)
+
+    def __init__(self):
+        self.amis = []
+        self.dates = []
+        self.group_names = []
+        self.group_sizes = []
+        self.protected_groups = []
+
+    def __len__(self):
+        return len(self.amis)
+
+    @property
+    def ids(self):
+        return [ami.id for ami in self.amis]
+
+    @staticmethod
+    def from_mapped(mapped_amis):
+
+        """
+        Builds columns from the output of AMICleaner.map_candidates,
+        AMIs of the unnamed group are flagged as protected
+        """
+
+        columns = AMIColumns()
+        for group_name, amis in mapped_amis.items():
+            columns.group_names.append(group_name or "")
+            columns.group_sizes.append(len(amis))
+            columns.protected_groups.append(not group_name)
+            columns.amis.extend(amis)
+
+        columns.dates = [ami.creation_date for ami in columns.amis]
+
+        return columns
+
+    @staticmethod
+    def from_inventory(inventory, mapped_rows):
+
+        """
+        Builds columns from Inventory.map_rows output, rows of an
+        inventory file stand for the AMIs
+        """
+
+        columns = AMIColumns()
+        for group_name, rows in mapped_rows.items():
+            columns.group_names.append(group_name or "")
+            columns.group_sizes.append(len(rows))
+            columns.protected_groups.append(not group_name)
+            columns.amis.extend(rows)
+
+        columns.dates = [inventory.creation_date(row) for row in columns.amis]
+
+        return columns
+
+    @staticmethod
+    def min_days_cutoff(sample_date, ami_min_days, now=None):
+
+        """
+        Returns the creation date after which an AMI is younger than
+        ami_min_days, in the same type as sample_date
+        """
+
+        cutoff = (now or datetime.now()) - timedelta(days=ami_min_days)
+        if isinstance(sample_date, datetime):
+            return cutoff
+        return cutoff.strftime('%Y-%m-%dT%H:%M:%S.') + '{0:03d}Z'.format(cutoff.microsecond // 1000)
+
+    def reduce(self, keep_previous=0, ami_min_days=-1):
+
+        """
+        Columnar equivalent of AMICleaner.reduce_candidates applied to all
+        the groups. Returns a list of (group name, reduced, keep previous,
+        keep min days) tuples, AMIs listed from the newest to the oldest.
+        Protected AMIs are returned as the reduced list of their group.
+        """
+
+        if not self.amis:
+            return []
+
+        dates = self.dates
+        sample_date = next((d for d in dates if d is not None), None)
+        if sample_date is None or None in dates:
+            # AMIs without creation date are the oldest ones
+            oldest = datetime.min if isinstance(sample_date, datetime) else ""
+            dates = [oldest if d is None else d for d in dates]
+
+        # without any creation date, the min days rule keeps nothing
+        cutoff = None
+        if ami_min_days > 0 and sample_date is not None:
+            cutoff = self.min_days_cutoff(sample_date, ami_min_days)
+
+        if numpy is not None:
+            return self._reduce_numpy(dates, keep_previous, cutoff)
+        return self._reduce_python(dates, keep_previous, cutoff)
+
+    def _reduce_python(self, dates, keep_previous, cutoff):
+        names = self.group_names
+        reduced = [[] for _ in names]
+        kept_previous = [[] for _ in names]
+        kept_min_days = [[] for _ in names]
+        ranks = array('l', [0] * len(names))
+
+        groups = array('l')
+        for code, size in enumerate(self.group_sizes):
+            groups.extend([code] * size)
+        protected = self.protected_groups
+
+        amis = self.amis
+        for i in sorted(range(len(amis)), key=dates.__getitem__, reverse=True):
+            code = groups[i]
+            if protected[code]:
+                reduced[code].append(amis[i])
+            elif cutoff is not None and dates[i] > cutoff:
+                kept_min_days[code].append(amis[i])
+            elif ranks[code] < keep_previous:
+                ranks[code] += 1
+                kept_previous[code].append(amis[i])
+            else:
+                reduced[code].append(amis[i])
+
+        return [
+            (names[code], reduced[code], kept_previous[code], kept_min_days[code])
+            for code in range(len(names))
+        ]
+
+    @staticmethod
+    def _numpy_date_keys(dates, cutoff):
+
+        """
+        Returns int64 keys ordered like dates, and the key of cutoff.
+        AWS creation dates (YYYY-MM-DDTHH:MM:SS.mmmZ) are read digit by digit
+        from their bytes, other values are ranked with numpy.unique.
+        """
+
+        if isinstance(dates[0], str):
+            encoded = "".join(dates).encode("ascii", "replace")
+            if len(encoded) == 24 * len(dates):
+                chars = numpy.frombuffer(encoded, dtype=numpy.uint8).reshape(-1, 24)
+                if (chars[:, 10] == ord('T')).all() and (chars[:, 23] == ord('Z')).all():
+                    keys = numpy.zeros(len(dates), dtype=numpy.int64)
+                    for position in AMIColumns.ISO_DIGITS:
+                        keys *= 10
+                        keys += chars[:, position]
+                    cutoff_key = None
+                    if cutoff is not None:
+                        cutoff_key = AMIColumns._numpy_date_keys([cutoff], None)[0][0]
+                    return keys, cutoff_key
+
+        unique_dates, keys = numpy.unique(numpy.array(dates), return_inverse=True)
+        cutoff_key = None
+        if cutoff is not None:
+            cutoff_key = numpy.searchsorted(unique_dates, cutoff, side='right') - 0.5
+        return keys.reshape(-1), cutoff_key
+
+    def _reduce_numpy(self, dates, keep_previous, cutoff):
+        sizes = numpy.array(self.group_sizes, dtype=numpy.int64)
+        group_type = numpy.uint16 if len(sizes) <= numpy.iinfo(numpy.uint16).max else numpy.int64
+        groups = numpy.repeat(numpy.arange(len(sizes), dtype=group_type), sizes)
+        protected = numpy.repeat(numpy.array(self.protected_groups, dtype=bool), sizes)
+        date_keys, cutoff_key = self._numpy_date_keys(dates, cutoff)
+
+        # 0 : reduced, 1 : kept by keep previous, 2 : kept by min days
+        status = numpy.zeros(len(groups), dtype=numpy.int8)
+        eligible = ~protected
+        if cutoff_key is not None:
+            too_young = date_keys > cutoff_key
+            status[eligible & too_young] = 2
+            eligible &= ~too_young
+
+        # newest first inside each group, both sorts are stable
+        order = numpy.argsort(-date_keys, kind='stable')
+        order = order[numpy.argsort(groups[order], kind='stable')]
+
+        if keep_previous:
+            ranked = order[eligible[order]]
+            ranked_groups = groups[ranked]
+            starts = numpy.searchsorted(ranked_groups, ranked_groups, side='left')
+            position = numpy.arange(len(ranked)) - starts
+            status[ranked[position < keep_previous]] = 1
+
+        # lay every group out as reduced, kept previous, kept min days rows
+        slots = groups.astype(numpy.int64) * 3 + status
+        order = order[numpy.argsort(slots[order], kind='stable')]
+        bounds = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(slots, minlength=3 * len(sizes))))).tolist()
+
+        amis = self.amis
+        results = []
+        for code, name in enumerate(self.group_names):
+            results.append((name,) + tuple(
+                [amis[i] for i in order[bounds[slot]:bounds[slot + 1]].tolist()]
+                for slot in range(3 * code, 3 * code + 3)
+            ))
+
+        return results
@@ -4,15 +4,270 @@
 from __future__ import print_function
 from __future__ import absolute_import
 from builtins import object
+from builtins import range
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import boto3
 from botocore.exceptions import ClientError
 
-from .resources.config import BOTO3_RETRIES
-from .resources.models import AMI
+from .resources.config import BOTO3_RETRIES, PENDING_DELETE_TAG, CREATE_TAGS_BATCH
+from .resources.models import AMI, RemovalResult
 
 from datetime import datetime
 
 
+class SnapshotIndex(object):
+
+    """
+    Index between EBS snapshots and the AMIs referencing them, built once
+    from the AMIs inventory. Releases are thread safe.
+    """
+
+    def __init__(self):
+        self.amis_by_snapshot = dict()
+        self.snapshots_by_ami = dict()
+        self.lock = threading.Lock()
+
+    def add(self, ami_id, snapshot_ids):
+        snapshot_ids = [snap for snap in snapshot_ids if snap]
+        self.snapshots_by_ami[ami_id] = snapshot_ids
+        for snap in snapshot_ids:
+            self.amis_by_snapshot.setdefault(snap, set()).add(ami_id)
+
+    @staticmethod
+    def from_amis(amis):
+        index = SnapshotIndex()
+        for ami in amis:
+            index.add(ami.id, [block_device.snapshot_id for block_device in ami.block_device_mappings])
+        return index
+
+    @staticmethod
+    def from_images_json(images_json):
+
+        """ builds the index from a describe_images response """
+
+        index = SnapshotIndex()
+        for image in images_json or []:
+            index.add(image.get("ImageId"), [
+                ebs.get("Ebs", {}).get("SnapshotId")
+                for ebs in image.get("BlockDeviceMappings", [])
+            ])
+        return index
+
+    def is_used(self, snapshot_id):
+        return snapshot_id in self.amis_by_snapshot
+
+    def used_by(self, snapshot_id):
+        return self.amis_by_snapshot.get(snapshot_id, set())
+
+    def release(self, ami_id, snapshot_ids=None):
+
+        """
+        Forgets an AMI and returns the snapshots no other AMI references
+        anymore, in other words the snapshots which can be deleted
+        """
+
+        with self.lock:
+            snapshot_ids = self.snapshots_by_ami.pop(ami_id, None) or snapshot_ids or []
+            released = []
+            for snap in snapshot_ids:
+                amis = self.amis_by_snapshot.get(snap)
+                if amis is not None:
+                    amis.discard(ami_id)
+                    if amis:
+                        continue
+                    del self.amis_by_snapshot[snap]
+                released.append(snap)
+
+        return released
+
+
+class TagIndex(object):
+
+    """
+    Inverted index from (tag key, tag value) to AMI ids. It can be kept
+    across runs and updated with add / remove, group names computed for a
+    set of tag keys are cached until the index changes.
+    """
+
+    def __init__(self):
+        self.ids_by_tag = dict()
+        self.values_by_key = dict()
+        self.groups_cache = dict()
+
+    def add(self, ami):
+        ids_by_tag = self.ids_by_tag
+        ami_id = ami.id
+        for tag in ami.tags:
+            key = (tag.key, tag.value)
+            ids = ids_by_tag.get(key)
+            if ids is None:
+                ids_by_tag[key] = {ami_id}
+                self.values_by_key.setdefault(tag.key, set()).add(tag.value)
+            else:
+                ids.add(ami_id)
+        self.groups_cache.clear()
+
+    def remove(self, ami):
+        for tag in ami.tags:
+            key = (tag.key, tag.value)
+            ids = self.ids_by_tag.get(key)
+            if ids is None:
+                continue
+            ids.discard(ami.id)
+            if not ids:
+                del self.ids_by_tag[key]
+                self.values_by_key[tag.key].discard(tag.value)
+        self.groups_cache.clear()
+
+    @staticmethod
+    def from_amis(amis):
+        index = TagIndex()
+        for ami in amis:
+            index.add(ami)
+        return index
+
+    def keys(self, filters=None):
+
+        """ keys of filters known by the index, all keys but the marking one without filters """
+
+        if not filters:
+            return [key for key in self.values_by_key if key != PENDING_DELETE_TAG]
+        return [key for key in set(filters) if key in self.values_by_key]
+
+    def ids(self, key, value):
+        return self.ids_by_tag.get((key, value), set())
+
+    def ids_with_values(self, values, filters=None):
+
+        """ ids of AMIs having one of values on a tag whose key is in filters """
+
+        ids = set()
+        for key in self.keys(filters):
+            for value in self.values_by_key[key].intersection(values):
+                ids |= self.ids_by_tag[(key, value)]
+        return ids
+
+    def partitions(self, filters=None):
+
+        """
+        Splits the AMIs tagged with one of filters keys into
+        (tag values, AMI ids) partitions, with set intersections only
+        """
+
+        keys = self.keys(filters)
+        tagged = set()
+        for key in keys:
+            for value in self.values_by_key[key]:
+                tagged |= self.ids_by_tag[(key, value)]
+
+        partitions = [((), tagged)] if tagged else []
+        for key in keys:
+            refined = []
+            for values, ids in partitions:
+                matched_ids = set()
+                for value in self.values_by_key[key]:
+                    matched = ids & self.ids_by_tag[(key, value)]
+                    if matched:
+                        refined.append((values + (value,), matched))
+                        matched_ids |= matched
+                if len(matched_ids) < len(ids):
+                    refined.append((values, ids - matched_ids))
+            partitions = refined
+
+        return partitions
+
+    def groups(self, filters=None):
+
+        """
+        Group name of each tagged AMI id : its tag values (restricted to
+        filters) sorted and joined with dots, as tags_values_to_string
+        """
+
+        cache_key = tuple(sorted(set(filters or [])))
+        groups = self.groups_cache.get(cache_key)
+        if groups is None:
+            groups = dict()
+            for values, ids in self.partitions(filters):
+                groups.update(dict.fromkeys(ids, ".".join(sorted(values))))
+            self.groups_cache[cache_key] = groups
+        return groups
+
+
+class InstanceIndex(object):
+
+    """
+    Usage of the AMIs by the instances : number of instances, last launch
+    time and autoscaling groups by image id
+    """
+
+    def __init__(self):
+        self.counts = dict()
+        self.last_launches = dict()
+        self.groups = dict()
+
+    def add(self, instance):
+        image_id = instance.image_id
+        if not image_id:
+            return
+        self.counts[image_id] = self.counts.get(image_id, 0) + 1
+        launch_time = instance.launch_time
+        if launch_time is not None:
+            last_launch = self.last_launches.get(image_id)
+            if last_launch is None or launch_time > last_launch:
+                self.last_launches[image_id] = launch_time
+        if instance.asg_name:
+            self.groups.setdefault(image_id, set()).add(instance.asg_name)
+
+    def remove(self, instance):
+
+        """
+        removes a terminated instance, the last launch and groups of an
+        image are forgotten with its last instance
+        """
+
+        image_id = instance.image_id
+        count = self.counts.get(image_id, 0) - 1
+        if count > 0:
+            self.counts[image_id] = count
+            return
+        self.counts.pop(image_id, None)
+        self.last_launches.pop(image_id, None)
+        self.groups.pop(image_id, None)
+
+    @staticmethod
+    def from_instances(instances):
+        index = InstanceIndex()
+        for instance in instances:
+            index.add(instance)
+        return index
+
+    def update(self, other):
+
+        """ adds the usage of another index (another region) """
+
+        for image_id, count in other.counts.items():
+            self.counts[image_id] = self.counts.get(image_id, 0) + count
+        for image_id, launch_time in other.last_launches.items():
+            last_launch = self.last_launches.get(image_id)
+            if last_launch is None or launch_time > last_launch:
+                self.last_launches[image_id] = launch_time
+        for image_id, groups in other.groups.items():
+            self.groups.setdefault(image_id, set()).update(groups)
+
+    def image_ids(self):
+        return list(self.counts)
+
+    def count(self, image_id):
+        return self.counts.get(image_id, 0)
+
+    def last_launch(self, image_id):
+        return self.last_launches.get(image_id)
+
+    def auto_scaling_groups(self, image_id):
+        return self.groups.get(image_id, set())
+
+
 class OrphanSnapshotCleaner(object):
 
     """ Finds and removes ebs snapshots left orphaned """
@@ -50,11 +305,7 @@ class OrphanSnapshotCleaner(object):
 
         resp = self.ec2.describe_images(Owners=['self'])
 
-        used_snaps = [
-            ebs.get("Ebs", {}).get("SnapshotId")
-            for image in resp.get("Images")
-            for ebs in image.get("BlockDeviceMappings")
-        ]
+        index = SnapshotIndex.from_images_json(resp.get("Images"))
         snap_filter = self.get_snapshots_filter()
         owner_id = self.get_owner_id(resp.get("Images"))
 
@@ -66,19 +317,25 @@ class OrphanSnapshotCleaner(object):
             Filters=snap_filter, OwnerIds=[owner_id]
         )
 
-        all_snaps = [snap.get("SnapshotId") for snap in resp["Snapshots"]]
-        return list(set(all_snaps) - set(used_snaps))
+        return [snap.get("SnapshotId") for snap in resp["Snapshots"]
+                if not index.is_used(snap.get("SnapshotId"))]
 
-    def clean(self, snapshots):
+    def clean(self, snapshots, queue=None):
 
         """
         actually deletes the snapshots with an array
-        of snapshots ids
+        of snapshots ids, through queue (a workqueue.QueueDeleter) if given
         """
         count = len(snapshots)
 
         snapshots = snapshots or []
 
+        if queue is not None:
+            failed = queue.delete_snapshots(snapshots)
+            for snap in failed:
+                self.log("{0} deletion failed".format(snap))
+            return count - len(failed)
+
         for snap in snapshots:
             try:
                 self.ec2.delete_snapshot(SnapshotId=snap)
@@ -104,53 +361,144 @@ class AMICleaner(object):
 
         return ami.creation_date
 
-    def remove_amis(self, amis):
+    def deregister(self, ami, snapshot_index=None):
+
+        """
+        deregister an AMI and removes its snapshots, without printing.
+        Returns a RemovalResult, deregistration errors are not raised.
+        """
+
+        try:
+            self.ec2.deregister_image(ImageId=ami.id)
+        except ClientError as e:
+            return RemovalResult(ami.id, e, [], [], [])
+
+        deleted, kept, failed = [], [], []
+
+        snapshot_ids = [block_device.snapshot_id for block_device in ami.block_device_mappings
+                        if block_device.snapshot_id is not None]
+        if snapshot_index is not None:
+            released = snapshot_index.release(ami.id, snapshot_ids)
+            kept.extend(snap for snap in snapshot_ids if snap not in released)
+            snapshot_ids = released
+
+        for snapshot_id in snapshot_ids:
+            try:
+                self.ec2.delete_snapshot(SnapshotId=snapshot_id)
+                deleted.append(snapshot_id)
+            except ClientError as e:
+                # referenced by an AMI unknown from the index
+                if e.response.get("Error", {}).get("Code") == "InvalidSnapshot.InUse":
+                    kept.append(snapshot_id)
+                else:
+                    failed.append(snapshot_id)
+
+        return RemovalResult(ami.id, None, deleted, kept, failed)
+
+    @staticmethod
+    def print_removal(result, snapshot_index=None):
+        print("{0} deregistered".format(result.ami_id))
+        for snap in result.kept_snapshots:
+            used_by = snapshot_index.used_by(snap) if snapshot_index is not None else None
+            if used_by:
+                print("{0} kept, still used by {1}\n".format(snap, ", ".join(sorted(used_by))))
+            else:
+                print("{0} kept, still in use\n".format(snap))
+        for snap in result.deleted_snapshots:
+            print("{0} deleted\n".format(snap))
+
+    def remove_ami(self, ami, snapshot_index=None):
+
+        """
+        deregister an AMI and removes its snapshots, returns the snapshots
+        which could not be deleted
+        """
+
+        result = self.deregister(ami, snapshot_index)
+        if result.error is not None:
+            raise result.error
+        self.print_removal(result, snapshot_index)
+
+        return result.failed_snapshots
+
+    def remove_amis(self, amis, snapshot_index=None, workers=1, queue=None):
 
         """
         deregister AMIs (array) and removes related snapshots
         :param amis: array of AMI objects
+        :param snapshot_index: SnapshotIndex of the AMIs inventory, snapshots
+        still referenced by an AMI which is not removed are kept
+        :param workers: number of AMIs removed in parallel
+        :param queue: workqueue.QueueDeleter removing the AMIs from several
+        processes, deregistration errors are then printed instead of raised
         """
 
         failed_snapshots = []
 
         amis = amis or []
-        for ami in amis:
-            self.ec2.deregister_image(ImageId=ami.id)
-            print("{0} deregistered".format(ami.id))
-            for block_device in ami.block_device_mappings:
-                if block_device.snapshot_id is not None:
-                    try:
-                            self.ec2.delete_snapshot(
-                                SnapshotId=block_device.snapshot_id
-                            )
-                    except ClientError:
-                        failed_snapshots.append(block_device.snapshot_id)
-                    print("{0} deleted\n".format(block_device.snapshot_id))
+        if queue is not None and amis:
+            for result in queue.remove_amis(amis, snapshot_index):
+                if not result.deregistered:
+                    print("{0} deregistration failed : {1}".format(result.ami_id, result.error))
+                    continue
+                self.print_removal(result, snapshot_index)
+                failed_snapshots.extend(result.failed_snapshots)
+        elif workers > 1 and len(amis) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for failed in executor.map(lambda ami: self.remove_ami(ami, snapshot_index), amis):
+                    failed_snapshots.extend(failed)
+        else:
+            for ami in amis:
+                failed_snapshots.extend(self.remove_ami(ami, snapshot_index))
 
         return failed_snapshots
 
-    def remove_amis_from_ids(self, ami_ids):
+    def mark_amis(self, amis, marked_at=None):
+
+        """
+        tags AMIs with PENDING_DELETE_TAG so a later sweep removes them,
+        AMIs already marked keep their marking date.
+        Returns the number of AMIs tagged.
+        """
+
+        marked_at = marked_at or datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        ami_ids = [ami.id for ami in amis or []
+                   if not any(tag.key == PENDING_DELETE_TAG for tag in ami.tags)]
+
+        for start in range(0, len(ami_ids), CREATE_TAGS_BATCH):
+            self.ec2.create_tags(
+                Resources=ami_ids[start:start + CREATE_TAGS_BATCH],
+                Tags=[{'Key': PENDING_DELETE_TAG, 'Value': marked_at}],
+            )
+
+        return len(ami_ids)
+
+    def remove_amis_from_ids(self, ami_ids, queue=None):
 
         """
         takes a list of AMI ids, verify on aws and removes them
         :param ami_ids: array of AMI ids
+        :param queue: see remove_amis
         """
 
         if not ami_ids:
             return False
 
-        my_custom_images = self.ec2.describe_images(
-            Owners=['self'],
-            ImageIds=ami_ids
-        )
+        # all the images are needed to know which snapshots are shared
+        paginator = self.ec2.get_paginator('describe_images')
+        images = [image for page in paginator.paginate(Owners=['self'])
+                  for image in page.get('Images', [])]
+        wanted_ids = set(ami_ids)
+
         amis = []
-        for image_json in my_custom_images.get('Images'):
-            ami = AMI.object_with_json(image_json)
-            amis.append(ami)
+        for image_json in images:
+            if image_json.get('ImageId') in wanted_ids:
+                ami = AMI.object_with_json(image_json)
+                amis.append(ami)
 
-        return self.remove_amis(amis)
+        return self.remove_amis(amis, SnapshotIndex.from_images_json(images), queue=queue)
 
-    def map_candidates(self, candidates_amis=None, mapping_strategy=None):
+    def map_candidates(self, candidates_amis=None, mapping_strategy=None, tag_index=None):
 
         """
         Given a dict of AMIs to clean, and a mapping strategy (see config.py),
@@ -186,6 +534,14 @@ class AMICleaner(object):
         if not mapping_strategy:
             return candidates_amis
 
+        if mapping_strategy.get("key") == "tags":
+            return self.map_candidates_on_tags(
+                candidates_amis,
+                mapping_strategy.get("values"),
+                mapping_strategy.get("excluded"),
+                tag_index,
+            )
+
         candidates_map = dict()
         for ami in candidates_amis:
             # case : grouping on name
@@ -195,31 +551,38 @@ class AMICleaner(object):
                         mapping_list = candidates_map.get(mapping_value) or []
                         mapping_list.append(ami)
                         candidates_map[mapping_value] = mapping_list
-            # case : grouping on tags
-            elif mapping_strategy.get("key") == "tags":
-                mapping_value = self.tags_values_to_string(
-                    ami.tags,
-                    mapping_strategy.get("values")
-                )
-                if mapping_strategy.get("excluded"):
-                    for excluded_mapping_value in mapping_strategy.get("excluded"):
-                        if excluded_mapping_value == "<all values>":
-                            if mapping_value == "":
-                                mapping_list = candidates_map.get("<no tag>") or []
-                                mapping_list.append(ami)
-                                candidates_map["<no tag>"] = mapping_list
-                            else:
-                                mapping_list = candidates_map.get("") or []
-                                mapping_list.append(ami)
-                                candidates_map[""] = mapping_list
-                        elif excluded_mapping_value not in mapping_value:
-                            mapping_list = candidates_map.get(mapping_value) or []
-                            mapping_list.append(ami)
-                            candidates_map[mapping_value] = mapping_list
-                else:
-                    mapping_list = candidates_map.get(mapping_value) or []
-                    mapping_list.append(ami)
-                    candidates_map[mapping_value] = mapping_list
+
+        return candidates_map
+
+    @staticmethod
+    def map_candidates_on_tags(candidates_amis, filters=None, excluded=None, tag_index=None):
+
+        """
+        Groups AMIs on the sorted values of their tags whose key is in
+        filters (all tags without filters). AMIs having one of the excluded
+        values are grouped under "", "<all values>" excludes every tagged
+        AMI and groups the others under "<no tag>".
+        tag_index may index more AMIs than the candidates.
+        """
+
+        index = tag_index or TagIndex.from_amis(candidates_amis)
+        excluded = set(excluded or [])
+        exclude_all = "<all values>" in excluded
+        excluded_ids = index.ids_with_values(excluded - {"<all values>"}, filters)
+        groups = index.groups(filters)
+
+        candidates_map = dict()
+        for ami in candidates_amis:
+            mapping_value = groups.get(ami.id, "")
+            if exclude_all:
+                mapping_value = "" if mapping_value else "<no tag>"
+            elif ami.id in excluded_ids:
+                mapping_value = ""
+            mapping_list = candidates_map.get(mapping_value)
+            if mapping_list is None:
+                candidates_map[mapping_value] = [ami]
+            else:
+                mapping_list.append(ami)
 
         return candidates_map
 
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import object
+import threading
+import time
+import traceback
+
+import boto3
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from .resources.config import METRICS_ADDRESS, TERM
+from .utils import Printer
+
+
+THROTTLING_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'TooManyRequestsException',
+)
+
+
+class Metrics(object):
+
+    """ Thread safe metrics registry rendered in the Prometheus text format """
+
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    DESCRIPTIONS = {
+        "amicleaner_amis_scanned": ("gauge", "AMIs found during the last cycle"),
+        "amicleaner_candidates": ("gauge", "AMIs per report group during the last cycle"),
+        "amicleaner_reclaimable_gigabytes": ("gauge", "Snapshots storage of the candidates during the last cycle"),
+        "amicleaner_amis_deleted_total": ("counter", "AMIs deregistered"),
+        "amicleaner_amis_marked_total": ("counter", "AMIs tagged for a later sweep (--mark)"),
+        "amicleaner_deletions_per_second": ("gauge", "AMIs deregistered per second during the last cycle"),
+        "amicleaner_failed_snapshots_total": ("counter", "Snapshots which could not be deleted"),
+        "amicleaner_lingering_amis": ("gauge", "AMIs still visible after the last cycle removals (--verify)"),
+        "amicleaner_lingering_snapshots": ("gauge",
+                                           "Snapshots still visible after the last cycle removals (--verify)"),
+        "amicleaner_cycles_total": ("counter", "Cleaning cycles run"),
+        "amicleaner_cycle_errors_total": ("counter", "Cleaning cycles aborted by an error"),
+        "amicleaner_cycle_duration_seconds": ("gauge", "Duration of the last cycle"),
+        "amicleaner_api_call_duration_seconds": ("histogram", "AWS API calls latency"),
+        "amicleaner_api_throttles_total": ("counter", "AWS API calls throttled"),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = dict()
+        self.histograms = dict()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self._key(name, labels)] = value
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def clear(self, name):
+
+        """ drops every labelled value of a metric """
+
+        with self.lock:
+            for key in [k for k in self.values if k[0] == name]:
+                del self.values[key]
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [0] * len(self.LATENCY_BUCKETS) + [0.0, 0]
+                self.histograms[key] = histogram
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(
+            '{0}="{1}"'.format(
+                k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            ) for k, v in labels
+        ) + "}"
+
+    def render(self):
+
+        """ returns metrics in the Prometheus text exposition format """
+
+        lines = []
+        with self.lock:
+            for name, (metric_type, description) in sorted(self.DESCRIPTIONS.items()):
+                lines.append("# HELP {0} {1}".format(name, description))
+                lines.append("# TYPE {0} {1}".format(name, metric_type))
+                if metric_type == "histogram":
+                    for (key, labels), histogram in sorted(self.histograms.items()):
+                        if key != name:
+                            continue
+                        for i, bound in enumerate(self.LATENCY_BUCKETS):
+                            lines.append("{0}_bucket{1} {2}".format(
+                                name, self._labels(labels, [("le", bound)]), histogram[i]))
+                        lines.append("{0}_bucket{1} {2}".format(
+                            name, self._labels(labels, [("le", "+Inf")]), histogram[-1]))
+                        lines.append("{0}_sum{1} {2}".format(name, self._labels(labels), histogram[-2]))
+                        lines.append("{0}_count{1} {2}".format(name, self._labels(labels), histogram[-1]))
+                else:
+                    for (key, labels), value in sorted(self.values.items()):
+                        if key == name:
+                            lines.append("{0}{1} {2}".format(name, self._labels(labels), value))
+
+        return "\n".join(lines) + "\n"
+
+    def instrument(self, events):
+
+        """
+        Registers latency and throttling handlers on a botocore event
+        emitter, clients created afterwards report their API calls
+        """
+
+        events.register('before-call', self._before_call)
+        events.register('after-call', self._after_call)
+        events.register('needs-retry', self._needs_retry)
+
+    @staticmethod
+    def _before_call(context=None, **kwargs):
+        if context is not None:
+            context['amicleaner_start'] = time.time()
+
+    def _after_call(self, model=None, context=None, **kwargs):
+        start = (context or {}).get('amicleaner_start')
+        if start is not None and model is not None:
+            self.observe("amicleaner_api_call_duration_seconds",
+                         time.time() - start, operation=model.name)
+
+    def _needs_retry(self, response=None, operation=None, **kwargs):
+        if not response:
+            return None
+        code = response[1].get("Error", {}).get("Code")
+        if code in THROTTLING_ERROR_CODES:
+            self.inc("amicleaner_api_throttles_total",
+                     operation=getattr(operation, "name", ""))
+        return None
+
+    def serve(self, port, address=METRICS_ADDRESS):
+
+        """ serves metrics over http from a background thread """
+
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((address, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class Daemon(object):
+
+    """
+    Runs the cleaner in a loop. The same App is reused for every cycle so
+    the AWS clients and the parsed AMIs inventory stay warm in memory.
+    """
+
+    def __init__(self, app, metrics=None):
+        self.app = app
+        self.metrics = metrics or Metrics()
+
+    def run_once(self):
+
+        """ one cleaning cycle, AMIs are only removed with --force-delete """
+
+        app = self.app
+        start = time.time()
+
+        candidates = None
+        app.last_report = dict()
+        app.last_storage = None
+        if app.aws_regions:
+            # the engine fetches every region to build the lineages
+            candidates = app.fetch_candidates()
+            available_amis = app.available_amis
+        else:
+            available_amis = app.fetcher.fetch_available_amis()
+            if available_amis:
+                candidates = app.fetch_candidates(available_amis)
+        self.metrics.set("amicleaner_amis_scanned", len(available_amis))
+        if candidates:
+            candidates = app.prepare_candidates(candidates)
+
+        self.metrics.clear("amicleaner_candidates")
+        for group_name, amis in app.last_report.items():
+            self.metrics.set("amicleaner_candidates", len(amis), group=group_name)
+        self.metrics.set("amicleaner_reclaimable_gigabytes",
+                         app.last_storage.total()[1] if app.last_storage else 0)
+
+        if candidates and app.force_delete and app.mark:
+            # two-phase mode, the AMIs are only tagged for a later --sweep
+            self.metrics.inc("amicleaner_amis_marked_total", app.prepare_mark_amis(candidates))
+            self.metrics.set("amicleaner_deletions_per_second", 0)
+        elif candidates and app.force_delete:
+            print(TERM.bold("\nCleaning {} AMIs ...".format(len(candidates))))
+            delete_start = time.time()
+            failed = app.delete_candidates(candidates)
+            elapsed = time.time() - delete_start
+            deleted = len(app.last_removed)
+
+            self.metrics.inc("amicleaner_amis_deleted_total", deleted)
+            self.metrics.inc("amicleaner_failed_snapshots_total", len(failed))
+            self.metrics.set("amicleaner_deletions_per_second",
+                             deleted / elapsed if elapsed else 0)
+            if failed:
+                print(TERM.red("\n{0} failed snapshots".format(len(failed))))
+                Printer.print_failed_snapshots(failed)
+
+            report = app.last_verification
+            if report is not None:
+                self.metrics.set("amicleaner_lingering_amis", len(report.lingering_amis))
+                self.metrics.set("amicleaner_lingering_snapshots", len(report.lingering_snapshots))
+        else:
+            self.metrics.set("amicleaner_deletions_per_second", 0)
+
+        self.metrics.inc("amicleaner_cycles_total")
+        self.metrics.set("amicleaner_cycle_duration_seconds", time.time() - start)
+
+    def run(self, cycles=None):
+
+        """ runs cycles until interrupted (or `cycles` times) """
+
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+        self.metrics.instrument(boto3.DEFAULT_SESSION.events)
+
+        server = None
+        if self.app.metrics_port:
+            server = self.metrics.serve(self.app.metrics_port)
+            print(TERM.bold("Serving metrics on port {0}".format(self.app.metrics_port)))
+
+        count = 0
+        try:
+            while cycles is None or count < cycles:
+                start = time.time()
+                print(TERM.bold("\nStarting cleaning cycle ..."))
+                try:
+                    self.run_once()
+                except Exception:
+                    self.metrics.inc("amicleaner_cycle_errors_total")
+                    traceback.print_exc()
+                count += 1
+                if cycles is None or count < cycles:
+                    time.sleep(max(0, self.app.interval - (time.time() - start)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if server is not None:
+                server.shutdown()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+import hashlib
+import json
+import os
+
+CANDIDATE = "candidate"
+
+
+def transition_label(old, new):
+
+    """ report entry name of AMIs going from status old to new (None: not scanned) """
+
+    if old is None:
+        return "New candidates" if new == CANDIDATE else "New AMIs (kept by {0})".format(new)
+    if new is None:
+        return "Gone since the previous run (was {0})".format(old)
+    if old == CANDIDATE:
+        return "Now protected (by {0})".format(new)
+    if new == CANDIDATE:
+        return "Now candidates (were kept by {0})".format(old)
+    return "Kept by {0} (was {1})".format(new, old)
+
+
+class RunStateError(ValueError):
+    pass
+
+
+class RunState(object):
+
+    """
+    Fingerprint of a run: the status of every scanned AMI, "candidate" or
+    the rule keeping it, stored as sorted AMI ids with a status code each
+    and a digest of the whole, so two runs compare in one merge pass.
+
+    {"version": 1, "digest": "...", "statuses": ["candidate", "instances"],
+     "ids": ["ami-0123", "ami-4567"], "codes": [0, 1]}
+    """
+
+    VERSION = 1
+
+    def __init__(self, ids=None, codes=None, statuses=None, path=None):
+        self.path = path
+        self.ids = ids or []
+        self.codes = codes or []
+        self.statuses = statuses or []
+        self._digest = None
+
+    @staticmethod
+    def from_results(scan_results, plan_results=()):
+
+        """ state of the ScanResults of a scan and PlanResults of its candidates """
+
+        status_of = dict()
+        for result in scan_results:
+            if result.excluded_by is not None:
+                status_of[result.ami.id] = result.excluded_by
+        for result in plan_results:
+            status_of[result.ami.id] = CANDIDATE if result.removed else result.reason
+
+        state = RunState()
+        status_codes = dict()
+        state.ids = sorted(status_of)
+        for ami_id in state.ids:
+            status = status_of[ami_id]
+            code = status_codes.get(status)
+            if code is None:
+                code = status_codes[status] = len(state.statuses)
+                state.statuses.append(status)
+            state.codes.append(code)
+        return state
+
+    @staticmethod
+    def load(path):
+
+        """
+        reads the state file, a missing file is an empty state. Raises
+        RunStateError when the file is not a run state.
+        """
+
+        state = RunState(path=path)
+        if path and os.path.exists(path):
+            try:
+                with open(path) as state_file:
+                    document = json.load(state_file)
+            except ValueError as e:
+                raise RunStateError("invalid run state {0} : {1}".format(path, e))
+            if not isinstance(document, dict) or document.get("version") != RunState.VERSION:
+                raise RunStateError("unsupported run state version in {0}".format(path))
+            try:
+                state.ids = [str(ami_id) for ami_id in document["ids"]]
+                state.codes = [int(code) for code in document["codes"]]
+                state.statuses = [str(status) for status in document["statuses"]]
+            except (KeyError, TypeError, ValueError):
+                raise RunStateError("invalid run state {0}".format(path))
+            if len(state.ids) != len(state.codes) or \
+                    any(code < 0 or code >= len(state.statuses) for code in state.codes):
+                raise RunStateError("invalid run state {0}".format(path))
+            state._digest = document.get("digest")
+        return state
+
+    def save(self, path):
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as state_file:
+            json.dump({"version": self.VERSION, "digest": self.digest, "statuses": self.statuses,
+                       "ids": self.ids, "codes": self.codes}, state_file, separators=(",", ":"))
+        os.replace(temp_path, path)
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            sha = hashlib.sha1()
+            for ami_id, code in zip(self.ids, self.codes):
+                sha.update("{0}\t{1}\n".format(ami_id, self.statuses[code]).encode("utf-8"))
+            self._digest = sha.hexdigest()
+        return self._digest
+
+    def __len__(self):
+        return len(self.ids)
+
+    def diff(self, other):
+
+        """
+        Changes from this state to other: {transition label: [AMI ids]},
+        empty when the digests match, found by merging the sorted ids
+        """
+
+        changes = dict()
+        if self.digest == other.digest:
+            return changes
+
+        def add(ami_id, old, new):
+            changes.setdefault(transition_label(old, new), []).append(ami_id)
+
+        ids, other_ids = self.ids, other.ids
+        i = j = 0
+        while i < len(ids) or j < len(other_ids):
+            if j == len(other_ids) or (i < len(ids) and ids[i] < other_ids[j]):
+                add(ids[i], self.statuses[self.codes[i]], None)
+                i += 1
+            elif i == len(ids) or other_ids[j] < ids[i]:
+                add(other_ids[j], None, other.statuses[other.codes[j]])
+                j += 1
+            else:
+                old, new = self.statuses[self.codes[i]], other.statuses[other.codes[j]]
+                if old != new:
+                    add(ids[i], old, new)
+                i += 1
+                j += 1
+        return changes
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .resources.config import MAPPING_KEY, MAPPING_VALUES, EXCLUDED_MAPPING_VALUES
+from .resources.config import KEEP_PREVIOUS, AMI_MIN_DAYS
+from .core import InstanceIndex
+from .lineage import LineageGraph
+from .resources.models import ScanResult, PlanResult, RemovalResult
+
+__all__ = ["Engine", "ScanResult", "PlanResult", "RemovalResult"]
+
+
+class Engine(object):
+
+    """
+    Programmatic API of the cleaner, it neither prints nor prompts :
+
+        engine = Engine(keep_previous=2)
+        candidates = [r.ami for r in engine.scan() if r.excluded_by is None]
+        removed = [r.ami for r in engine.plan(candidates) if r.removed]
+        for result in engine.execute(removed):
+            ...
+
+    Each step is a generator of typed results. The engine keeps its AWS
+    clients and inventories between calls, so it can be called repeatedly.
+    """
+
+    # (name, Fetcher method) of the rules excluding AMIs in use
+    EXCLUSION_RULES = (
+        ("instances", "fetch_instances"),
+        ("unattached launch configurations", "fetch_unattached_lc"),
+        ("unattached launch templates", "fetch_unattached_lt"),
+        ("zeroed autoscaling groups launch configurations", "fetch_zeroed_asg_lc"),
+        ("zeroed autoscaling groups launch templates", "fetch_zeroed_asg_lt"),
+        ("launch templates default versions", "fetch_default_lt"),
+        ("aws backup", "fetch_aws_backup"),
+    )
+
+    def __init__(self, mapping_strategy=None, keep_previous=KEEP_PREVIOUS, ami_min_days=AMI_MIN_DAYS,
+                 policy=None, columnar=False, workers=1, processes=1, usage_history=None,
+                 keep_used_days=None, regions=None, keep_shared=False, fetcher=None, cleaner=None,
+                 fetchers=None, cleaners=None, config=None):
+        self.mapping_strategy = mapping_strategy or {
+            "key": MAPPING_KEY,
+            "values": MAPPING_VALUES,
+            "excluded": EXCLUDED_MAPPING_VALUES,
+        }
+        self.keep_previous = keep_previous
+        self.ami_min_days = ami_min_days
+        self.policy = policy
+        self.columnar = columnar
+        self.workers = workers
+        self.processes = processes
+        self.usage_history = usage_history
+        self.keep_used_days = keep_used_days
+        self.keep_shared = keep_shared
+        self.config = config
+
+        self._fetcher = fetcher
+        self._cleaner = cleaner
+
+        # regions scanned together, AMI copies are then handled by lineage
+        self.regions = regions
+        self._fetchers = dict(fetchers or {})
+        self._cleaners = dict(cleaners or {})
+
+        # inventory of the last scan (and its snapshots index, built once
+        # per scan), AMI ids excluded by each rule and lineage graph of the
+        # regions
+        self._available_amis = dict()
+        self._snapshot_index = None
+        self.exclusions = dict()
+        self.lineage = None
+
+        # usage of the AMIs by the instances of the last scan
+        self.instance_index = InstanceIndex()
+
+    @property
+    def fetcher(self):
+        if self._fetcher is None:
+            from .fetch import Fetcher
+            self._fetcher = Fetcher(config=self.config)
+        return self._fetcher
+
+    @property
+    def cleaner(self):
+        if self._cleaner is None:
+            from .core import AMICleaner
+            self._cleaner = AMICleaner(config=self.config)
+        return self._cleaner
+
+    def region_config(self, region):
+        from botocore.config import Config
+        region_config = Config(region_name=region)
+        return self.config.merge(region_config) if self.config is not None else region_config
+
+    def fetcher_for(self, region):
+        if region not in self._fetchers:
+            from .fetch import Fetcher
+            self._fetchers[region] = Fetcher(config=self.region_config(region))
+        return self._fetchers[region]
+
+    def cleaner_for(self, region):
+        if not self.regions or region is None:
+            return self.cleaner
+        if region not in self._cleaners:
+            from .core import AMICleaner
+            self._cleaners[region] = AMICleaner(config=self.region_config(region))
+        return self._cleaners[region]
+
+    @property
+    def available_amis(self):
+        return self._available_amis
+
+    @available_amis.setter
+    def available_amis(self, amis):
+        self._available_amis = amis
+        self._snapshot_index = None
+
+    @property
+    def snapshot_index(self):
+
+        """
+        snapshots index of the last scanned AMIs inventory, built once and
+        shared by the report and the removals (which release their AMIs)
+        """
+
+        if self._snapshot_index is None and self.available_amis:
+            from .core import SnapshotIndex
+            self._snapshot_index = SnapshotIndex.from_amis(self.available_amis.values())
+        return self._snapshot_index
+
+    @property
+    def tag_index(self):
+
+        """ tags index of the scanned inventory, if it comes from the fetcher """
+
+        if self._fetcher is not None and self.available_amis is self._fetcher.available_amis:
+            return self._fetcher.tag_index
+        return None
+
+    def add_ami(self, ami):
+
+        """ adds (or updates) an AMI of the inventory, and its snapshots """
+
+        self.available_amis[ami.id] = ami
+        if self._snapshot_index is not None:
+            self._snapshot_index.release(ami.id)
+            self._snapshot_index.add(ami.id, [block_device.snapshot_id
+                                              for block_device in ami.block_device_mappings])
+
+    def forget_ami(self, ami_id):
+
+        """ drops an AMI from the inventory, its snapshots index and tags index """
+
+        if ami_id not in self.available_amis:
+            return None
+        if self.tag_index is not None:
+            ami = self._fetcher.forget_ami(ami_id)
+        else:
+            ami = self.available_amis.pop(ami_id)
+        if self._snapshot_index is not None:
+            self._snapshot_index.release(ami_id)
+        return ami
+
+    def scan(self, available_amis=None, excluded_amis=None):
+
+        """
+        Yields a ScanResult for every AMI of the inventory (fetched unless
+        given). AMIs are checked against the exclusion rules, or only
+        against excluded_amis ids when given.
+        With several regions, the inventories are merged and every AMI of
+        a lineage with an AMI in use is excluded.
+        """
+
+        if self.regions and available_amis is None:
+            fetchers = [(region, self.fetcher_for(region)) for region in self.regions]
+            inventories = dict((region, f.fetch_available_amis()) for region, f in fetchers)
+            self.available_amis = dict()
+            for region, amis in inventories.items():
+                for ami in amis.values():
+                    ami.region = region
+                self.available_amis.update(amis)
+            self.lineage = LineageGraph.from_inventories(inventories)
+        else:
+            fetchers = [(None, self.fetcher)]
+            self.available_amis = available_amis or self.fetcher.fetch_available_amis()
+            self.lineage = None
+
+        if excluded_amis:
+            self.exclusions = {"excluded": set(excluded_amis)}
+        else:
+            self.exclusions = self.fetch_exclusions(fetchers)
+
+        if self.keep_shared:
+            self.exclusions["shared"] = self.shared_amis(fetchers)
+
+        if self.lineage is not None:
+            self.exclusions["lineage in use"] = self.lineage_in_use()
+
+        exclusions = list(self.exclusions.items())
+        for ami_id, ami in self.available_amis.items():
+            excluded_by = None
+            for name, ami_ids in exclusions:
+                if ami_id in ami_ids:
+                    excluded_by = name
+                    break
+            yield ScanResult(ami, excluded_by)
+
+    def fetch_exclusions(self, fetchers):
+
+        """ rule name: ids of the AMIs excluded by the rule, in the regions of fetchers """
+
+        exclusions = dict((name, set()) for name, _ in self.EXCLUSION_RULES)
+        self.instance_index = InstanceIndex()
+        for _, f in fetchers:
+            f.invalidate()
+            for name, method in self.EXCLUSION_RULES:
+                exclusions[name].update(getattr(f, method)())
+            self.instance_index.update(f.instance_index)
+        if self.usage_history is not None:
+            self.record_usage(exclusions["instances"])
+            if self.keep_used_days:
+                exclusions["recently used"] = self.usage_history.recently_used(self.keep_used_days)
+        return exclusions
+
+    def shared_amis(self, fetchers):
+
+        """
+        ids of the AMIs not excluded yet but shared with other accounts,
+        only these candidates have their launch permissions checked
+        """
+
+        excluded_ids = set()
+        for ami_ids in self.exclusions.values():
+            excluded_ids |= ami_ids
+
+        shared = set()
+        for region, f in fetchers:
+            shared |= f.fetch_shared_amis([
+                ami_id for ami_id, ami in self.available_amis.items()
+                if ami_id not in excluded_ids and (region is None or ami.region == region)
+            ])
+        return shared
+
+    def lineage_in_use(self):
+
+        """ ids of the AMIs not excluded themselves but whose lineage has an excluded AMI """
+
+        excluded_ids = set()
+        for ami_ids in self.exclusions.values():
+            excluded_ids |= ami_ids
+
+        lineage = self.lineage.lineage
+        used = set(lineage(ami.region, ami_id) for ami_id, ami in self.available_amis.items()
+                   if ami_id in excluded_ids)
+        return set(ami_id for ami_id, ami in self.available_amis.items()
+                   if ami_id not in excluded_ids and lineage(ami.region, ami_id) in used)
+
+    def lineage_representatives(self, candidates_amis):
+
+        """
+        Returns the oldest candidate of each lineage, and the candidates of
+        the lineage of each representative (by representative id)
+        """
+
+        lineages = dict()
+        for ami in candidates_amis:
+            lineages.setdefault(self.lineage.lineage(ami.region, ami.id), []).append(ami)
+
+        representatives = []
+        members = dict()
+        for amis in lineages.values():
+            amis.sort(key=lambda a: a.creation_date or "")
+            representatives.append(amis[0])
+            members[amis[0].id] = amis
+        return representatives, members
+
+    def record_usage(self, ami_ids=None):
+
+        """
+        Records AMIs in use (the instances AMIs unless given) in the usage
+        history, and saves it
+        """
+
+        history = self.usage_history
+        if ami_ids is None:
+            ami_ids = self.fetcher.fetch_instances()
+        history.record(ami_ids)
+        history.prune(max(history.DAYS, self.keep_used_days or 0))
+        if history.path:
+            history.save()
+        return history
+
+    def plan(self, candidates_amis=None):
+
+        """
+        Yields a PlanResult for every candidate AMI (scanned unless given),
+        with the policy if any, the mapping strategy and reductions otherwise
+        """
+
+        if candidates_amis is None:
+            candidates_amis = [r.ami for r in self.scan() if r.excluded_by is None]
+
+        if not candidates_amis:
+            return
+
+        if self.lineage is not None:
+            # rules apply to lineages, through their oldest AMI
+            representatives, members = self.lineage_representatives(candidates_amis)
+            for result in self._plan(representatives):
+                for ami in members[result.ami.id]:
+                    yield PlanResult(ami, result.group, result.reason)
+            return
+
+        for result in self._plan(candidates_amis):
+            yield result
+
+    def _plan(self, candidates_amis):
+        if self.policy:
+            for result in self.policy.plan(candidates_amis):
+                yield result
+            return
+
+        c = self.cleaner
+
+        mapped_amis = c.map_candidates(
+            candidates_amis=candidates_amis,
+            mapping_strategy=self.mapping_strategy,
+            tag_index=self.tag_index,
+        )
+
+        if self.columnar:
+            from .columnar import AMIColumns
+            reductions = AMIColumns.from_mapped(mapped_amis).reduce(self.keep_previous, self.ami_min_days)
+        elif self.processes > 1:
+            from .parallel import reduce_groups
+            reductions = reduce_groups(mapped_amis, self.keep_previous, self.ami_min_days, self.processes)
+        else:
+            reductions = (
+                (group_name,) + (c.reduce_candidates(amis, self.keep_previous, self.ami_min_days)
+                                 if group_name else (amis, [], []))
+                for group_name, amis in mapped_amis.items()
+            )
+
+        for result in self.plan_results(reductions):
+            yield result
+
+    @staticmethod
+    def plan_results(reductions, ami_of=None):
+
+        """ PlanResults of (group name, reduced, keep previous, keep min days) reductions """
+
+        for group_name, reduced, keep_previous, keep_min_day in reductions:
+            group_name = group_name or ""
+            if ami_of is not None:
+                reduced, keep_previous, keep_min_day = (
+                    (ami_of(row) for row in rows) for rows in (reduced, keep_previous, keep_min_day))
+
+            if not group_name:
+                for ami in reduced:
+                    yield PlanResult(ami, "", PlanResult.KEPT_BY_MAPPING)
+                continue
+
+            for ami in reduced:
+                yield PlanResult(ami, group_name, None)
+            for ami in keep_previous:
+                yield PlanResult(ami, group_name, PlanResult.KEPT_BY_KEEP_PREVIOUS)
+            for ami in keep_min_day:
+                yield PlanResult(ami, group_name, PlanResult.KEPT_BY_MIN_DAYS)
+
+    def plan_inventory(self, path):
+
+        """
+        plan over a compact inventory file written at path while fetching
+        (see inventory.py): candidates are grouped and reduced over its
+        columns, an AMI is only built when its PlanResult is yielded. The
+        mapping strategy applies, not the policy nor lineages.
+        available_amis then only holds the excluded AMIs, and the snapshots
+        index is read from the inventory columns.
+        """
+
+        from .columnar import AMIColumns
+
+        f = self.fetcher
+        inventory = f.fetch_inventory(path)
+        try:
+            self.lineage = None
+            self.exclusions = self.fetch_exclusions([(None, f)])
+
+            excluded_ids = set()
+            for ami_ids in self.exclusions.values():
+                excluded_ids |= ami_ids
+            rows = inventory.rows(excluded_ids)
+
+            if self.keep_shared:
+                ids = dict((inventory.id(row), row) for row in rows)
+                self.exclusions["shared"] = f.fetch_shared_amis(list(ids))
+                excluded_rows = set(ids[ami_id] for ami_id in self.exclusions["shared"])
+                rows = [row for row in rows if row not in excluded_rows]
+
+            kept_rows = set(rows)
+            self.available_amis = dict(
+                (ami.id, ami) for ami in (inventory.ami(row, f.region)
+                                          for row in range(len(inventory)) if row not in kept_rows))
+            self._snapshot_index = inventory.snapshot_index()
+
+            mapped_rows = inventory.map_rows(rows, self.mapping_strategy)
+            reductions = AMIColumns.from_inventory(inventory, mapped_rows).reduce(
+                self.keep_previous, self.ami_min_days)
+
+            for result in self.plan_results(reductions, lambda row: inventory.ami(row, f.region)):
+                yield result
+        finally:
+            inventory.close()
+
+    def execute(self, amis, snapshot_index=None, workers=None):
+
+        """
+        Removes amis (each in its region), yields a RemovalResult for each
+        of them as soon as it is done (in completion order with several workers)
+        """
+
+        workers = workers or self.workers or 1
+
+        if workers <= 1:
+            for ami in amis:
+                yield self.cleaner_for(ami.region).deregister(ami, snapshot_index)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.cleaner_for(ami.region).deregister, ami, snapshot_index)
+                       for ami in amis]
+            for future in as_completed(futures):
+                yield future.result()
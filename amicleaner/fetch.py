@@ -3,9 +3,13 @@
 
 from __future__ import absolute_import
 from builtins import object
+from concurrent.futures import ThreadPoolExecutor
+import time
 import boto3
-from .resources.config import BOTO3_RETRIES
-from .resources.models import AMI
+from botocore.exceptions import ClientError
+from .core import TagIndex, InstanceIndex
+from .resources.config import BOTO3_RETRIES, PENDING_DELETE_TAG, SHARED_CHECK_WORKERS, SHARED_CHECK_TTL
+from .resources.models import AMI, AWSEC2Instance, InternTable
 
 
 class Fetcher(object):
@@ -17,45 +21,177 @@ class Fetcher(object):
         """ Initializes aws sdk clients """
 
         self.ec2 = ec2 or boto3.client('ec2', config=config)
-        self.asg = autoscaling or boto3.client('autoscaling')
+        self.asg = autoscaling or boto3.client('autoscaling', config=config)
+        self.region = getattr(getattr(self.ec2, 'meta', None), 'region_name', None)
+
+        # inventory of the previous fetch, and its tags index
+        self.available_amis = dict()
+        self.tag_index = TagIndex()
+
+        # strings shared by the AMIs and instances of the inventory
+        self.strings = InternTable()
+
+        # autoscaling inventories shared by the launch configurations and
+        # templates rules, until invalidate is called
+        self._auto_scaling_groups = None
+        self._launch_configurations = None
+
+        # instances inventory and their usage of the AMIs, until invalidate
+        self._instances = None
+        self.instance_index = InstanceIndex()
+
+        # AMI id: (checked at, shared) of the launch permissions checks,
+        # kept across evaluations for SHARED_CHECK_TTL seconds
+        self._shared = dict()
+
+    def invalidate(self):
+
+        """ forgets the instances and autoscaling inventories, for a new evaluation """
+
+        self._auto_scaling_groups = None
+        self._launch_configurations = None
+        self._instances = None
+
+    def fetch_auto_scaling_groups(self):
+
+        """ all the autoscaling groups, fetched once page by page """
+
+        if self._auto_scaling_groups is None:
+            paginator = self.asg.get_paginator('describe_auto_scaling_groups')
+            self._auto_scaling_groups = [
+                asg for page in paginator.paginate()
+                for asg in page.get("AutoScalingGroups", [])
+            ]
+        return self._auto_scaling_groups
+
+    def fetch_launch_configurations(self):
+
+        """
+        ImageId of every launch configuration by name, fetched once page by
+        page instead of describing them again by names (50 at most per call)
+        """
+
+        if self._launch_configurations is None:
+            paginator = self.asg.get_paginator('describe_launch_configurations')
+            self._launch_configurations = dict(
+                (lc.get("LaunchConfigurationName", ""), lc.get("ImageId"))
+                for page in paginator.paginate()
+                for lc in page.get("LaunchConfigurations", [])
+            )
+        return self._launch_configurations
 
     def fetch_available_amis(self):
 
-        """ Retrieve from your aws account your custom AMIs"""
+        """
+        Retrieve from your aws account your custom AMIs.
+        AMIs whose payload did not change since the previous call on this
+        fetcher are reused instead of being parsed again, the tags index is
+        updated with the differences.
+        """
 
+        previous_amis = self.available_amis
         available_amis = dict()
 
         my_custom_images = self.ec2.describe_images(Owners=['self'])
         for image_json in my_custom_images.get('Images'):
-            ami = AMI.object_with_json(image_json)
+            ami = previous_amis.get(image_json.get('ImageId'))
+            if ami is None or ami.json != image_json:
+                if ami is not None:
+                    self.tag_index.remove(ami)
+                ami = AMI.object_with_json(self.strings.intern_image(image_json), self.region)
+                self.tag_index.add(ami)
             available_amis[ami.id] = ami
 
+        for ami_id, ami in previous_amis.items():
+            if ami_id not in available_amis:
+                self.tag_index.remove(ami)
+
+        self.available_amis = available_amis
+        self.strings.retain(ami.json for ami in available_amis.values())
+
         return available_amis
 
-    def fetch_unattached_lc(self):
+    def fetch_ami(self, ami_id):
 
         """
-        Find AMIs for launch configurations unattached
-        to autoscaling groups
+        Describes one AMI again and updates the inventory and the tags
+        index with it. Returns the AMI, None if it is no longer available
+        (see forget_ami).
         """
 
-        resp = self.asg.describe_auto_scaling_groups()
-        used_lc = (asg.get("LaunchConfigurationName", "")
-                   for asg in resp.get("AutoScalingGroups", []))
+        images = self.ec2.describe_images(
+            Owners=['self'], Filters=[{'Name': 'image-id', 'Values': [ami_id]}]).get('Images') or []
+        image_json = images[0] if images else None
+        if image_json is None or image_json.get('State', 'available') != 'available':
+            return None
+
+        ami = self.available_amis.get(ami_id)
+        if ami is None or ami.json != image_json:
+            if ami is not None:
+                self.tag_index.remove(ami)
+            ami = AMI.object_with_json(self.strings.intern_image(image_json), self.region)
+            self.tag_index.add(ami)
+            self.available_amis[ami_id] = ami
+        return ami
+
+    def forget_ami(self, ami_id):
+
+        """ drops a deregistered AMI from the inventory and the tags index """
+
+        ami = self.available_amis.pop(ami_id, None)
+        if ami is not None:
+            self.tag_index.remove(ami)
+        return ami
 
-        resp = self.asg.describe_launch_configurations()
-        all_lcs = (lc.get("LaunchConfigurationName", "")
-                   for lc in resp.get("LaunchConfigurations", []))
+    def fetch_inventory(self, path):
 
-        unused_lcs = list(set(all_lcs) - set(used_lc))
+        """
+        Writes your custom AMIs to a compact inventory file at path page
+        by page, without building AMI objects, and returns it opened
+        """
+
+        from .inventory import Inventory, InventoryWriter
+
+        writer = InventoryWriter(path)
+        try:
+            paginator = self.ec2.get_paginator('describe_images')
+            for page in paginator.paginate(Owners=['self']):
+                for image_json in page.get('Images', []):
+                    writer.add(image_json)
+        except Exception:
+            writer.discard()
+            raise
+        writer.close()
+
+        return Inventory.open(path)
+
+    def fetch_marked_amis(self, tag_key=PENDING_DELETE_TAG):
+
+        """
+        Retrieve the custom AMIs marked for deletion, filtered on their
+        tag by aws instead of evaluating the whole inventory again
+        """
 
-        resp = self.asg.describe_launch_configurations(
-            LaunchConfigurationNames=unused_lcs
+        resp = self.ec2.describe_images(
+            Owners=['self'],
+            Filters=[{'Name': 'tag-key', 'Values': [tag_key]}]
         )
 
-        amis = [lc.get("ImageId")
-                for lc in resp.get("LaunchConfigurations", [])]
+        return [AMI.object_with_json(image_json, self.region)
+                for image_json in resp.get('Images', [])]
 
+    def fetch_unattached_lc(self):
+
+        """
+        Find AMIs for launch configurations unattached
+        to autoscaling groups
+        """
+
+        used_lc = set(asg.get("LaunchConfigurationName", "")
+                      for asg in self.fetch_auto_scaling_groups())
+
+        amis = [image_id for lc_name, image_id in self.fetch_launch_configurations().items()
+                if lc_name not in used_lc]
 
         return amis
 
@@ -66,9 +202,8 @@ class Fetcher(object):
         to autoscaling groups
         """
 
-        resp = self.asg.describe_auto_scaling_groups()
         used_lt = (asg.get("LaunchTemplate", {}).get("LaunchTemplateName")
-                   for asg in resp.get("AutoScalingGroups", []))
+                   for asg in self.fetch_auto_scaling_groups())
 
         resp = self.ec2.describe_launch_templates()
         all_lts = (lt.get("LaunchTemplateName", "")
@@ -92,17 +227,10 @@ class Fetcher(object):
         Find AMIs for autoscaling groups who's desired capacity is set to 0
         """
 
-        resp = self.asg.describe_auto_scaling_groups()
-        zeroed_lcs = [asg.get("LaunchConfigurationName", "")
-                      for asg in resp.get("AutoScalingGroups", [])
-                      if asg.get("DesiredCapacity", 0) == 0 and len(asg.get("LaunchConfigurationNames", [])) > 0]
-
-        resp = self.asg.describe_launch_configurations(
-            LaunchConfigurationNames=zeroed_lcs
-        )
-
-        amis = [lc.get("ImageId", "")
-                for lc in resp.get("LaunchConfigurations", [])]
+        launch_configurations = self.fetch_launch_configurations()
+        amis = [launch_configurations.get(asg["LaunchConfigurationName"], "")
+                for asg in self.fetch_auto_scaling_groups()
+                if asg.get("DesiredCapacity", 0) == 0 and asg.get("LaunchConfigurationName")]
 
         return amis
 
@@ -112,10 +240,9 @@ class Fetcher(object):
         Find AMIs for autoscaling groups who's desired capacity is set to 0
         """
 
-        resp = self.asg.describe_auto_scaling_groups()
         # This does not support multiple versions of the same launch template being used
         zeroed_lts = [asg.get("LaunchTemplate", {})
-                      for asg in resp.get("AutoScalingGroups", [])
+                      for asg in self.fetch_auto_scaling_groups()
                       if asg.get("DesiredCapacity", 0) == 0 and "LaunchTemplate" in asg]
         zeroed_lt_names = [lt.get("LaunchTemplateName", "")
                         for lt in zeroed_lts]
@@ -176,26 +303,101 @@ class Fetcher(object):
 
         return ami_ids
 
+    def is_shared(self, ami_id):
+
+        """
+        True if the AMI has launch permissions for other accounts, groups
+        or organizations (public included). An AMI that could not be
+        checked is considered shared, and not cached.
+        """
+
+        try:
+            resp = self.ec2.describe_image_attribute(ImageId=ami_id, Attribute='launchPermission')
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidAMIID.NotFound':
+                shared = False
+            else:
+                return True
+        else:
+            shared = bool(resp.get("LaunchPermissions"))
+        self._shared[ami_id] = (time.time(), shared)
+        return shared
+
+    def fetch_shared_amis(self, ami_ids, workers=SHARED_CHECK_WORKERS):
+
+        """
+        Ids of the shared AMIs among ami_ids (the candidates, the call
+        is per AMI), checked concurrently by workers threads. Results are
+        cached per AMI id for SHARED_CHECK_TTL seconds.
+        """
+
+        cutoff = time.time() - SHARED_CHECK_TTL
+        shared = set()
+        unchecked = []
+        for ami_id in ami_ids:
+            cached = self._shared.get(ami_id)
+            if cached is None or cached[0] < cutoff:
+                unchecked.append(ami_id)
+            elif cached[1]:
+                shared.add(ami_id)
+
+        if len(unchecked) > 1 and workers > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(unchecked))) as executor:
+                checks = list(executor.map(self.is_shared, unchecked))
+        else:
+            checks = [self.is_shared(ami_id) for ami_id in unchecked]
+
+        shared.update(ami_id for ami_id, is_shared in zip(unchecked, checks) if is_shared)
+        return shared
+
+    def fetch_instance_records(self):
+
+        """
+        Not terminated EC2 instances as AWSEC2Instance, fetched page by page
+        once until invalidate is called, indexed by image id in instance_index
+        """
+
+        if self._instances is None:
+            paginator = self.ec2.get_paginator('describe_instances')
+            pages = paginator.paginate(
+                Filters=[
+                    {
+                        'Name': 'instance-state-name',
+                        'Values': [
+                            'pending',
+                            'running',
+                            'shutting-down',
+                            'stopping',
+                            'stopped'
+                        ]
+                    }
+                ]
+            )
+            self._instances = [AWSEC2Instance.object_with_json(i, self.strings)
+                               for page in pages
+                               for r in page.get("Reservations", [])
+                               for i in r.get("Instances", [])]
+            self.instance_index = InstanceIndex.from_instances(self._instances)
+
+        return self._instances
+
+    def fetch_instance(self, instance_id):
+
+        """ one instance as an AWSEC2Instance, None if it is unknown """
+
+        try:
+            resp = self.ec2.describe_instances(InstanceIds=[instance_id])
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "InvalidInstanceID.NotFound":
+                return None
+            raise
+        for r in resp.get("Reservations", []):
+            for i in r.get("Instances", []):
+                return AWSEC2Instance.object_with_json(i, self.strings)
+        return None
+
     def fetch_instances(self):
 
         """ Find AMIs for not terminated EC2 instances """
 
-        resp = self.ec2.describe_instances(
-            Filters=[
-                {
-                    'Name': 'instance-state-name',
-                    'Values': [
-                        'pending',
-                        'running',
-                        'shutting-down',
-                        'stopping',
-                        'stopped'
-                    ]
-                }
-            ]
-        )
-        amis = [i.get("ImageId", None)
-                for r in resp.get("Reservations", [])
-                for i in r.get("Instances", [])]
-
-        return amis
+        return [instance.image_id for instance in self.fetch_instance_records()]
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+import json
+import os
+import time
+
+DAY = 86400
+
+
+class UsageHistoryError(ValueError):
+    pass
+
+
+class UsageHistory(object):
+
+    """
+    Local history of the AMIs seen in use, kept across runs in a json file.
+    For each AMI id it stores the last time it was seen and a bitmap of the
+    days it was seen on (bit n : n days before the current day), so "used
+    in the last N days" is a dict lookup.
+
+    {"version": 1, "day": 17000, "amis": {"ami-0123": [1468800000, 5]}}
+    """
+
+    VERSION = 1
+
+    # number of days of the bitmap
+    DAYS = 64
+
+    def __init__(self, path=None):
+        self.path = path
+        self.day = None
+        self.amis = dict()
+
+    @staticmethod
+    def load(path):
+
+        """
+        reads the history file, a missing file is an empty history. Raises
+        UsageHistoryError when the file is not a usage history.
+        """
+
+        history = UsageHistory(path)
+        if path and os.path.exists(path):
+            try:
+                with open(path) as history_file:
+                    document = json.load(history_file)
+            except ValueError as e:
+                raise UsageHistoryError("invalid usage history {0} : {1}".format(path, e))
+            if not isinstance(document, dict) or document.get("version") != UsageHistory.VERSION:
+                raise UsageHistoryError("unsupported usage history version in {0}".format(path))
+            try:
+                history.day = document.get("day")
+                history.amis = dict((ami_id, [int(sample[0]), int(sample[1])])
+                                    for ami_id, sample in document["amis"].items())
+            except (KeyError, TypeError, ValueError, IndexError, AttributeError):
+                raise UsageHistoryError("invalid usage history {0}".format(path))
+        return history
+
+    def save(self, path=None):
+        path = path or self.path
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as history_file:
+            json.dump({"version": self.VERSION, "day": self.day, "amis": self.amis},
+                      history_file, separators=(",", ":"))
+        os.replace(temp_path, path)
+
+    def _advance(self, day):
+
+        """ moves the bitmaps so bit 0 is day """
+
+        if self.day is None:
+            self.day = day
+            return
+        shift = day - self.day
+        if shift <= 0:
+            return
+        mask = (1 << self.DAYS) - 1
+        for sample in self.amis.values():
+            sample[1] = (sample[1] << shift) & mask
+        self.day = day
+
+    def record(self, ami_ids, when=None):
+
+        """ records ami_ids as used at when (now by default) """
+
+        when = int(when if when is not None else time.time())
+        day = when // DAY
+        self._advance(day)
+        bit = 1 << (self.day - day) if self.day - day < self.DAYS else 0
+
+        for ami_id in ami_ids:
+            if not ami_id:
+                continue
+            sample = self.amis.get(ami_id)
+            if sample is None:
+                self.amis[ami_id] = [when, bit]
+            else:
+                sample[0] = max(sample[0], when)
+                sample[1] |= bit
+
+    def last_used(self, ami_id):
+        sample = self.amis.get(ami_id)
+        return sample[0] if sample else None
+
+    def used_within(self, ami_id, days, now=None):
+
+        """ True if ami_id was seen in use during the last days """
+
+        sample = self.amis.get(ami_id)
+        if sample is None:
+            return False
+        now = now if now is not None else time.time()
+        return now - sample[0] < days * DAY
+
+    def days_used(self, ami_id):
+
+        """ number of days the AMI was seen in use, over the last DAYS days """
+
+        sample = self.amis.get(ami_id)
+        return bin(sample[1]).count("1") if sample else 0
+
+    def recently_used(self, days, now=None):
+
+        """ ids of the AMIs used during the last days """
+
+        cutoff = (now if now is not None else time.time()) - days * DAY
+        return set(ami_id for ami_id, sample in self.amis.items() if sample[0] > cutoff)
+
+    def prune(self, max_days, now=None):
+
+        """ forgets AMIs not used for max_days, returns how many """
+
+        cutoff = (now if now is not None else time.time()) - max_days * DAY
+        stale = [ami_id for ami_id, sample in self.amis.items() if sample[0] <= cutoff]
+        for ami_id in stale:
+            del self.amis[ami_id]
+        return len(stale)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+from builtins import range
+from array import array
+from collections import Counter
+import mmap
+import os
+import shutil
+import struct
+
+from .resources.config import PENDING_DELETE_TAG
+from .resources.models import AMI
+
+MAGIC = b"AMIINV01"
+
+# ids and creation dates are stored in fixed width ascii columns
+ID_WIDTH = 24
+DATE_WIDTH = 24
+
+NO_STRING = 0xFFFFFFFF
+
+# magic, AMIs count, strings count, then the offset of each section
+SECTIONS = ("ids", "dates", "names", "tag_offsets", "tags", "device_offsets", "devices",
+            "string_offsets", "strings")
+HEADER = struct.Struct("<8sII" + "Q" * len(SECTIONS))
+
+# device name, snapshot id, volume type (string codes) and volume size
+DEVICE_FIELDS = 4
+
+
+def _fixed(value, width):
+    encoded = (value or "").encode("ascii")
+    if len(encoded) > width:
+        raise ValueError("{0} does not fit in {1} bytes".format(value, width))
+    return encoded.ljust(width, b"\0")
+
+
+class InventoryWriter(object):
+
+    """
+    Writes describe_images payloads to a compact inventory file as they
+    are fetched. Strings (names, tag keys and values, snapshot ids...) are
+    interned once in a string table, AMIs only store their codes. Each
+    section is appended to its own spill file next to path as AMIs are
+    added, close concatenates them, so only the distinct strings are kept
+    in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.string_codes = dict()
+        self.strings_size = 0
+        self.tags_count = 0
+        self.devices_count = 0
+        self.spills = dict((name, open("{0}.{1}.tmp".format(path, name), "w+b")) for name in SECTIONS)
+        for name in ("tag_offsets", "device_offsets", "string_offsets"):
+            self.spills[name].write(array('I', [0]).tobytes())
+
+    def intern(self, value):
+        if value is None:
+            return NO_STRING
+        code = self.string_codes.get(value)
+        if code is None:
+            code = self.string_codes[value] = len(self.string_codes)
+            encoded = value.encode("utf-8")
+            self.strings_size += len(encoded)
+            self.spills["strings"].write(encoded)
+            self.spills["string_offsets"].write(array('I', [self.strings_size]).tobytes())
+        return code
+
+    def add(self, image_json):
+        intern = self.intern
+        spills = self.spills
+        spills["ids"].write(_fixed(image_json.get('ImageId'), ID_WIDTH))
+        spills["dates"].write(_fixed(image_json.get('CreationDate'), DATE_WIDTH))
+        spills["names"].write(array('I', [intern(image_json.get('Name'))]).tobytes())
+
+        tags = array('I')
+        for tag in image_json.get('Tags') or []:
+            tags.append(intern(tag.get('Key')))
+            tags.append(intern(tag.get('Value')))
+        spills["tags"].write(tags.tobytes())
+        self.tags_count += len(tags) // 2
+        spills["tag_offsets"].write(array('I', [self.tags_count]).tobytes())
+
+        devices = array('I')
+        for block_device in image_json.get('BlockDeviceMappings') or []:
+            ebs = block_device.get('Ebs') or {}
+            devices.extend([
+                intern(block_device.get('DeviceName')),
+                intern(ebs.get('SnapshotId')),
+                intern(ebs.get('VolumeType')),
+                ebs.get('VolumeSize') or 0,
+            ])
+        spills["devices"].write(devices.tobytes())
+        self.devices_count += len(devices) // DEVICE_FIELDS
+        spills["device_offsets"].write(array('I', [self.devices_count]).tobytes())
+
+        self.count += 1
+
+    def close(self):
+        sizes = []
+        for name in SECTIONS:
+            self.spills[name].flush()
+            sizes.append(self.spills[name].tell())
+
+        # sections start on 8 bytes boundaries
+        offsets = []
+        position = HEADER.size
+        for size in sizes:
+            position += -position % 8
+            offsets.append(position)
+            position += size
+
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "wb") as inventory_file:
+                inventory_file.write(HEADER.pack(MAGIC, self.count, len(self.string_codes), *offsets))
+                for offset, name in zip(offsets, SECTIONS):
+                    inventory_file.write(b"\0" * (offset - inventory_file.tell()))
+                    spill = self.spills[name]
+                    spill.seek(0)
+                    shutil.copyfileobj(spill, inventory_file)
+            os.replace(temp_path, self.path)
+        finally:
+            self.discard()
+
+    def discard(self):
+
+        """ removes the spill files """
+
+        for spill in self.spills.values():
+            spill.close()
+            if os.path.exists(spill.name):
+                os.remove(spill.name)
+
+
+class Inventory(object):
+
+    """
+    Read only view of an inventory file through mmap. AMIs are rows, their
+    fields are decoded on access, map_rows groups rows on their string
+    codes and AMIs are only built (ami) for the rows that need one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+
+        header = HEADER.unpack_from(self._map)
+        if header[0] != MAGIC:
+            self.close()
+            raise ValueError("{0} is not an amicleaner inventory".format(path))
+        self.count, strings_count = header[1], header[2]
+        offsets = dict(zip(SECTIONS, header[3:]))
+
+        def section(name, size):
+            return view[offsets[name]:offsets[name] + size]
+
+        count = self.count
+        self._ids = section("ids", count * ID_WIDTH)
+        self._dates = section("dates", count * DATE_WIDTH)
+        self._names = section("names", count * 4).cast('I')
+        self._tag_offsets = section("tag_offsets", (count + 1) * 4).cast('I')
+        self._tags = section("tags", self._tag_offsets[count] * 8).cast('I')
+        self._device_offsets = section("device_offsets", (count + 1) * 4).cast('I')
+        self._devices = section("devices", self._device_offsets[count] * DEVICE_FIELDS * 4).cast('I')
+        self._string_offsets = section("string_offsets", (strings_count + 1) * 4).cast('I')
+        self._strings = view[offsets["strings"]:]
+        self._string_cache = dict()
+
+    @staticmethod
+    def open(path):
+        return Inventory(path)
+
+    def close(self):
+        for attribute in ("_ids", "_dates", "_names", "_tag_offsets", "_tags", "_device_offsets",
+                          "_devices", "_string_offsets", "_strings"):
+            view = self.__dict__.pop(attribute, None)
+            if view is not None:
+                view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def string(self, code):
+
+        """ string of a code, decoded once """
+
+        if code == NO_STRING:
+            return None
+        value = self._string_cache.get(code)
+        if value is None:
+            value = bytes(self._strings[self._string_offsets[code]:self._string_offsets[code + 1]]).decode("utf-8")
+            self._string_cache[code] = value
+        return value
+
+    def id(self, row):
+        return bytes(self._ids[row * ID_WIDTH:(row + 1) * ID_WIDTH]).rstrip(b"\0").decode("ascii")
+
+    def creation_date(self, row):
+        return bytes(self._dates[row * DATE_WIDTH:(row + 1) * DATE_WIDTH]).rstrip(b"\0").decode("ascii") or None
+
+    def name(self, row):
+        return self.string(self._names[row])
+
+    def tag_codes(self, row):
+
+        """ (key code, value code) pairs of the tags of row, flattened """
+
+        return tuple(self._tags[self._tag_offsets[row] * 2:self._tag_offsets[row + 1] * 2])
+
+    def tags(self, row):
+        codes = self.tag_codes(row)
+        return [(self.string(codes[i]), self.string(codes[i + 1])) for i in range(0, len(codes), 2)]
+
+    def rows(self, excluded_ids=None):
+
+        """ rows whose AMI id is not in excluded_ids """
+
+        if not excluded_ids:
+            return list(range(self.count))
+        excluded = set(_fixed(ami_id, ID_WIDTH) for ami_id in excluded_ids)
+        ids = self._ids
+        return [row for row in range(self.count)
+                if bytes(ids[row * ID_WIDTH:(row + 1) * ID_WIDTH]) not in excluded]
+
+    def snapshot_index(self):
+
+        """
+        SnapshotIndex of the AMIs sharing a snapshot with another AMI, read
+        from the devices column. The snapshots of a single AMI are left out,
+        SnapshotIndex.release frees the snapshots it does not know.
+        """
+
+        from .core import SnapshotIndex
+
+        devices = self._devices
+        offsets = self._device_offsets
+        snapshot_codes = devices[1::DEVICE_FIELDS]
+        references = Counter(snapshot_codes)
+        references.pop(NO_STRING, None)
+        shared = set(code for code, count in references.items() if count > 1)
+
+        index = SnapshotIndex()
+        if not shared:
+            return index
+        for row in range(self.count):
+            codes = snapshot_codes[offsets[row]:offsets[row + 1]]
+            if any(code in shared for code in codes):
+                index.add(self.id(row), [self.string(code) for code in codes])
+        return index
+
+    def ami(self, row, region=None):
+
+        """ AMI of row, built from the stored fields """
+
+        block_devices = []
+        devices = self._devices
+        for i in range(self._device_offsets[row], self._device_offsets[row + 1]):
+            name, snapshot, volume_type, size = devices[i * DEVICE_FIELDS:(i + 1) * DEVICE_FIELDS]
+            block_devices.append({
+                'DeviceName': self.string(name),
+                'Ebs': {'SnapshotId': self.string(snapshot), 'VolumeType': self.string(volume_type),
+                        'VolumeSize': size},
+            })
+
+        return AMI.object_with_json({
+            'ImageId': self.id(row),
+            'Name': self.name(row),
+            'CreationDate': self.creation_date(row),
+            'State': 'available',
+            'Tags': [{'Key': key, 'Value': value} for key, value in self.tags(row)],
+            'BlockDeviceMappings': block_devices,
+        }, region)
+
+    def map_rows(self, rows, mapping_strategy):
+
+        """
+        AMICleaner.map_candidates over rows : {group name: [rows]}. Tags
+        are compared as string codes, a group name is built once for each
+        distinct set of tags.
+        """
+
+        key = mapping_strategy.get("key")
+        values = mapping_strategy.get("values") or []
+        mapped = dict()
+
+        if key == "name":
+            for row in rows:
+                name = self.name(row) or ""
+                for value in values:
+                    if value in name:
+                        mapped.setdefault(value, []).append(row)
+            return mapped
+
+        if key != "tags":
+            return {"": list(rows)}
+
+        filters = set(values)
+        excluded = set(mapping_strategy.get("excluded") or [])
+        exclude_all = "<all values>" in excluded
+
+        groups_by_codes = dict()
+        for row in rows:
+            codes = self.tag_codes(row)
+            group = groups_by_codes.get(codes)
+            if group is None:
+                tag_values = [value for tag_key, value in self.tags(row)
+                              if (tag_key in filters if filters else tag_key != PENDING_DELETE_TAG)]
+                group = ".".join(sorted(tag_values))
+                if exclude_all:
+                    group = "" if group else "<no tag>"
+                elif excluded.intersection(tag_values):
+                    group = ""
+                groups_by_codes[codes] = group
+            mapped.setdefault(group, []).append(row)
+
+        return mapped
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+
+from .resources.config import LINEAGE_TAG
+
+
+def source_of(region, ami):
+
+    """
+    (region, AMI id) the AMI was copied from, read from the SourceImageId /
+    SourceImageRegion fields of describe_images or from the LINEAGE_TAG
+    tag ("ami-id" or "region/ami-id"), None for an original AMI
+    """
+
+    if ami.source_image_id:
+        return ami.source_image_region or region, ami.source_image_id
+
+    for tag in ami.tags:
+        if tag.key == LINEAGE_TAG and tag.value:
+            if "/" in tag.value:
+                source_region, source_id = tag.value.split("/", 1)
+                return source_region, source_id
+            return region, tag.value
+
+    return None
+
+
+class LineageGraph(object):
+
+    """
+    AMIs of several regions linked to the AMIs they were copied from. A
+    lineage is the set of AMIs sharing the same original AMI (which may no
+    longer exist), tracked with a union find over (region, AMI id) keys
+    and built in one pass over the inventories.
+    """
+
+    def __init__(self):
+        self.parent = dict()
+        self.amis = dict()
+        self._members = None
+
+    def find(self, key):
+        parent = self.parent
+        if key not in parent:
+            return key
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    def union(self, key, other):
+        self.parent.setdefault(key, key)
+        self.parent.setdefault(other, other)
+        root, other_root = self.find(key), self.find(other)
+        if root != other_root:
+            self.parent[other_root] = root
+        self._members = None
+
+    def add(self, region, ami):
+        key = (region, ami.id)
+        self.amis[key] = ami
+        self.parent.setdefault(key, key)
+        source = source_of(region, ami)
+        if source is not None:
+            self.union(source, key)
+        self._members = None
+
+    @staticmethod
+    def from_inventories(inventories):
+
+        """ builds the graph of {region: {AMI id: AMI}} inventories """
+
+        graph = LineageGraph()
+        for region, amis in inventories.items():
+            for ami in amis.values():
+                graph.add(region, ami)
+        return graph
+
+    def lineage(self, region, ami_id):
+
+        """ key identifying the lineage of an AMI """
+
+        return self.find((region, ami_id))
+
+    def members(self):
+
+        """ lineage key: [(region, AMI)] of the existing AMIs of each lineage """
+
+        if self._members is None:
+            members = dict()
+            for key, ami in self.amis.items():
+                members.setdefault(self.find(key), []).append((key[0], ami))
+            self._members = members
+        return self._members
+
+    def lineage_amis(self, region, ami_id):
+        return self.members().get(self.lineage(region, ami_id), [])
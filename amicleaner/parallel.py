@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import range
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from .columnar import AMIColumns
+
+# shards per process, so a few large groups do not leave processes idle
+SHARDS_PER_PROCESS = 4
+
+
+def reduce_dates(dates, keep_previous=0, ami_min_days=-1, now=None):
+
+    """
+    AMICleaner.reduce_candidates applied to the creation dates of a group.
+    Returns the positions of the reduced, kept by keep previous and kept by
+    min days AMIs, in the order reduce_candidates lists them.
+    """
+
+    positions = list(range(len(dates)))
+    kept_min_days = []
+
+    if ami_min_days > 0 and dates:
+        # AWS dates compare as strings, no need to parse each of them
+        cutoff = AMIColumns.min_days_cutoff(dates[0], ami_min_days, now)
+        remaining = []
+        for i in positions:
+            if dates[i] > cutoff:
+                kept_min_days.append(i)
+            else:
+                remaining.append(i)
+        positions = remaining
+
+    if not keep_previous or not positions:
+        return positions, [], kept_min_days
+
+    positions = sorted(positions, key=dates.__getitem__, reverse=True)
+    return positions[keep_previous:], positions[:keep_previous], kept_min_days
+
+
+def _reduce_shard(shard, keep_previous, ami_min_days, now):
+    return [(code,) + reduce_dates(dates, keep_previous, ami_min_days, now) for code, dates in shard]
+
+
+def shard_groups(sizes, count):
+
+    """
+    Splits group codes into count shards of similar total size, the
+    largest groups are placed first in the lightest shard
+    """
+
+    shards = [[] for _ in range(count)]
+    loads = [0] * count
+    for code in sorted(range(len(sizes)), key=lambda c: -sizes[c]):
+        lightest = loads.index(min(loads))
+        shards[lightest].append(code)
+        loads[lightest] += sizes[code]
+    return [shard for shard in shards if shard]
+
+
+def reduce_groups(mapped_amis, keep_previous=0, ami_min_days=-1, processes=2):
+
+    """
+    Reduces every group of mapped_amis (AMICleaner.map_candidates output)
+    on a pool of processes. Only (group code, creation dates) are sent to
+    the workers, the results are merged back in the mapped_amis order.
+    Returns (group name, reduced, keep previous, keep min days) tuples,
+    the unnamed group is returned as reduced.
+    """
+
+    names = list(mapped_amis)
+    groups = [mapped_amis[name] for name in names]
+    codes = [code for code, name in enumerate(names) if name]
+    now = datetime.now()
+
+    reductions = [None] * len(names)
+    for code, name in enumerate(names):
+        if not name:
+            reductions[code] = (name, groups[code], [], [])
+
+    shards = shard_groups([len(groups[code]) for code in codes], processes * SHARDS_PER_PROCESS)
+    payloads = [
+        [(codes[i], [ami.creation_date for ami in groups[codes[i]]]) for i in shard]
+        for shard in shards
+    ]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_reduce_shard, payload, keep_previous, ami_min_days, now)
+                   for payload in payloads]
+        for future in futures:
+            for code, reduced, kept_previous, kept_min_days in future.result():
+                amis = groups[code]
+                reductions[code] = (
+                    names[code],
+                    [amis[i] for i in reduced],
+                    [amis[i] for i in kept_previous],
+                    [amis[i] for i in kept_min_days],
+                )
+
+    return reductions
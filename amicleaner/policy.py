@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+import json
+import re
+
+from .columnar import AMIColumns
+from .resources.models import PlanResult
+from .resources.config import KEEP_PREVIOUS, AMI_MIN_DAYS, PENDING_DELETE_TAG
+
+
+class PolicyError(ValueError):
+    pass
+
+
+class GroupRule(object):
+
+    """
+    One group of a policy. AMIs are grouped either on tags values
+    (key: tags) or on their name (key: name), with substrings (values)
+    or regular expressions (patterns).
+    """
+
+    def __init__(self, rule, defaults):
+        self.key = rule.get("key", "tags")
+        self.label = rule.get("name")
+        self.values = list(rule.get("values") or [])
+        self.patterns = [re.compile(p) for p in rule.get("patterns") or []]
+        self.excluded = set(rule.get("excluded") or [])
+        self.keep_previous = rule.get("keep_previous", defaults.get("keep_previous", KEEP_PREVIOUS))
+        self.min_days = rule.get("min_days", defaults.get("min_days", AMI_MIN_DAYS))
+
+        if self.key not in ("tags", "name"):
+            raise PolicyError("unknown group key '{0}', expected tags or name".format(self.key))
+        if self.key == "name" and not (self.values or self.patterns):
+            raise PolicyError("name groups need values or patterns")
+
+    def group_name(self, ami):
+
+        """
+        Returns the group of an AMI, "" when the AMI is excluded by the
+        rule, None when the rule does not apply to it
+        """
+
+        if self.key == "tags":
+            tag_values = [tag.value for tag in ami.tags
+                          if (tag.key in self.values if self.values else tag.key != PENDING_DELETE_TAG)]
+            if not tag_values:
+                return None
+            if self.excluded.intersection(tag_values):
+                return ""
+            name = ".".join(sorted(tag_values))
+        else:
+            ami_name = ami.name or ""
+            name = next((v for v in self.values if v in ami_name), None)
+            if name is None:
+                name = next((p.pattern for p in self.patterns if p.search(ami_name)), None)
+            if name is None:
+                return None
+
+        if self.label:
+            return "{0}:{1}".format(self.label, name) if name else self.label
+        return name
+
+
+class Policy(object):
+
+    """
+    Declarative retention policy (json or yaml file) :
+
+    protect:
+      ami_ids: [ami-0123456789abcdef0]
+      tags: {retention: forever}
+      name_patterns: ["^golden-"]
+    defaults:
+      keep_previous: 4
+      min_days: 7
+    groups:
+      - {name: web, key: tags, values: [environment, role], excluded: [prod], keep_previous: 2}
+      - {key: name, patterns: ["^ubuntu-\\d+"], keep_previous: 1}
+
+    The first group matching an AMI wins. Evaluation visits each AMI once.
+    """
+
+    def __init__(self, document):
+        if not isinstance(document, dict):
+            raise PolicyError("a policy must be a mapping")
+
+        protect = document.get("protect") or {}
+        defaults = document.get("defaults") or {}
+        self.protected_ids = set(protect.get("ami_ids") or [])
+        self.protected_tags = set((protect.get("tags") or {}).items())
+        self.protected_names = [re.compile(p) for p in protect.get("name_patterns") or []]
+        self.groups = [GroupRule(rule, defaults) for rule in document.get("groups") or []]
+
+        if not self.groups:
+            raise PolicyError("a policy needs at least one group")
+
+    @staticmethod
+    def load(path):
+
+        """ reads a json policy, or a yaml one if PyYAML is installed """
+
+        with open(path) as policy_file:
+            content = policy_file.read()
+
+        if path.endswith((".yml", ".yaml")):
+            try:
+                import yaml
+            except ImportError:
+                raise PolicyError("PyYAML is required to read yaml policies")
+            try:
+                document = yaml.safe_load(content)
+            except yaml.YAMLError as e:
+                raise PolicyError("invalid policy {0} : {1}".format(path, e))
+        else:
+            try:
+                document = json.loads(content)
+            except ValueError as e:
+                raise PolicyError("invalid policy {0} : {1}".format(path, e))
+
+        return Policy(document)
+
+    def is_protected(self, ami):
+        if ami.id in self.protected_ids:
+            return True
+        if self.protected_tags and not self.protected_tags.isdisjoint((t.key, t.value) for t in ami.tags):
+            return True
+        if self.protected_names:
+            ami_name = ami.name or ""
+            return any(p.search(ami_name) for p in self.protected_names)
+        return False
+
+    def plan(self, amis):
+
+        """
+        Yields a PlanResult for every AMI, protected and excluded ones
+        first, then each group from its newest AMI to its oldest
+        """
+
+        groups = dict()
+        cutoffs = dict()
+
+        for ami in amis:
+            if self.is_protected(ami):
+                yield PlanResult(ami, "", PlanResult.KEPT_BY_PROTECTION)
+                continue
+
+            for rule in self.groups:
+                group_name = rule.group_name(ami)
+                if group_name is not None:
+                    break
+            else:
+                group_name = ""
+
+            if not group_name:
+                yield PlanResult(ami, "", PlanResult.KEPT_BY_MAPPING)
+                continue
+
+            if rule.min_days > 0 and ami.creation_date is not None:
+                if rule.min_days not in cutoffs:
+                    cutoffs[rule.min_days] = AMIColumns.min_days_cutoff(ami.creation_date, rule.min_days)
+                if ami.creation_date > cutoffs[rule.min_days]:
+                    yield PlanResult(ami, group_name, PlanResult.KEPT_BY_MIN_DAYS)
+                    continue
+
+            groups.setdefault(group_name, (rule, []))[1].append(ami)
+
+        for group_name, (rule, group_amis) in groups.items():
+            group_amis = sorted(group_amis, key=lambda a: a.creation_date, reverse=True)
+            for position, ami in enumerate(group_amis):
+                yield PlanResult(ami, group_name,
+                                 PlanResult.KEPT_BY_KEEP_PREVIOUS if position < rule.keep_previous else None)
+
+    def evaluate(self, amis):
+
+        """
+        Returns the AMIs to remove and a report in the format of
+        App.prepare_candidates
+        """
+
+        results = list(self.plan(amis))
+        return [r.ami for r in results if r.removed], PlanResult.report(results)
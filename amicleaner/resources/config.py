@@ -3,10 +3,23 @@
 
 # set your aws env vars to production
 
-from blessings import Terminal
+
+class LazyTerminal(object):
+
+    """ blessings Terminal only imported and created on first use """
+
+    def __init__(self):
+        self.terminal = None
+
+    def __getattr__(self, name):
+        if self.terminal is None:
+            from blessings import Terminal
+            self.terminal = Terminal()
+        return getattr(self.terminal, name)
+
 
 # terminal colors
-TERM = Terminal()
+TERM = LazyTerminal()
 
 # Number of previous amis to keep based on grouping strategy
 # not including the ami currently running by an ec2 instance
@@ -36,3 +49,51 @@ AMI_MIN_DAYS = -1
 BOTO3_RETRIES = 10
 
 AWS_REGION = 'us-west-2'
+
+# Seconds to wait between two cleaning cycles in daemon mode
+DAEMON_INTERVAL = 3600
+
+# Local port serving Prometheus metrics in daemon mode
+METRICS_PORT = 9180
+METRICS_ADDRESS = '127.0.0.1'
+
+# Tag marking AMIs to be removed by a later sweep run, its value is the
+# marking date. create_tags accepts up to 1000 resources per call
+PENDING_DELETE_TAG = 'amicleaner:pending-delete'
+CREATE_TAGS_BATCH = 1000
+
+# Number of AMIs removed in parallel, one at a time unless --workers asks
+# for more
+DELETE_WORKERS = 1
+
+# Tag of AMI copies naming their source AMI ("ami-id" or "region/ami-id"),
+# for the copies without SourceImageId
+LINEAGE_TAG = 'amicleaner:source-ami'
+
+# Launch permissions checks of the candidate AMIs (--keep-shared): number
+# of concurrent calls, and seconds a result is reused
+SHARED_CHECK_WORKERS = 16
+SHARED_CHECK_TTL = 3600
+
+# Local work queue (--queue): items claimed at once by a consumer process,
+# seconds between two progress reports, and seconds after which the items
+# left by an interrupted run are expired
+QUEUE_CLAIM_BATCH = 20
+QUEUE_POLL_INTERVAL = 1.0
+QUEUE_BATCH_TTL = 24 * 3600
+
+# Width of the names and tags columns of the reports, longer values are cut
+REPORT_CELL_WIDTH = 80
+
+# Checks of the removals (--verify): ids described in one call, concurrent
+# calls, checks of an id still visible, and seconds before its second check
+# (doubled at each new check)
+VERIFY_BATCH = 200
+VERIFY_WORKERS = 4
+VERIFY_ATTEMPTS = 5
+VERIFY_DELAY = 1.0
+
+# Watch mode (--watch): seconds without event before the queued AMIs are
+# removed, and number of queued AMIs removed without waiting
+WATCH_POLL_INTERVAL = 1.0
+WATCH_BATCH = 50
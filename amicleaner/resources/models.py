@@ -4,25 +4,169 @@
 
 from builtins import str
 from builtins import object
+from collections import namedtuple
 
 
-class AMI(object):
-    def __init__(self):
-        self.id = None
-        self.architecture = None
-        self.block_device_mappings = []
-        self.creation_date = None
-        self.hypervisor = None
-        self.image_type = None
-        self.location = None
+class JsonField(object):
+
+    """
+    Model attribute read from the raw json payload on first access,
+    assigning it overrides the payload value
+    """
+
+    def __init__(self, key, parser=None):
+        self.key = key
+        self.parser = parser
         self.name = None
-        self.owner_id = None
-        self.public = None
-        self.root_device_name = None
-        self.root_device_type = None
-        self.state = None
-        self.tags = []
-        self.virtualization_type = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        try:
+            return instance.__dict__[self.name]
+        except KeyError:
+            pass
+
+        json = instance.__dict__.get('json') or {}
+        if self.parser is not None:
+            value = self.parser(json.get(self.key) or [])
+        else:
+            value = json.get(self.key)
+        instance.__dict__[self.name] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
+class InternTable(object):
+
+    """
+    Strings repeated across an inventory (tag keys and values, states,
+    volume types...) kept once. A fetcher owns one table and, after each
+    inventory, only retains the strings its AMIs still use, so the values
+    of removed AMIs do not pile up and reused AMIs keep sharing theirs.
+    """
+
+    # describe_images fields with a small set of values
+    IMAGE_FIELDS = ('Architecture', 'Hypervisor', 'ImageType', 'OwnerId', 'PlatformDetails',
+                    'RootDeviceName', 'RootDeviceType', 'State', 'UsageOperation', 'VirtualizationType')
+
+    def __init__(self):
+        self.strings = dict()
+
+    def clear(self):
+        self.strings.clear()
+
+    def intern(self, value):
+        if not isinstance(value, str):
+            return value
+        return self.strings.setdefault(value, value)
+
+    def retain(self, image_jsons):
+
+        """ drops the strings that none of the (interned) payloads image_jsons uses """
+
+        strings = self.strings
+        kept = dict()
+        for image_json in image_jsons:
+            for value in self.image_strings(image_json):
+                if isinstance(value, str) and strings.get(value) is value:
+                    kept[value] = value
+        self.strings = kept
+
+    @staticmethod
+    def image_strings(image_json):
+
+        """ values of a describe_images payload which are interned """
+
+        for field in InternTable.IMAGE_FIELDS:
+            if field in image_json:
+                yield image_json[field]
+        for tag_json in image_json.get('Tags') or []:
+            for value in tag_json.values():
+                yield value
+        for block_device in image_json.get('BlockDeviceMappings') or []:
+            yield block_device.get('DeviceName')
+            yield (block_device.get('Ebs') or {}).get('VolumeType')
+
+    def intern_image(self, image_json):
+
+        """
+        Copy of a describe_images payload whose repeated values are
+        replaced with their shared copies, the payload is left unchanged
+        """
+
+        intern = self.intern
+        image_json = dict(image_json)
+        for field in self.IMAGE_FIELDS:
+            if field in image_json:
+                image_json[field] = intern(image_json[field])
+
+        if image_json.get('Tags'):
+            image_json['Tags'] = [dict((k, intern(v)) for k, v in tag_json.items())
+                                  for tag_json in image_json['Tags']]
+
+        if image_json.get('BlockDeviceMappings'):
+            block_devices = []
+            for block_device in image_json['BlockDeviceMappings']:
+                block_device = dict(block_device)
+                if 'DeviceName' in block_device:
+                    block_device['DeviceName'] = intern(block_device['DeviceName'])
+                ebs = block_device.get('Ebs')
+                if ebs and 'VolumeType' in ebs:
+                    block_device['Ebs'] = dict(ebs, VolumeType=intern(ebs['VolumeType']))
+                block_devices.append(block_device)
+            image_json['BlockDeviceMappings'] = block_devices
+
+        return image_json
+
+
+def _parse_tags(tags_json):
+    return [AWSTag.object_with_json(tag) for tag in tags_json]
+
+
+def _parse_block_devices(block_devices_json):
+    ebs_snapshots = [
+        AWSBlockDevice.object_with_json(block_device) for block_device
+        in block_devices_json
+    ]
+    return [f for f in ebs_snapshots if f]
+
+
+class AMI(object):
+
+    """
+    AMI built from a describe_images payload. Fields, tags and block
+    devices are only parsed when first accessed.
+    """
+
+    id = JsonField('ImageId')
+    architecture = JsonField('Architecture')
+    block_device_mappings = JsonField('BlockDeviceMappings', _parse_block_devices)
+    creation_date = JsonField('CreationDate')
+    hypervisor = JsonField('Hypervisor')
+    image_type = JsonField('ImageType')
+    location = JsonField('ImageLocation')
+    name = JsonField('Name')
+    owner_id = JsonField('OwnerId')
+    public = JsonField('Public')
+    root_device_name = JsonField('RootDeviceName')
+    root_device_type = JsonField('RootDeviceType')
+    source_image_id = JsonField('SourceImageId')
+    source_image_region = JsonField('SourceImageRegion')
+    state = JsonField('State')
+    tags = JsonField('Tags', _parse_tags)
+    virtualization_type = JsonField('VirtualizationType')
+
+    def __init__(self, json=None, region=None):
+        self.json = json
+        # region of the inventory the AMI was fetched from
+        self.region = region
 
     def __str__(self):
         return str({
@@ -32,33 +176,11 @@ class AMI(object):
         })
 
     @staticmethod
-    def object_with_json(json):
+    def object_with_json(json, region=None):
         if json is None:
             return None
 
-        o = AMI()
-        o.id = json.get('ImageId')
-        o.name = json.get('Name')
-        o.architecture = json.get('Architecture')
-        o.creation_date = json.get('CreationDate')
-        o.hypervisor = json.get('Hypervisor')
-        o.image_type = json.get('ImageType')
-        o.location = json.get('ImageLocation')
-        o.owner_id = json.get('OwnerId')
-        o.public = json.get('ImageLocation')
-        o.root_device_name = json.get('RootDeviceName')
-        o.root_device_type = json.get('RootDeviceType')
-        o.state = json.get('State')
-        o.virtualization_type = json.get('VirtualizationType')
-
-        o.tags = [AWSTag.object_with_json(tag) for tag in json.get('Tags', [])]
-        ebs_snapshots = [
-            AWSBlockDevice.object_with_json(block_device) for block_device
-            in json.get('BlockDeviceMappings', [])
-        ]
-        o.block_device_mappings = [f for f in ebs_snapshots if f]
-
-        return o
+        return AMI(json, region)
 
     def __repr__(self):
         return '{0}: {1} {2}'.format(self.__class__.__name__,
@@ -67,6 +189,16 @@ class AMI(object):
 
 
 class AWSEC2Instance(object):
+
+    """ Instance of the usage inventory, slotted as there is one per instance """
+
+    __slots__ = ('id', 'name', 'launch_time', 'private_ip_address', 'public_ip_address', 'vpc_id',
+                 'image_id', 'private_dns_name', 'key_name', 'subnet_id', 'instance_type',
+                 'availability_zone', 'asg_name', 'tags')
+
+    # tag set by autoscaling on the instances of a group
+    ASG_TAG = 'aws:autoscaling:groupName'
+
     def __init__(self):
         self.id = None
         self.name = None
@@ -92,10 +224,14 @@ class AWSEC2Instance(object):
         })
 
     @staticmethod
-    def object_with_json(json):
+    def object_with_json(json, strings=None):
+
+        """ strings, an InternTable, keeps one copy of the instance types and zones """
+
         if json is None:
             return None
 
+        intern = strings.intern if strings is not None else (lambda value: value)
         o = AWSEC2Instance()
         o.id = json.get('InstanceId')
         o.name = json.get('PrivateDnsName')
@@ -107,9 +243,10 @@ class AWSEC2Instance(object):
         o.private_dns_name = json.get('PrivateDnsName')
         o.key_name = json.get('KeyName')
         o.subnet_id = json.get('SubnetId')
-        o.instance_type = json.get('InstanceType')
-        o.availability_zone = json.get('Placement').get('AvailabilityZone')
-        o.tags = [AWSTag.object_with_json(tag) for tag in json.get('Tags', [])]
+        o.instance_type = intern(json.get('InstanceType'))
+        o.availability_zone = intern((json.get('Placement') or {}).get('AvailabilityZone'))
+        o.tags = [AWSTag.object_with_json(tag) for tag in json.get('Tags') or []]
+        o.asg_name = next((tag.value for tag in o.tags if tag.key == AWSEC2Instance.ASG_TAG), None)
 
         return o
 
@@ -170,3 +307,85 @@ class AWSTag(object):
         o.key = json.get('Key')
         o.value = json.get('Value')
         return o
+
+
+class ScanResult(namedtuple("ScanResult", "ami excluded_by")):
+
+    """ An AMI of the inventory, excluded_by names the rule using it (None for candidates) """
+
+    __slots__ = ()
+
+
+class PlanResult(namedtuple("PlanResult", "ami group reason")):
+
+    """
+    Decision for a candidate AMI : removed when reason is None, otherwise
+    kept because of reason (one of the KEPT_BY_* values)
+    """
+
+    __slots__ = ()
+
+    KEPT_BY_MAPPING = "mapping strategy"
+    KEPT_BY_PROTECTION = "policy protection"
+    KEPT_BY_KEEP_PREVIOUS = "keep previous"
+    KEPT_BY_MIN_DAYS = "min day"
+
+    @property
+    def removed(self):
+        return self.reason is None
+
+    @property
+    def report_key(self):
+
+        """ name of the report entry listing the AMI """
+
+        if self.reason is None:
+            return self.group
+        if self.reason in (self.KEPT_BY_MAPPING, self.KEPT_BY_PROTECTION):
+            return "Excluded (by {0})".format(self.reason)
+        return "Excluded {0} (by {1})".format(self.group, self.reason)
+
+    @staticmethod
+    def report(results):
+
+        """ report entry name: AMIs, in the order of results """
+
+        report = dict()
+        for result in results:
+            key = result.report_key
+            amis = report.get(key)
+            if amis is None:
+                report[key] = [result.ami]
+            else:
+                amis.append(result.ami)
+        return report
+
+
+class RemovalResult(namedtuple("RemovalResult",
+                               "ami_id error deleted_snapshots kept_snapshots failed_snapshots")):
+
+    """
+    Outcome of an AMI removal. error is the deregistration error, kept
+    snapshots are still used by other AMIs.
+    """
+
+    __slots__ = ()
+
+    @property
+    def deregistered(self):
+        return self.error is None
+
+
+class VerificationReport(namedtuple("VerificationReport",
+                                    "verified_amis verified_snapshots lingering_amis lingering_snapshots")):
+
+    """
+    Outcome of the checks of the removals : counts of the AMIs and
+    snapshots gone, ids still visible after the last check
+    """
+
+    __slots__ = ()
+
+    @property
+    def complete(self):
+        return not self.lingering_amis and not self.lingering_snapshots
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import object
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+
+PRIORITIES = ("oldest", "largest", "group")
+
+
+class ScheduleSummary(object):
+
+    """ Outcome of a scheduled deletion """
+
+    def __init__(self):
+        self.deleted = []
+        self.failed_amis = []
+        self.failed_snapshots = []
+        self.remaining = []
+        self.stopped_by = "completed"
+        self.elapsed = 0.0
+
+    def to_json(self):
+        return {
+            "deleted": self.deleted,
+            "failed_amis": self.failed_amis,
+            "failed_snapshots": self.failed_snapshots,
+            "remaining": self.remaining,
+            "stopped_by": self.stopped_by,
+            "elapsed": self.elapsed,
+        }
+
+
+class DeletionScheduler(object):
+
+    """
+    Removes AMIs in priority order with a pool of workers, within a time
+    budget (max_duration seconds) and / or a number of AMIs (max_deletes).
+    No AMI is started once the budget would be exceeded, the ones in
+    progress are finished, so the run stops at a consistent point.
+
+    priority :
+      oldest : oldest AMIs first
+      largest : AMIs with the largest snapshots first
+      group : groups with the largest payoff first (StorageReport ranking),
+              oldest first inside a group
+
+    A checkpoint file (json) is written as AMIs complete. AMIs left by the
+    previous run are scheduled first when the scheduler starts again.
+    cleaner_for, a region: AMICleaner function (Engine.cleaner_for),
+    removes each AMI in its region, cleaner removes them all otherwise.
+    """
+
+    # seconds between two checkpoint writes
+    CHECKPOINT_INTERVAL = 5
+
+    def __init__(self, cleaner, snapshot_index=None, workers=1, max_duration=None,
+                 max_deletes=None, priority="oldest", checkpoint=None, clock=time.time, cleaner_for=None):
+        if priority not in PRIORITIES:
+            raise ValueError("unknown priority '{0}', expected one of {1}".format(
+                priority, ", ".join(PRIORITIES)))
+
+        self.cleaner = cleaner
+        self.cleaner_for = cleaner_for
+        self.snapshot_index = snapshot_index
+        self.workers = max(1, workers or 1)
+        self.max_duration = max_duration
+        self.max_deletes = max_deletes
+        self.priority = priority
+        self.checkpoint = checkpoint
+        self.clock = clock
+
+    @staticmethod
+    def ami_size(ami):
+        return sum(block_device.volume_size or 0 for block_device in ami.block_device_mappings)
+
+    def order(self, amis, groups=None, ranked_groups=None):
+
+        """
+        Returns amis in priority order, AMIs of the previous checkpoint first
+        :param groups: group name: AMIs, for the group priority
+        :param ranked_groups: group names by decreasing payoff
+        """
+
+        by_date = sorted(amis, key=lambda ami: ami.creation_date or "")
+
+        if self.priority == "largest":
+            ordered = sorted(by_date, key=self.ami_size, reverse=True)
+        elif self.priority == "group" and groups:
+            ranks = dict((name, rank) for rank, name in enumerate(ranked_groups or sorted(groups)))
+            group_rank = dict()
+            for name, group_amis in groups.items():
+                for ami in group_amis:
+                    group_rank[ami.id] = ranks.get(name, len(ranks))
+            ordered = sorted(by_date, key=lambda ami: group_rank.get(ami.id, len(ranks)))
+        else:
+            ordered = by_date
+
+        resumed = self.load_checkpoint()
+        if resumed:
+            positions = dict((ami_id, i) for i, ami_id in enumerate(resumed))
+            ordered = sorted(ordered, key=lambda ami: positions.get(ami.id, len(positions)))
+
+        return ordered
+
+    def load_checkpoint(self):
+
+        """ AMI ids left by the previous run """
+
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return []
+        try:
+            with open(self.checkpoint) as checkpoint_file:
+                return json.load(checkpoint_file).get("remaining") or []
+        except ValueError:
+            return []
+
+    def save_checkpoint(self, summary):
+        if not self.checkpoint:
+            return
+        temp_path = self.checkpoint + ".tmp"
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump(summary.to_json(), checkpoint_file, indent=2)
+        os.replace(temp_path, self.checkpoint)
+
+    def _remove(self, ami):
+        cleaner = self.cleaner_for(ami.region) if self.cleaner_for is not None else self.cleaner
+        try:
+            return cleaner.remove_ami(ami, self.snapshot_index), None
+        except ClientError as e:
+            return [], e
+
+    def run(self, amis, groups=None, ranked_groups=None):
+
+        """ removes amis until done or out of budget, returns a ScheduleSummary """
+
+        start = self.clock()
+        deadline = start + self.max_duration if self.max_duration else None
+        queue = self.order(amis, groups, ranked_groups)
+        queue.reverse()
+
+        summary = ScheduleSummary()
+        started = 0
+        completed = 0
+        busy_time = 0.0
+        in_flight = dict()
+        saved_at = start
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while queue or in_flight:
+                while queue and len(in_flight) < self.workers:
+                    if self.max_deletes is not None and started >= self.max_deletes:
+                        summary.stopped_by = "max-deletes"
+                        break
+                    if deadline is not None:
+                        # an AMI is only started if it should end in time
+                        expected = busy_time / completed if completed else 0
+                        if self.clock() + expected > deadline:
+                            summary.stopped_by = "max-duration"
+                            break
+                    ami = queue.pop()
+                    in_flight[executor.submit(self._remove, ami)] = (ami, self.clock())
+                    started += 1
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                for future in done:
+                    ami, ami_start = in_flight.pop(future)
+                    busy_time += self.clock() - ami_start
+                    completed += 1
+                    failed_snapshots, error = future.result()
+                    if error is not None:
+                        print("{0} deregistration failed : {1}".format(ami.id, error))
+                        summary.failed_amis.append(ami.id)
+                    else:
+                        summary.deleted.append(ami.id)
+                    summary.failed_snapshots.extend(failed_snapshots)
+
+                if self.checkpoint and self.clock() - saved_at >= self.CHECKPOINT_INTERVAL:
+                    summary.remaining = [a.id for a, _ in in_flight.values()] + [a.id for a in reversed(queue)]
+                    summary.elapsed = self.clock() - start
+                    self.save_checkpoint(summary)
+                    saved_at = self.clock()
+
+        summary.remaining = [ami.id for ami in reversed(queue)]
+        summary.elapsed = self.clock() - start
+        self.save_checkpoint(summary)
+        return summary
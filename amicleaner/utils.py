@@ -5,16 +5,63 @@ from __future__ import print_function
 from __future__ import absolute_import
 from builtins import object
 import argparse
-
-from prettytable import PrettyTable
+import sys
 
 from .resources.config import KEEP_PREVIOUS, AMI_MIN_DAYS, AWS_REGION
+from .resources.config import DAEMON_INTERVAL, METRICS_PORT, DELETE_WORKERS, REPORT_CELL_WIDTH
+
+
+class StreamTable(object):
+
+    """
+    Table written row by row with the look of a PrettyTable, for reports
+    too large to be buffered. Column widths are given up front, longer
+    cells are cut, so nothing is kept once a row is written.
+    """
+
+    def __init__(self, field_names, widths, out=None):
+        self.field_names = field_names
+        self.widths = [max(width, len(name)) for name, width in zip(field_names, widths)]
+        self.out = out or sys.stdout
+        self.rule = "+" + "+".join("-" * (width + 2) for width in self.widths) + "+\n"
+        self.started = False
+
+    def _line(self, cells):
+        return "| " + " | ".join(
+            (cell if len(cell) <= width else cell[:width - 3] + "...").center(width)
+            for cell, width in zip(cells, self.widths)) + " |\n"
+
+    def row(self, cells):
+        if not self.started:
+            self.out.write(self.rule + self._line(self.field_names) + self.rule)
+            self.started = True
+        self.out.write(self._line(["" if cell is None else str(cell) for cell in cells]))
+
+    def close(self):
+        if not self.started:
+            self.out.write(self.rule + self._line(self.field_names) + self.rule)
+            self.started = True
+        self.out.write(self.rule)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 class Printer(object):
 
     @staticmethod
-    def print_ami_ids_group(group_name, amis_dict, ami_ids):
+    def table(field_names):
+
+        """ prettytable is only imported when a table is printed """
+
+        from prettytable import PrettyTable
+        return PrettyTable(field_names)
+
+    @staticmethod
+    def print_ami_ids_group(group_name, amis_dict, ami_ids, usage=None, max_rows=None):
         filtered_amis = []
         additional_amis_ids = []
 
@@ -25,61 +72,166 @@ class Printer(object):
             else:
                 additional_amis_ids.append(ami_id)
 
-        Printer._print_ami_ids_group(group_name, filtered_amis)
+        Printer._print_ami_ids_group(group_name, filtered_amis, usage, max_rows)
         if additional_amis_ids:
             print(group_name, "(other ids)")
-            groups_table = PrettyTable(["AMI ID"])
-            for ami_id in additional_amis_ids:
-                groups_table.add_row([
-                    ami_id
-                ])
-
-            print(groups_table.get_string(sortby="AMI ID"), "\n\n")
+            additional_amis_ids.sort()
+            shown = additional_amis_ids[:max_rows] if max_rows is not None else additional_amis_ids
+            with StreamTable(["AMI ID"], [max((len(ami_id) for ami_id in shown), default=21)]) as groups_table:
+                for ami_id in shown:
+                    groups_table.row([ami_id])
+            Printer._print_more(len(additional_amis_ids) - len(shown))
 
     """ Pretty table prints methods """
     @staticmethod
-    def print_report(candidates, full_report=False):
+    def print_report(candidates, full_report=False, storage=None, max_rows=None):
 
-        """ Print AMI collection results """
+        """
+        Print AMI collection results, with the reclaimable storage of
+        each group when a StorageReport is given. Tables are streamed,
+        groups of the full report are cut after max_rows AMIs.
+        """
 
         if not candidates:
             return
 
-        groups_table = PrettyTable(["Group name", "candidates"])
+        field_names = ["Group name", "candidates"]
+        storage_by_group = dict()
+        if storage is not None:
+            field_names += ["Snapshots", "Size (GB)"] + (["Monthly cost"] if storage.priced else [])
+            storage_by_group = storage.by_group()
 
-        for group_name, amis in candidates.items():
-            groups_table.add_row([group_name, len(amis)])
-            if full_report:
-                Printer._print_ami_ids_group(group_name, amis)
+        if full_report:
+            for group_name, amis in candidates.items():
+                Printer._print_ami_ids_group(group_name, amis, max_rows=max_rows)
+
+        group_names = sorted(candidates)
+        widths = [min(REPORT_CELL_WIDTH, max(len(name) for name in group_names)), 10, 9, 10, 12]
 
         print("\nAMIs to be removed:")
-        print(groups_table.get_string(sortby="Group name"))
+        with StreamTable(field_names, widths) as groups_table:
+            for group_name in group_names:
+                row = [group_name, len(candidates[group_name])]
+                if storage is not None:
+                    row += Printer._storage_cells(storage, storage_by_group.get(group_name))
+                groups_table.row(row)
+
+        if storage is not None:
+            Printer.print_storage_totals(storage)
 
     @staticmethod
-    def _print_ami_ids_group(group_name, amis):
-        amis_table = Printer._prepare_ami_table(amis)
-        print(group_name)
-        print(amis_table.get_string(sortby="Creation Date"), "\n\n")
+    def _storage_cells(storage, group_storage):
+        if group_storage is None:
+            return [""] * (3 if storage.priced else 2)
+        snapshots, size, cost = group_storage
+        cells = [snapshots, "{0:.0f}".format(size)]
+        if storage.priced:
+            cells.append("{0:.2f}".format(cost))
+        return cells
 
     @staticmethod
-    def _prepare_ami_table(amis):
-        eligible_amis_table = PrettyTable(
-            ["AMI ID", "AMI Name", "Creation Date", "Tags"]
+    def print_storage_totals(storage):
+
+        """ reclaimable storage per region and in total """
+
+        totals_table = Printer.table(
+            ["Region", "Snapshots", "Size (GB)"] + (["Monthly cost"] if storage.priced else [])
         )
-        for ami in amis:
-            eligible_amis_table.add_row([
-                ami.id,
-                ami.name,
-                ami.creation_date,
-                Printer.tags_to_string(ami.tags)
-            ])
+        for region, region_storage in sorted(storage.by_region().items()):
+            totals_table.add_row([region] + Printer._storage_cells(storage, region_storage))
+        totals_table.add_row(["Total"] + Printer._storage_cells(storage, storage.total()))
+
+        print("\nReclaimable snapshots storage:")
+        print(totals_table)
 
-        return eligible_amis_table
+    @staticmethod
+    def _print_ami_ids_group(group_name, amis, usage=None, max_rows=None):
+
+        """
+        AMIs table sorted by creation date, with their instances count and
+        last launch from an InstanceIndex, cut after max_rows AMIs
+        """
+
+        amis = sorted(amis, key=lambda ami: ami.creation_date or "")
+        shown = amis[:max_rows] if max_rows is not None else amis
+
+        field_names = ["AMI ID", "AMI Name", "Creation Date", "Tags"]
+        widths = [21, 0, 24, 0]
+        for ami in shown:
+            widths[0] = max(widths[0], len(ami.id or ""))
+            widths[1] = max(widths[1], len(ami.name or ""))
+            widths[3] = max(widths[3], len(Printer.tags_to_string(ami.tags)))
+        widths[1] = min(widths[1], REPORT_CELL_WIDTH)
+        widths[3] = min(widths[3], REPORT_CELL_WIDTH)
+        if usage is not None:
+            field_names += ["Instances", "Last launch"]
+            widths += [9, 25]
+
+        print(group_name)
+        with StreamTable(field_names, widths) as amis_table:
+            for ami in shown:
+                row = [ami.id, ami.name, ami.creation_date, Printer.tags_to_string(ami.tags)]
+                if usage is not None:
+                    row += [usage.count(ami.id), usage.last_launch(ami.id)]
+                amis_table.row(row)
+        Printer._print_more(len(amis) - len(shown))
+        print("\n")
+
+    @staticmethod
+    def _print_more(count):
+        if count > 0:
+            print("... and {0} more AMIs".format(count))
+
+    @staticmethod
+    def print_schedule_summary(summary):
+
+        summary_table = Printer.table(["Deleted", "Failed AMIs", "Failed snapshots",
+                                       "Remaining", "Stopped by", "Duration (s)"])
+        summary_table.add_row([
+            len(summary.deleted),
+            len(summary.failed_amis),
+            len(summary.failed_snapshots),
+            len(summary.remaining),
+            summary.stopped_by,
+            "{0:.1f}".format(summary.elapsed),
+        ])
+        print(summary_table)
+
+    @staticmethod
+    def print_diff(changes, amis_dict, scanned, max_rows=None):
+
+        """ AMIs whose status changed since the previous run, by transition """
+
+        if not changes:
+            print("No change since the previous run ({0} AMIs)".format(scanned))
+            return
+
+        for label in sorted(changes):
+            Printer.print_ami_ids_group("{0}: {1}".format(label, len(changes[label])),
+                                        amis_dict, changes[label], max_rows=max_rows)
+
+    @staticmethod
+    def print_queue_progress(counts):
+        print("{0}/{1} items done, {2} failed".format(
+            counts["done"] + counts["failed"], sum(counts.values()), counts["failed"]))
+
+    @staticmethod
+    def print_verification(report):
+        print("\nVerification : {0} AMIs and {1} snapshots gone".format(
+            report.verified_amis, report.verified_snapshots))
+        if report.complete:
+            return
+        table = Printer.table(["Still visible", "Kind"])
+        for ami_id in report.lingering_amis:
+            table.add_row([ami_id, "AMI"])
+        for snapshot_id in report.lingering_snapshots:
+            table.add_row([snapshot_id, "snapshot"])
+        print(table)
 
     @staticmethod
     def print_failed_snapshots(snapshots):
 
-        snap_table = PrettyTable(["Failed Snapshots"])
+        snap_table = Printer.table(["Failed Snapshots"])
 
         for snap in snapshots:
             snap_table.add_row([snap])
@@ -88,7 +240,7 @@ class Printer(object):
     @staticmethod
     def print_orphan_snapshots(snapshots):
 
-        snap_table = PrettyTable(["Orphan Snapshots"])
+        snap_table = Printer.table(["Orphan Snapshots"])
 
         for snap in snapshots:
             snap_table.add_row([snap])
@@ -106,6 +258,63 @@ class Printer(object):
         return "; ".join(sorted(tag_values))
 
 
+def policy_file(path):
+
+    """ argparse type loading a retention policy file """
+
+    from .policy import Policy, PolicyError
+    try:
+        return Policy.load(path)
+    except (IOError, PolicyError) as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def pricing_file(path):
+
+    """ argparse type loading a snapshots pricing file """
+
+    from .accounting import Pricing, PricingError
+    try:
+        return Pricing.load(path)
+    except (IOError, PricingError) as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def usage_history_file(path):
+
+    """ argparse type loading a usage history file, which may not exist yet """
+
+    from .history import UsageHistory, UsageHistoryError
+    try:
+        return UsageHistory.load(path)
+    except (IOError, UsageHistoryError) as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def run_state_file(path):
+
+    """ argparse type loading the state of the previous --diff run, which may not exist yet """
+
+    from .diff import RunState, RunStateError
+    try:
+        return RunState.load(path)
+    except (IOError, RunStateError) as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def positive_int(value):
+
+    """ argparse type of the counts which must be at least 1 """
+
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError("{0} is not a positive integer".format(value))
+    return count
+
+
 def parse_args(args):
     parser = argparse.ArgumentParser(description='Clean your AMIs on your '
                                                  'AWS account. Your AWS '
@@ -170,10 +379,184 @@ def parse_args(args):
                         default=AWS_REGION,
                         help="AWS Region")
 
+    parser.add_argument("--aws-regions",
+                        dest='aws_regions',
+                        nargs="+",
+                        help="Clean several AWS regions together, copies of "
+                             "an AMI are kept or removed with their lineage")
+
+    parser.add_argument("--report-max-rows",
+                        dest='report_max_rows',
+                        type=positive_int,
+                        help="Number of AMIs listed for each group of the full "
+                             "report, the others are only counted")
+
+    parser.add_argument("--queue",
+                        dest='queue',
+                        help="Remove AMIs and orphan snapshots through a local "
+                             "SQLite work queue drained by --processes processes")
+
+    parser.add_argument("--queue-rate",
+                        dest='queue_rate',
+                        type=float,
+                        help="API calls per second shared by the --queue processes")
+
+    parser.add_argument("--watch",
+                        dest='watch',
+                        help="Keep the AMIs inventory up to date from a feed of "
+                             "EC2 events (a JSON lines file followed as it "
+                             "grows, or unix:PATH for a socket) and clean the "
+                             "groups as they exceed the retention")
+
+    parser.add_argument("--verify",
+                        dest='verify',
+                        action="store_true",
+                        help="Check that the removed AMIs and snapshots are "
+                             "gone, while the removals go on")
+
+    parser.add_argument("--inventory",
+                        dest='inventory',
+                        help="Write the AMIs to this compact file while fetching "
+                             "and group them from it, for very large accounts")
+
+    parser.add_argument("--diff",
+                        dest='diff_state',
+                        type=run_state_file,
+                        help="Dry run only printing the changes since the "
+                             "previous run, whose state is kept in this file")
+
+    parser.add_argument("--keep-shared",
+                        dest='keep_shared',
+                        action="store_true",
+                        help="Keep the candidate AMIs shared with other "
+                             "accounts through launch permissions")
+
+    parser.add_argument("--mark",
+                        dest='mark',
+                        action="store_true",
+                        help="Tag the AMIs to clean for a later --sweep "
+                             "instead of removing them")
+
+    parser.add_argument("--sweep",
+                        dest='sweep',
+                        action="store_true",
+                        help="Remove the AMIs tagged by a previous --mark run")
+
+    parser.add_argument("--workers",
+                        dest='workers',
+                        type=positive_int,
+                        default=DELETE_WORKERS,
+                        help="Number of AMIs removed in parallel")
+
+    parser.add_argument("--max-duration",
+                        dest='max_duration',
+                        type=int,
+                        help="Stop starting AMI removals after this many seconds")
+
+    parser.add_argument("--max-deletes",
+                        dest='max_deletes',
+                        type=int,
+                        help="Remove at most this many AMIs")
+
+    parser.add_argument("--priority",
+                        dest='priority',
+                        choices=["oldest", "largest", "group"],
+                        help="Order of the removals : oldest AMIs, largest snapshots,"
+                             " or groups freeing the most storage first")
+
+    parser.add_argument("--checkpoint",
+                        dest='checkpoint',
+                        help="Json file recording the progress of removals, AMIs "
+                             "left by a previous run are removed first")
+
+    parser.add_argument("--policy",
+                        dest='policy',
+                        type=policy_file,
+                        help="Json or yaml retention policy file, replaces the "
+                             "mapping, keep previous and min days options")
+
+    parser.add_argument("--pricing",
+                        dest='pricing',
+                        type=pricing_file,
+                        help="Json file of snapshots prices per GB and month, "
+                             "adds the monthly cost of each group to the report")
+
+    parser.add_argument("--columnar",
+                        dest='columnar',
+                        action="store_true",
+                        help="Apply keep previous and min days rules on all groups "
+                             "at once, faster on large accounts (uses numpy if installed)")
+
+    parser.add_argument("--processes",
+                        dest='processes',
+                        type=positive_int,
+                        default=1,
+                        help="Apply keep previous and min days rules to the groups "
+                             "on this many processes (and consumers of --queue)")
+
+    parser.add_argument("--usage-history",
+                        dest='usage_history',
+                        type=usage_history_file,
+                        help="Json file recording the AMIs seen in use by instances, "
+                             "updated on each run")
+
+    parser.add_argument("--keep-used-days",
+                        dest='keep_used_days',
+                        type=int,
+                        help="Keep AMIs seen in use during the last days, "
+                             "according to --usage-history")
+
+    parser.add_argument("--sample-usage",
+                        dest='sample_usage',
+                        action="store_true",
+                        help="Only record the AMIs in use in --usage-history "
+                             "(to run often, from cron)")
+
+    parser.add_argument("--daemon",
+                        dest='daemon',
+                        action="store_true",
+                        help="Keep running and clean every --interval seconds,"
+                             " AMIs are only removed with --force-delete")
+
+    parser.add_argument("--interval",
+                        dest='interval',
+                        type=int,
+                        default=DAEMON_INTERVAL,
+                        help="Seconds between two cleaning cycles in daemon mode")
+
+    parser.add_argument("--metrics-port",
+                        dest='metrics_port',
+                        type=int,
+                        default=METRICS_PORT,
+                        help="Port exposing Prometheus metrics in daemon mode,"
+                             " 0 disables the endpoint")
+
     parsed_args = parser.parse_args(args)
     if parsed_args.mapping_key and not parsed_args.mapping_values:
         print("missing mapping-values\n")
         parser.print_help()
         return None
 
+    if (parsed_args.keep_used_days or parsed_args.sample_usage) and not parsed_args.usage_history:
+        print("missing usage-history\n")
+        parser.print_help()
+        return None
+
+    if parsed_args.verify and (parsed_args.queue or parsed_args.from_ids or any(
+            option is not None for option in (parsed_args.max_duration, parsed_args.max_deletes,
+                                              parsed_args.priority, parsed_args.checkpoint))):
+        print("verify does not support queue, from-ids nor scheduling options\n")
+        parser.print_help()
+        return None
+
+    if parsed_args.watch and (parsed_args.policy or parsed_args.aws_regions or parsed_args.inventory):
+        print("watch does not support policy, aws-regions nor inventory\n")
+        parser.print_help()
+        return None
+
+    if parsed_args.inventory and (parsed_args.policy or parsed_args.aws_regions or parsed_args.daemon):
+        print("inventory does not support policy, aws-regions nor daemon\n")
+        parser.print_help()
+        return None
+
     return parsed_args
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+from builtins import range
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from .resources.config import VERIFY_BATCH, VERIFY_WORKERS, VERIFY_ATTEMPTS, VERIFY_DELAY
+from .resources.models import VerificationReport
+
+AMI = "ami"
+SNAPSHOT = "snapshot"
+
+
+class DeletionVerifier(object):
+
+    """
+    Checks that removals took effect while the deletions go on. Removal
+    results are given to submit, a background thread describes their
+    deregistered AMIs and deleted snapshots again by batches of
+    batch_size ids, with workers concurrent calls. Ids still visible
+    (describes are eventually consistent) are checked again after a
+    delay doubled at each attempt, and reported as lingering after
+    attempts checks.
+    """
+
+    def __init__(self, ec2, batch_size=VERIFY_BATCH, workers=VERIFY_WORKERS, attempts=VERIFY_ATTEMPTS,
+                 delay=VERIFY_DELAY):
+        self.ec2 = ec2
+        self.batch_size = batch_size
+        self.workers = workers
+        self.attempts = attempts
+        self.delay = delay
+
+        # (check time, sequence, kind, id, attempt) of the ids to check
+        self.checks = []
+        self.sequence = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.verified = {AMI: 0, SNAPSHOT: 0}
+        self.lingering = {AMI: [], SNAPSHOT: []}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="deletion-verifier")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _push(self, kind, resource_id, attempt, when):
+        self.sequence += 1
+        heapq.heappush(self.checks, (when, self.sequence, kind, resource_id, attempt))
+
+    def submit(self, result):
+
+        """ queues the checks of a RemovalResult, failed deregistrations are not checked """
+
+        if not result.deregistered:
+            return
+        with self.condition:
+            now = time.time()
+            self._push(AMI, result.ami_id, 0, now)
+            for snapshot_id in result.deleted_snapshots:
+                self._push(SNAPSHOT, snapshot_id, 0, now)
+            self.condition.notify()
+
+    def close(self):
+
+        """ waits for the pending checks, returns a VerificationReport """
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        else:
+            self._run()
+        return VerificationReport(self.verified[AMI], self.verified[SNAPSHOT],
+                                  sorted(self.lingering[AMI]), sorted(self.lingering[SNAPSHOT]))
+
+    def _take_due(self):
+
+        """ checks due now (at most a batch per worker), None when closed and done """
+
+        limit = self.batch_size * self.workers
+        with self.condition:
+            while True:
+                if not self.checks:
+                    if self.closed:
+                        return None
+                    self.condition.wait()
+                    continue
+                wait = self.checks[0][0] - time.time()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                due = []
+                while self.checks and self.checks[0][0] <= time.time() and len(due) < limit:
+                    due.append(heapq.heappop(self.checks))
+                return due
+
+    def _visible(self, kind, ids):
+
+        """ ids still visible, all of them when the describe call fails """
+
+        try:
+            if kind == AMI:
+                resp = self.ec2.describe_images(Owners=['self'], Filters=[{'Name': 'image-id', 'Values': ids}])
+                return set(image['ImageId'] for image in resp.get('Images', [])
+                           if image.get('State') != 'deregistered')
+            resp = self.ec2.describe_snapshots(OwnerIds=['self'], Filters=[{'Name': 'snapshot-id', 'Values': ids}])
+            return set(snapshot['SnapshotId'] for snapshot in resp.get('Snapshots', []))
+        except ClientError:
+            return set(ids)
+        except Exception:
+            # connection or parsing errors, checked again later
+            return set(ids)
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                due = self._take_due()
+                if due is None:
+                    return
+
+                batches = []
+                for kind in (AMI, SNAPSHOT):
+                    checks = [check for check in due if check[2] == kind]
+                    for start in range(0, len(checks), self.batch_size):
+                        batches.append((kind, checks[start:start + self.batch_size]))
+
+                futures = [executor.submit(self._visible, kind, [check[3] for check in checks])
+                           for kind, checks in batches]
+                # the describes run without the lock, submit is not blocked
+                visible_ids = [future.result() for future in futures]
+
+                with self.condition:
+                    for (kind, checks), visible in zip(batches, visible_ids):
+                        for _, _, _, resource_id, attempt in checks:
+                            if resource_id not in visible:
+                                self.verified[kind] += 1
+                            elif attempt + 1 >= self.attempts:
+                                self.lingering[kind].append(resource_id)
+                            else:
+                                self._push(kind, resource_id, attempt + 1,
+                                           time.time() + self.delay * 2 ** attempt)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+import json
+import os
+import selectors
+import socket
+import stat
+import time
+
+from .resources.config import WATCH_POLL_INTERVAL
+
+# detail-type of the EventBridge events handled
+AMI_STATE_CHANGE = "EC2 AMI State Change"
+INSTANCE_STATE_CHANGE = "EC2 Instance State-change Notification"
+
+# instance states using their AMI, as in Fetcher.fetch_instance_records
+USING_STATES = ("pending", "running", "shutting-down", "stopping", "stopped")
+
+
+def _events(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(event, dict):
+            yield event
+
+
+def read_feed(feed, follow=True, interval=WATCH_POLL_INTERVAL):
+
+    """
+    Yields the events (EventBridge shaped dicts, one JSON object per line)
+    of feed, a file followed as it grows or "unix:PATH", a socket listening
+    for connections of the forwarders. None is yielded when no event came
+    for interval seconds. Without follow, stops at the end of the file.
+    Lines which are not JSON objects are skipped.
+    """
+
+    if feed.startswith("unix:"):
+        for event in _read_socket(feed[len("unix:"):], interval):
+            yield event
+        return
+
+    with open(feed, "rb") as feed_file:
+        buffered = b""
+        while True:
+            line = feed_file.readline()
+            buffered += line
+            if buffered.endswith(b"\n") or (buffered and not line and not follow):
+                for event in _events([buffered.decode("utf-8")]):
+                    yield event
+                buffered = b""
+                continue
+            if line:
+                # partial line, completed by the next writes
+                continue
+            if not follow:
+                return
+            yield None
+            time.sleep(interval)
+
+
+def _read_socket(path, interval):
+
+    """
+    Serves every forwarder connected at once through a selector, each with
+    its own buffer of partial line. None is yielded after interval seconds
+    without an event.
+    """
+
+    # the socket of a previous run, any other file is left alone
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+    except socket.error:
+        server.close()
+        raise
+
+    selector = selectors.DefaultSelector()
+    buffers = dict()
+    try:
+        server.listen(8)
+        server.setblocking(False)
+        selector.register(server, selectors.EVENT_READ)
+        last_event = time.time()
+        while True:
+            lines = []
+            for key, _ in selector.select(max(0, last_event + interval - time.time())):
+                if key.fileobj is server:
+                    connection, _ = server.accept()
+                    connection.setblocking(False)
+                    selector.register(connection, selectors.EVENT_READ)
+                    buffers[connection] = b""
+                    continue
+                connection = key.fileobj
+                try:
+                    data = connection.recv(65536)
+                except (socket.error, IOError):
+                    data = b""
+                if not data:
+                    # closed, its last line may not end with a newline
+                    lines.append(buffers.pop(connection))
+                    selector.unregister(connection)
+                    connection.close()
+                    continue
+                complete, _, buffers[connection] = (buffers[connection] + data).rpartition(b"\n")
+                if complete:
+                    lines.extend(complete.split(b"\n"))
+
+            events = list(_events(line.decode("utf-8", "replace") for line in lines))
+            for event in events:
+                yield event
+            if events:
+                last_event = time.time()
+            elif time.time() - last_event >= interval:
+                yield None
+                last_event = time.time()
+    finally:
+        for connection in buffers:
+            connection.close()
+        selector.close()
+        server.close()
+        os.remove(path)
+
+
+class Watcher(object):
+
+    """
+    Keeps the inventory of an engine up to date from EC2 events instead of
+    scanning it again : AMIs created or deregistered, instances started or
+    terminated. Every AMI of the inventory is mapped to its groups, an
+    event only reduces again the groups of the AMIs it touches, and the
+    AMIs removed by these reductions are queued for deletion.
+    The other exclusion rules (launch configurations, templates, backups)
+    keep the ids of the initial scan. The policy and several regions are
+    not supported.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+        # instance id: AWSEC2Instance using an AMI
+        self.instances = dict()
+
+        # group name: AMI ids, and AMI id: group names
+        self.groups = dict()
+        self.ami_groups = dict()
+
+        # AMI id: PlanResult of the AMIs queued, until drained, and ids of
+        # the AMIs queued until removed
+        self.pending = dict()
+        self.queued = set()
+
+    def start(self):
+
+        """ scans the inventory once, and queues the AMIs to remove """
+
+        engine = self.engine
+        list(engine.scan())
+        self.instances = dict((instance.id, instance) for instance in engine.fetcher.fetch_instance_records()
+                              if instance.image_id)
+        self.groups = dict()
+        self.ami_groups = dict()
+        for ami in engine.available_amis.values():
+            self._map(ami)
+        return self.reduce(list(self.groups))
+
+    def _map(self, ami):
+        mapped = self.engine.cleaner.map_candidates([ami], self.engine.mapping_strategy)
+        groups = [group_name for group_name in mapped if group_name]
+        self.ami_groups[ami.id] = groups
+        for group_name in groups:
+            self.groups.setdefault(group_name, set()).add(ami.id)
+        return groups
+
+    def _unmap(self, ami_id):
+        groups = self.ami_groups.pop(ami_id, [])
+        for group_name in groups:
+            members = self.groups.get(group_name)
+            members.discard(ami_id)
+            if not members:
+                del self.groups[group_name]
+        return groups
+
+    def excluded(self, ami_id):
+        return any(ami_id in ami_ids for ami_ids in self.engine.exclusions.values())
+
+    def reduce(self, groups):
+
+        """
+        Reduces groups again, queues the AMIs they remove and returns
+        their PlanResults
+        """
+
+        engine = self.engine
+        available_amis = engine.available_amis
+        reductions = []
+        for group_name in groups:
+            amis = [available_amis[ami_id] for ami_id in self.groups.get(group_name, ())
+                    if ami_id in available_amis and not self.excluded(ami_id)]
+            if amis:
+                reductions.append((group_name,) + engine.cleaner.reduce_candidates(
+                    amis, engine.keep_previous, engine.ami_min_days))
+
+        queued = []
+        for result in engine.plan_results(reductions):
+            if result.removed and result.ami.id not in self.queued:
+                self.queued.add(result.ami.id)
+                self.pending[result.ami.id] = result
+                queued.append(result)
+        return queued
+
+    def handle(self, event):
+
+        """ applies an event to the inventory, returns the groups it touches """
+
+        detail = event.get("detail") or {}
+        detail_type = event.get("detail-type")
+        if detail_type == AMI_STATE_CHANGE and detail.get("ImageId"):
+            return self.image_changed(detail["ImageId"], detail.get("State"))
+        if detail_type == INSTANCE_STATE_CHANGE and detail.get("instance-id"):
+            return self.instance_changed(detail["instance-id"], detail.get("state"))
+        return set()
+
+    def image_changed(self, ami_id, state):
+        groups = set(self._unmap(ami_id))
+        ami = self.engine.fetcher.fetch_ami(ami_id) if state == "available" else None
+        if ami is None:
+            self.forget(ami_id)
+            return groups
+        self.engine.add_ami(ami)
+        return groups | set(self._map(ami))
+
+    def instance_changed(self, instance_id, state):
+        engine = self.engine
+        instance = self.instances.get(instance_id)
+        if state in USING_STATES:
+            if instance is not None:
+                return set()
+            instance = engine.fetcher.fetch_instance(instance_id)
+            if instance is None or not instance.image_id:
+                return set()
+            self.instances[instance_id] = instance
+            engine.instance_index.add(instance)
+            engine.exclusions.setdefault("instances", set()).add(instance.image_id)
+            # queued but not removed yet, the AMI is in use again
+            self.pending.pop(instance.image_id, None)
+            self.queued.discard(instance.image_id)
+        else:
+            if instance is None:
+                return set()
+            del self.instances[instance_id]
+            engine.instance_index.remove(instance)
+            if not engine.instance_index.count(instance.image_id):
+                engine.exclusions.get("instances", set()).discard(instance.image_id)
+        return set(self.ami_groups.get(instance.image_id, []))
+
+    def process(self, event):
+
+        """ handle then reduce, returns the PlanResults of the AMIs queued """
+
+        return self.reduce(self.handle(event))
+
+    def drain(self):
+
+        """ PlanResults of the AMIs queued since the previous drain """
+
+        pending = list(self.pending.values())
+        self.pending = dict()
+        return pending
+
+    def forget(self, ami_id):
+
+        """ drops a removed AMI """
+
+        self.engine.forget_ami(ami_id)
+        self._unmap(ami_id)
+        self.pending.pop(ami_id, None)
+        self.queued.discard(ami_id)
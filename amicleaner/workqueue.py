@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+from builtins import range
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_EXCEPTION
+import json
+import sqlite3
+import time
+
+from .resources.config import QUEUE_CLAIM_BATCH, QUEUE_POLL_INTERVAL, QUEUE_BATCH_TTL
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    batch INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker INTEGER,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS items_state ON items (state, id);
+CREATE INDEX IF NOT EXISTS items_batch ON items (batch);
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL
+);
+"""
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+EXPIRED = "expired"
+
+# errors of a deregistration or deletion already done by a previous attempt
+GONE_CODES = ("InvalidAMIID.NotFound", "InvalidAMIID.Unavailable", "InvalidSnapshot.NotFound")
+
+
+class WorkQueue(object):
+
+    """
+    Durable queue of removal work items in a local SQLite file, shared by
+    the consumer processes. Each run publishes its items as a batch, and
+    only claims the items of its batch in a write transaction, so each one
+    is handled by a single consumer and runs sharing the file do not steal
+    their claims. Items left claimed by an interrupted consumer are put
+    back with release, batches left unfinished are expired.
+    Kinds : "ami" {"ami_id", "region", "snapshot_ids", "kept_snapshots"}
+    and "snapshot" {"snapshot_id", "region"}.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def put(self, kind, payloads):
+
+        """ publishes payloads as a new batch of items, returns the batch id """
+
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            batch = self.db.execute(
+                "SELECT MAX((SELECT COALESCE(MAX(batch), 0) FROM items),"
+                " (SELECT COALESCE(MAX(id), 0) FROM batches)) + 1").fetchone()[0]
+            self.db.execute("INSERT INTO batches (id, created) VALUES (?, ?)", (batch, time.time()))
+            self.db.executemany(
+                "INSERT INTO items (batch, kind, payload) VALUES (?, ?, ?)",
+                ((batch, kind, json.dumps(payload)) for payload in payloads))
+        return batch
+
+    def claim(self, worker, batch, count=QUEUE_CLAIM_BATCH):
+
+        """ claims up to count pending items of batch for worker : [(id, kind, payload)] """
+
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            rows = self.db.execute(
+                "SELECT id, kind, payload FROM items WHERE state = ? AND batch = ? ORDER BY id LIMIT ?",
+                (PENDING, batch, count)).fetchall()
+            self.db.executemany("UPDATE items SET state = ?, worker = ? WHERE id = ?",
+                                ((CLAIMED, worker, row[0]) for row in rows))
+        return [(item_id, kind, json.loads(payload)) for item_id, kind, payload in rows]
+
+    def finish(self, outcomes):
+
+        """ records (item id, DONE or FAILED, result) outcomes """
+
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany("UPDATE items SET state = ?, result = ? WHERE id = ?",
+                                ((state, json.dumps(result), item_id) for item_id, state, result in outcomes))
+
+    def release(self, batch):
+
+        """ puts back the items of batch claimed by consumers which did not finish them """
+
+        with self.db:
+            return self.db.execute("UPDATE items SET state = ?, worker = NULL WHERE state = ? AND batch = ?",
+                                   (PENDING, CLAIMED, batch)).rowcount
+
+    def expire(self, ttl=QUEUE_BATCH_TTL):
+
+        """
+        Expires the items still pending or claimed of the batches published
+        more than ttl seconds ago (by a run which was interrupted), they are
+        not handled anymore. Returns the number of items expired.
+        """
+
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            return self.db.execute(
+                "UPDATE items SET state = ? WHERE state IN (?, ?) AND batch NOT IN"
+                " (SELECT id FROM batches WHERE created >= ?)",
+                (EXPIRED, PENDING, CLAIMED, time.time() - ttl)).rowcount
+
+    def progress(self, batch=None):
+
+        """ state: items count, of a batch or of the whole queue """
+
+        query = "SELECT state, COUNT(*) FROM items {0} GROUP BY state".format(
+            "WHERE batch = ?" if batch is not None else "")
+        counts = dict.fromkeys((PENDING, CLAIMED, DONE, FAILED), 0)
+        counts.update(self.db.execute(query, (batch,) if batch is not None else ()).fetchall())
+        return counts
+
+    def results(self, batch):
+
+        """ (kind, payload, state, result) of the finished items of a batch """
+
+        for kind, payload, state, result in self.db.execute(
+                "SELECT kind, payload, state, result FROM items WHERE batch = ? AND state IN (?, ?) ORDER BY id",
+                (batch, DONE, FAILED)):
+            yield kind, json.loads(payload), state, json.loads(result)
+
+
+class RateLimiter(object):
+
+    """ spaces calls to stay under rate calls per second, no limit for None """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.time()
+        if now < self.next_call:
+            time.sleep(self.next_call - now)
+            now = self.next_call
+        self.next_call = now + self.interval
+
+
+def _error_code(error):
+    return getattr(error, "response", {}).get("Error", {}).get("Code")
+
+
+def handle_item(ec2, kind, payload, limiter):
+
+    """
+    runs a work item with the ec2 client, returns (state, result).
+    Items can be run again: AMIs and snapshots already removed are
+    counted as removed.
+    """
+
+    from botocore.exceptions import ClientError
+
+    if kind == "snapshot":
+        limiter.wait()
+        try:
+            ec2.delete_snapshot(SnapshotId=payload["snapshot_id"])
+        except ClientError as e:
+            if _error_code(e) not in GONE_CODES:
+                return FAILED, {"error": str(e), "code": _error_code(e)}
+        return DONE, {"error": None}
+
+    limiter.wait()
+    try:
+        ec2.deregister_image(ImageId=payload["ami_id"])
+    except ClientError as e:
+        # deregistered by a previous attempt, its snapshots may be left
+        if _error_code(e) not in GONE_CODES:
+            return FAILED, {"error": str(e), "code": _error_code(e), "deleted": [], "failed": [],
+                            "kept": payload.get("kept_snapshots", [])}
+
+    deleted, kept, failed = [], list(payload.get("kept_snapshots", [])), []
+    for snapshot_id in payload.get("snapshot_ids", []):
+        limiter.wait()
+        try:
+            ec2.delete_snapshot(SnapshotId=snapshot_id)
+            deleted.append(snapshot_id)
+        except ClientError as e:
+            # referenced by an AMI unknown from the index
+            if _error_code(e) == "InvalidSnapshot.InUse":
+                kept.append(snapshot_id)
+            elif _error_code(e) in GONE_CODES:
+                deleted.append(snapshot_id)
+            else:
+                failed.append(snapshot_id)
+    return DONE, {"error": None, "deleted": deleted, "kept": kept, "failed": failed}
+
+
+def default_client(config=None, region=None):
+
+    """ ec2 client of region, the region of config when None """
+
+    import boto3
+    if region is not None:
+        from botocore.config import Config
+        region_config = Config(region_name=region)
+        config = config.merge(region_config) if config is not None else region_config
+    return boto3.client('ec2', config=config)
+
+
+def consume(path, worker, batch, rate=None, client_factory=default_client, config=None):
+
+    """
+    Consumer process : handles the items of batch with its own ec2 clients
+    (one per region of the items) and its share of the rate until the
+    batch is empty. Returns the number of items handled.
+    """
+
+    queue = WorkQueue(path)
+    clients = dict()
+    limiter = RateLimiter(rate)
+    handled = 0
+    try:
+        while True:
+            items = queue.claim(worker, batch)
+            if not items:
+                return handled
+            outcomes = []
+            for item_id, kind, payload in items:
+                region = payload.get("region")
+                if region not in clients:
+                    clients[region] = client_factory(config, region)
+                outcomes.append((item_id,) + handle_item(clients[region], kind, payload, limiter))
+            queue.finish(outcomes)
+            handled += len(items)
+    finally:
+        queue.close()
+
+
+def run(path, batch, processes=2, rate=None, client_factory=default_client, config=None, progress=None,
+        interval=QUEUE_POLL_INTERVAL):
+
+    """
+    Drains the items of batch in the queue at path with processes
+    consumers, rate (calls per second, None for no limit) is split between
+    them. progress is called with the items count of the batch by state
+    while they work. Returns the final counts.
+    """
+
+    queue = WorkQueue(path)
+    try:
+        queue.release(batch)
+        share = float(rate) / processes if rate else None
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(consume, path, worker, batch, share, client_factory, config)
+                       for worker in range(processes)]
+            pending = futures
+            while pending:
+                _, pending = wait(pending, timeout=interval, return_when=FIRST_EXCEPTION)
+                if progress is not None:
+                    progress(queue.progress(batch))
+            for future in futures:
+                future.result()
+        return queue.progress(batch)
+    finally:
+        queue.close()
+
+
+class QueueDeleter(object):
+
+    """
+    Removes AMIs and snapshots through the work queue at path, drained by
+    processes consumers with their own clients
+    """
+
+    def __init__(self, path, processes=2, rate=None, config=None, client_factory=default_client,
+                 progress=None):
+        self.path = path
+        self.processes = processes
+        self.rate = rate
+        self.config = config
+        self.client_factory = client_factory
+        self.progress = progress
+
+    def publish(self, kind, payloads):
+
+        """ expires the batches left by interrupted runs, publishes payloads as a new batch """
+
+        queue = WorkQueue(self.path)
+        try:
+            queue.expire()
+            return queue.put(kind, payloads)
+        finally:
+            queue.close()
+
+    def drain(self, batch):
+        run(self.path, batch, self.processes, self.rate, self.client_factory, self.config, self.progress)
+        queue = WorkQueue(self.path)
+        try:
+            return list(queue.results(batch))
+        finally:
+            queue.close()
+
+    def remove_amis(self, amis, snapshot_index=None):
+
+        """
+        Removes amis, snapshots still referenced according to
+        snapshot_index are kept. Returns a RemovalResult for each AMI.
+        """
+
+        from .resources.models import RemovalResult
+
+        payloads = []
+        for ami in amis:
+            snapshot_ids = [block_device.snapshot_id for block_device in ami.block_device_mappings
+                            if block_device.snapshot_id is not None]
+            kept = []
+            if snapshot_index is not None:
+                released = snapshot_index.release(ami.id, snapshot_ids)
+                kept = [snap for snap in snapshot_ids if snap not in released]
+                snapshot_ids = released
+            payloads.append({"ami_id": ami.id, "region": ami.region, "snapshot_ids": snapshot_ids,
+                             "kept_snapshots": kept})
+
+        return [
+            RemovalResult(payload["ami_id"], result["error"], result["deleted"], result["kept"], result["failed"])
+            for _, payload, _, result in self.drain(self.publish("ami", payloads))
+        ]
+
+    def delete_snapshots(self, snapshot_ids, region=None):
+
+        """ Deletes snapshots of region, returns the ids of those which could not be deleted """
+
+        return [payload["snapshot_id"]
+                for _, payload, state, _ in self.drain(self.publish("snapshot", [
+                    {"snapshot_id": snapshot_id, "region": region} for snapshot_id in snapshot_ids]))
+                if state == FAILED]
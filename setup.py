@@ -51,6 +51,9 @@ setup(
             'amicleaner = amicleaner.cli:main',
         ],
     },
+    extras_require={
+        'columnar': ['numpy'],
+    },
     tests_require=test_requirements,
     install_requires=install_requirements,
 )
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""
+Deterministic in-memory stand-in for the EC2 and autoscaling clients used
+by amicleaner, for load tests at a scale moto cannot handle.
+
+    aws = FakeAWS(seed=1, latency=0.002, throttle_rate=0.05, page_size=1000)
+    aws.populate(images=100000, instances=5000)
+    fetcher = Fetcher(ec2=aws.ec2, autoscaling=aws.asg)
+
+Every call pays `latency` seconds (on a virtual clock unless `realtime`),
+fails with a throttling error with probability `throttle_rate` and with a
+server error with probability `failure_rate` (a float, or a dict of rates
+per operation name). Throttled calls are retried
+like botocore does, up to `max_attempts`, with an exponential backoff.
+`aws.stats` counts calls, throttles, retries and failures per operation.
+"""
+
+import fnmatch
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from botocore.exceptions import ClientError
+
+
+THROTTLING_ERROR = 'RequestLimitExceeded'
+
+
+def client_error(code, operation, message=""):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def matches_filters(item, filters, attributes):
+
+    """
+    True if item matches every describe filter, `attributes` maps a filter
+    name to a function returning the item values for it
+    """
+
+    for f in filters or []:
+        name = f['Name']
+        if name.startswith('tag:'):
+            key = name[4:]
+            values = [t['Value'] for t in item.get('Tags', []) if t['Key'] == key]
+        elif name == 'tag-key':
+            values = [t['Key'] for t in item.get('Tags', [])]
+        else:
+            values = attributes[name](item)
+        if not any(fnmatch.fnmatchcase(str(v), pattern) for v in values for pattern in f['Values']):
+            return False
+    return True
+
+
+class FakePaginator(object):
+
+    def __init__(self, method, page_size, token_key='NextToken', limit_key='MaxResults'):
+        self.method = method
+        self.page_size = page_size
+        self.token_key = token_key
+        self.limit_key = limit_key
+
+    def paginate(self, **kwargs):
+        config = kwargs.pop('PaginationConfig', {})
+        kwargs[self.limit_key] = config.get('PageSize') or self.page_size
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            token = page.get(self.token_key)
+            if not token:
+                return
+            kwargs[self.token_key] = token
+
+
+class FakeClient(object):
+
+    PAGINATORS = {}
+    TOKEN_KEY = 'NextToken'
+    LIMIT_KEY = 'MaxResults'
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, operation_name), self.aws.page_size, self.TOKEN_KEY, self.LIMIT_KEY)
+
+    def can_paginate(self, operation_name):
+        return operation_name in self.PAGINATORS
+
+    def _page(self, operation, items, kwargs, key):
+
+        """ slices items as one page of the response """
+
+        size = kwargs.get(self.LIMIT_KEY)
+        paginated = size is not None or self.TOKEN_KEY in kwargs or operation in self.aws.always_paginate
+        if not paginated:
+            return {key: items}
+
+        size = min(size or self.aws.page_size, self.aws.page_size)
+        start = int(kwargs.get(self.TOKEN_KEY) or 0)
+        response = {key: items[start:start + size]}
+        if start + size < len(items):
+            response[self.TOKEN_KEY] = str(start + size)
+        return response
+
+
+class FakeEC2(FakeClient):
+
+    PAGINATORS = ('describe_images', 'describe_snapshots', 'describe_instances',
+                  'describe_launch_templates', 'describe_launch_template_versions')
+
+    IMAGE_FILTERS = {
+        'image-id': lambda i: [i['ImageId']],
+        'name': lambda i: [i['Name']],
+        'state': lambda i: [i['State']],
+    }
+    SNAPSHOT_FILTERS = {
+        'snapshot-id': lambda s: [s['SnapshotId']],
+        'status': lambda s: [s['State']],
+        'description': lambda s: [s['Description']],
+    }
+    INSTANCE_FILTERS = {
+        'instance-id': lambda i: [i['InstanceId']],
+        'image-id': lambda i: [i['ImageId']],
+        'instance-state-name': lambda i: [i['State']['Name']],
+    }
+
+    def describe_images(self, Owners=None, ImageIds=None, Filters=None, **kwargs):
+        self.aws.call('DescribeImages')
+        with self.aws.lock:
+            images = list(self.aws.images.values())
+        if ImageIds:
+            wanted = set(ImageIds)
+            images = [i for i in images if i['ImageId'] in wanted]
+        images = [i for i in images if matches_filters(i, Filters, self.IMAGE_FILTERS)]
+        return self._page('describe_images', images, kwargs, 'Images')
+
+    def describe_image_attribute(self, ImageId, Attribute):
+        self.aws.call('DescribeImageAttribute')
+        image = self.aws.images.get(ImageId)
+        if image is None:
+            raise client_error('InvalidAMIID.NotFound', 'DescribeImageAttribute')
+        return {
+            'ImageId': ImageId,
+            'LaunchPermissions': [{'UserId': a} for a in self.aws.launch_permissions.get(ImageId, [])],
+        }
+
+    def deregister_image(self, ImageId):
+        self.aws.call('DeregisterImage')
+        with self.aws.lock:
+            image = self.aws.images.pop(ImageId, None)
+            if image is None:
+                raise client_error('InvalidAMIID.NotFound', 'DeregisterImage')
+            for snapshot_id in self.aws.image_snapshots(image):
+                self.aws.snapshot_images[snapshot_id].discard(ImageId)
+        return {}
+
+    def describe_snapshots(self, OwnerIds=None, SnapshotIds=None, Filters=None, **kwargs):
+        self.aws.call('DescribeSnapshots')
+        with self.aws.lock:
+            snapshots = list(self.aws.snapshots.values())
+        if SnapshotIds:
+            wanted = set(SnapshotIds)
+            snapshots = [s for s in snapshots if s['SnapshotId'] in wanted]
+        snapshots = [s for s in snapshots if matches_filters(s, Filters, self.SNAPSHOT_FILTERS)]
+        return self._page('describe_snapshots', snapshots, kwargs, 'Snapshots')
+
+    def delete_snapshot(self, SnapshotId):
+        self.aws.call('DeleteSnapshot')
+        with self.aws.lock:
+            if SnapshotId not in self.aws.snapshots:
+                raise client_error('InvalidSnapshot.NotFound', 'DeleteSnapshot')
+            if self.aws.snapshot_images.get(SnapshotId):
+                raise client_error('InvalidSnapshot.InUse', 'DeleteSnapshot')
+            del self.aws.snapshots[SnapshotId]
+        return {}
+
+    def describe_instances(self, Filters=None, InstanceIds=None, **kwargs):
+        self.aws.call('DescribeInstances')
+        instances = self.aws.instances
+        if InstanceIds:
+            wanted = set(InstanceIds)
+            instances = [i for i in instances if i['InstanceId'] in wanted]
+        instances = [i for i in instances if matches_filters(i, Filters, self.INSTANCE_FILTERS)]
+        page = self._page('describe_instances', instances, kwargs, 'Instances')
+        page['Reservations'] = [{'Instances': [i]} for i in page.pop('Instances')]
+        return page
+
+    def create_tags(self, Resources, Tags):
+        self.aws.call('CreateTags')
+        if len(Resources) > 1000:
+            raise client_error('InvalidParameterValue', 'CreateTags', 'too many resources')
+        with self.aws.lock:
+            for resource in Resources:
+                item = self.aws.images.get(resource) or self.aws.snapshots.get(resource)
+                if item is None:
+                    raise client_error('InvalidID', 'CreateTags')
+                tags = dict((t['Key'], t['Value']) for t in item.get('Tags', []))
+                tags.update((t['Key'], t['Value']) for t in Tags)
+                item['Tags'] = [{'Key': k, 'Value': v} for k, v in tags.items()]
+        return {}
+
+    def describe_launch_templates(self, LaunchTemplateNames=None, **kwargs):
+        self.aws.call('DescribeLaunchTemplates')
+        templates = [{'LaunchTemplateName': name} for name in sorted(self.aws.launch_templates)]
+        if LaunchTemplateNames:
+            templates = [t for t in templates if t['LaunchTemplateName'] in LaunchTemplateNames]
+        return self._page('describe_launch_templates', templates, kwargs, 'LaunchTemplates')
+
+    def describe_launch_template_versions(self, LaunchTemplateName=None, Versions=None, **kwargs):
+        self.aws.call('DescribeLaunchTemplateVersions')
+        names = [LaunchTemplateName] if LaunchTemplateName else sorted(self.aws.launch_templates)
+        versions = [{
+            'LaunchTemplateName': name,
+            'VersionNumber': 1,
+            'DefaultVersion': True,
+            'LaunchTemplateData': {'ImageId': self.aws.launch_templates[name]},
+        } for name in names if name in self.aws.launch_templates]
+        return self._page('describe_launch_template_versions', versions, kwargs, 'LaunchTemplateVersions')
+
+
+class FakeAutoScaling(FakeClient):
+
+    PAGINATORS = ('describe_auto_scaling_groups', 'describe_launch_configurations')
+    LIMIT_KEY = 'MaxRecords'
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames=None, **kwargs):
+        self.aws.call('DescribeAutoScalingGroups')
+        groups = self.aws.auto_scaling_groups
+        if AutoScalingGroupNames:
+            groups = [g for g in groups if g['AutoScalingGroupName'] in AutoScalingGroupNames]
+        return self._page('describe_auto_scaling_groups', groups, kwargs, 'AutoScalingGroups')
+
+    def describe_launch_configurations(self, LaunchConfigurationNames=None, **kwargs):
+        self.aws.call('DescribeLaunchConfigurations')
+        if LaunchConfigurationNames and len(LaunchConfigurationNames) > 50:
+            raise client_error('ValidationError', 'DescribeLaunchConfigurations',
+                               'at most 50 launch configuration names')
+        configurations = self.aws.launch_configurations
+        if LaunchConfigurationNames:
+            configurations = [c for c in configurations
+                              if c['LaunchConfigurationName'] in LaunchConfigurationNames]
+        return self._page('describe_launch_configurations', configurations, kwargs, 'LaunchConfigurations')
+
+
+class FakeAWS(object):
+
+    def __init__(self, seed=0, latency=0.0, throttle_rate=0.0, failure_rate=0.0,
+                 page_size=1000, max_attempts=10, realtime=False, always_paginate=()):
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.page_size = page_size
+        self.max_attempts = max_attempts
+        self.realtime = realtime
+        self.always_paginate = set(always_paginate)
+
+        self.lock = threading.RLock()
+        self.clock = 0.0
+        self.stats = Counter()
+
+        self.images = dict()
+        self.snapshots = dict()
+        self.snapshot_images = dict()
+        self.instances = []
+        self.auto_scaling_groups = []
+        self.launch_configurations = []
+        self.launch_templates = dict()
+        self.launch_permissions = dict()
+
+        self.ec2 = FakeEC2(self)
+        self.asg = FakeAutoScaling(self)
+
+    def sleep(self, seconds):
+        if self.realtime:
+            time.sleep(seconds)
+        else:
+            with self.lock:
+                self.clock += seconds
+
+    def call(self, operation):
+
+        """
+        Simulates one API call: latency, throttling with botocore like
+        retries and failure injection
+        """
+
+        for attempt in range(self.max_attempts):
+            self.sleep(self.latency)
+            with self.lock:
+                self.stats[operation] += 1
+                throttled = self.random.random() < self.throttle_rate
+                failure_rate = self.failure_rate
+                if isinstance(failure_rate, dict):
+                    failure_rate = failure_rate.get(operation, 0)
+                failed = not throttled and self.random.random() < failure_rate
+                if throttled:
+                    self.stats[operation + '.throttled'] += 1
+                if failed:
+                    self.stats[operation + '.failed'] += 1
+            if failed:
+                raise client_error('InternalError', operation)
+            if not throttled:
+                return
+            with self.lock:
+                self.stats[operation + '.retried'] += 1
+            self.sleep(min(20, 0.05 * 2 ** attempt))
+
+        raise client_error(THROTTLING_ERROR, operation, 'Rate exceeded')
+
+    @staticmethod
+    def image_snapshots(image):
+        return [b['Ebs']['SnapshotId'] for b in image.get('BlockDeviceMappings', [])
+                if 'Ebs' in b and 'SnapshotId' in b['Ebs']]
+
+    def populate(self, images=0, snapshots_per_image=1, orphan_snapshots=0, instances=0,
+                 groups=10, owner_id='123456789012', start=datetime(2016, 1, 1)):
+
+        """ creates a deterministic inventory """
+
+        for i in range(images):
+            image_id = 'ami-{0:017x}'.format(i)
+            created = start + timedelta(minutes=i)
+            block_devices = []
+            for j in range(snapshots_per_image):
+                snapshot_id = 'snap-{0:017x}'.format(i * snapshots_per_image + j)
+                self.snapshots[snapshot_id] = {
+                    'SnapshotId': snapshot_id,
+                    'OwnerId': owner_id,
+                    'State': 'completed',
+                    'VolumeSize': 8,
+                    'Description': 'Created by CreateImage(i-0) for {0}'.format(image_id),
+                }
+                self.snapshot_images.setdefault(snapshot_id, set()).add(image_id)
+                block_devices.append({
+                    'DeviceName': '/dev/xvd' + chr(ord('a') + j),
+                    'Ebs': {'SnapshotId': snapshot_id, 'VolumeSize': 8, 'VolumeType': 'gp2'},
+                })
+            self.images[image_id] = {
+                'ImageId': image_id,
+                'Name': 'app{0}-{1}'.format(i % groups, created.strftime('%Y%m%d%H%M')),
+                'OwnerId': owner_id,
+                'State': 'available',
+                'CreationDate': created.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'BlockDeviceMappings': block_devices,
+                'Tags': [
+                    {'Key': 'environment', 'Value': ('prod', 'test')[i % 2]},
+                    {'Key': 'role', 'Value': 'app{0}'.format(i % groups)},
+                ],
+            }
+
+        for k in range(orphan_snapshots):
+            snapshot_id = 'snap-orphan{0:012x}'.format(k)
+            self.snapshots[snapshot_id] = {
+                'SnapshotId': snapshot_id,
+                'OwnerId': owner_id,
+                'State': 'completed',
+                'VolumeSize': 8,
+                'Description': 'Created by CreateImage(i-0) for ami-deleted',
+            }
+
+        image_ids = sorted(self.images)
+        for n in range(instances):
+            self.instances.append({
+                'InstanceId': 'i-{0:017x}'.format(n),
+                'ImageId': image_ids[self.random.randrange(len(image_ids))] if image_ids else 'ami-0',
+                'LaunchTime': start + timedelta(hours=n),
+                'State': {'Name': 'running'},
+                'Placement': {'AvailabilityZone': 'us-west-2a'},
+                'Tags': [],
+            })
+
+        return self
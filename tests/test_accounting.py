@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from amicleaner import accounting
+from amicleaner.accounting import Pricing, PricingError, StorageReport
+from amicleaner.core import SnapshotIndex
+from amicleaner.resources.models import AMI, AWSBlockDevice
+from amicleaner.utils import Printer, parse_args
+
+
+def _ami(ami_id, *snapshots):
+    ami = AMI()
+    ami.id = ami_id
+    for snapshot_id, size, volume_type in snapshots:
+        block_device = AWSBlockDevice()
+        block_device.snapshot_id = snapshot_id
+        block_device.volume_size = size
+        block_device.volume_type = volume_type
+        ami.block_device_mappings.append(block_device)
+    return ami
+
+
+PRICING = {
+    "default": 0.05,
+    "volume_types": {"io1": 0.1},
+    "regions": {"eu-west-1": {"default": 0.06}},
+}
+
+
+def test_pricing():
+    pricing = Pricing(PRICING)
+    assert pricing.price("us-west-2", "gp2") == 0.05
+    assert pricing.price("us-west-2", "io1") == 0.1
+    assert pricing.price("eu-west-1", "io1") == 0.06
+    assert Pricing({}).price("us-west-2", "gp2") == 0
+
+    with pytest.raises(PricingError):
+        Pricing([])
+    with pytest.raises(PricingError):
+        Pricing({"default": "cheap"})
+
+
+def test_pricing_file(tmpdir):
+    path = tmpdir.join("pricing.json")
+    path.write(json.dumps(PRICING))
+    assert parse_args(["--pricing", str(path)]).pricing.price("us-west-2", "io1") == 0.1
+
+    path.write("{")
+    with pytest.raises(SystemExit):
+        parse_args(["--pricing", str(path)])
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_storage_report(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(accounting, "numpy", None)
+
+    kept = _ami("ami-kept", ("snap-kept", 100, "gp2"))
+    web = [_ami("ami-1", ("snap-kept", 100, "gp2"), ("snap-1", 8, "gp2")),
+           _ami("ami-2", ("snap-2", 20, "io1"), ("snap-shared", 10, "gp2"))]
+    db = [_ami("ami-3", ("snap-shared", 10, "gp2"), ("snap-3", 50, "gp2"))]
+    empty = [_ami("ami-4")]
+    index = SnapshotIndex.from_amis([kept] + web + db + empty)
+
+    groups = {"web": web, "db": db, "empty": empty}
+    report = StorageReport.from_groups(groups, "us-west-2", index, Pricing(PRICING))
+
+    assert report.by_group() == {
+        "web": (3, 38.0, pytest.approx(8 * 0.05 + 20 * 0.1 + 10 * 0.05)),
+        "db": (1, 50.0, pytest.approx(50 * 0.05)),
+        "empty": (0, 0.0, 0.0),
+    }
+    assert report.total() == (4, 88.0, pytest.approx(5.4))
+    assert report.ranked_groups() == ["web", "db", "empty"]
+
+    unpriced = StorageReport.from_groups(groups, "us-west-2", index)
+    assert not unpriced.priced
+    assert unpriced.ranked_groups() == ["db", "web", "empty"]
+
+    other = StorageReport.from_groups({"web": web}, "eu-west-1", None, Pricing(PRICING))
+    regions = report.merge(other).by_region()
+    assert regions["us-west-2"][:2] == (4, 88.0)
+    assert regions["eu-west-1"] == (4, 138.0, pytest.approx(138 * 0.06))
+
+    assert Printer.print_report(groups, storage=report) is None
+    assert Printer.print_report(groups, storage=unpriced) is None
@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import json
+import subprocess
+import sys
 
 import boto3
+import pytest
 from moto import mock_ec2, mock_autoscaling
 from datetime import datetime
 
 from amicleaner.cli import App
 from amicleaner.fetch import Fetcher
 from amicleaner.utils import parse_args, Printer
-from amicleaner.resources.models import AMI, AWSEC2Instance
+from amicleaner.resources.models import AMI, AWSEC2Instance, PlanResult
 
 
 @mock_ec2
@@ -156,6 +159,32 @@ def test_fetch_candidates():
     assert amis_dict.get('unused-ami') is not None
 
 
+@mock_ec2
+@mock_autoscaling
+def test_fetch_launch_configurations():
+    ec2 = boto3.client('ec2')
+    asg = boto3.client('autoscaling')
+    reservation = ec2.run_instances(ImageId="ami-1234abcd", MinCount=1, MaxCount=1)
+    instance_id = reservation["Instances"][0]["InstanceId"]
+    image_ids = [ec2.create_image(InstanceId=instance_id, Name="image-{0}".format(i))["ImageId"]
+                 for i in range(3)]
+
+    zones = [asg.meta.region_name + "a"]
+    for i, image_id in enumerate(image_ids):
+        asg.create_launch_configuration(LaunchConfigurationName="lc-{0}".format(i),
+                                        ImageId=image_id, InstanceType="t2.micro")
+    asg.create_auto_scaling_group(AutoScalingGroupName="zeroed", LaunchConfigurationName="lc-0",
+                                  MinSize=0, MaxSize=1, DesiredCapacity=0, AvailabilityZones=zones)
+    asg.create_auto_scaling_group(AutoScalingGroupName="running", LaunchConfigurationName="lc-1",
+                                  MinSize=0, MaxSize=1, DesiredCapacity=1, AvailabilityZones=zones)
+
+    f = Fetcher(ec2=ec2, autoscaling=asg)
+    assert f.fetch_launch_configurations() == dict(("lc-{0}".format(i), image_id)
+                                                   for i, image_id in enumerate(image_ids))
+    assert f.fetch_unattached_lc() == [image_ids[2]]
+    assert f.fetch_zeroed_asg_lc() == [image_ids[0]]
+
+
 def test_parse_args_no_args():
     parser = parse_args([])
     assert parser.force_delete is False
@@ -166,6 +195,7 @@ def test_parse_args_no_args():
     assert parser.mapping_values is None
     assert parser.keep_previous is 4
     assert parser.ami_min_days is -1
+    assert parser.workers == 1
 
 
 def test_parse_args():
@@ -197,6 +227,52 @@ def test_print_report():
         assert Printer.print_report(candidates, full_report=True) is None
 
 
+def test_print_report_max_rows(capsys):
+    amis = []
+    for i in range(5):
+        ami = AMI.object_with_json({"ImageId": "ami-{0}".format(i), "Name": "x" * 200,
+                                    "CreationDate": "2016-01-0{0}T00:00:00.000Z".format(5 - i), "Tags": []})
+        amis.append(ami)
+
+    Printer.print_report({"test": amis}, full_report=True, max_rows=2)
+    out = capsys.readouterr().out
+    # oldest first, long names cut
+    assert out.index("ami-4") < out.index("ami-3")
+    assert "ami-2" not in out and "... and 3 more AMIs" in out
+    assert "x" * 77 + "..." in out and "x" * 81 not in out
+    assert "|    test    |     5      |" in out
+
+
+def test_report_max_rows_option(capsys):
+    assert parse_args(["--report-max-rows", "3"]).report_max_rows == 3
+    for value in ("0", "-2", "x"):
+        with pytest.raises(SystemExit):
+            parse_args(["--report-max-rows", value])
+
+    # ids only known from the exclusion rules, none shown
+    Printer.print_ami_ids_group("excluded", {}, ["ami-1", "ami-2"], max_rows=0)
+    assert "... and 2 more AMIs" in capsys.readouterr().out
+
+
+def test_report_candidates_groups(capsys):
+    def ami(ami_id, snapshot_id):
+        return AMI.object_with_json({
+            "ImageId": ami_id, "CreationDate": "2016-01-01T00:00:00.000Z",
+            "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": snapshot_id, "VolumeSize": 8}}],
+        })
+
+    app = App(parse_args([]))
+    app.available_amis = dict()
+    app.report_candidates([
+        PlanResult(ami("ami-1", "snap-1"), "web", PlanResult.KEPT_BY_KEEP_PREVIOUS),
+        PlanResult(ami("ami-2", "snap-2"), "web", None),
+        PlanResult(ami("ami-3", "snap-3"), "db", None),
+        PlanResult(ami("ami-4", "snap-4"), "", PlanResult.KEPT_BY_MAPPING),
+    ])
+    assert sorted(app.last_storage.by_group()) == ["db", "web"]
+    assert app.last_storage.by_group()["web"][0] == 1
+
+
 def test_print_failed_snapshots():
     assert Printer.print_failed_snapshots({}) is None
     assert Printer.print_failed_snapshots(["ami-one", "ami-two"]) is None
@@ -209,3 +285,18 @@ def test_print_orphan_snapshots():
 
 def test_print_defaults():
     assert App(parse_args([])).print_defaults() is None
+
+
+def test_startup_imports():
+    """ --version, --help and arguments errors must not pay boto3 import """
+
+    code = (
+        "import sys\n"
+        "from amicleaner.cli import App\n"
+        "from amicleaner.utils import parse_args\n"
+        "App(parse_args(['--keep-previous', '1'])).print_version()\n"
+        "heavy = ['boto3', 'botocore', 'prettytable', 'blessings', 'numpy']\n"
+        "print([m for m in heavy if m in sys.modules])\n"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code]).decode()
+    assert output.splitlines()[-1] == "[]"
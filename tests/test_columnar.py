@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+
+from amicleaner import columnar
+from amicleaner.columnar import AMIColumns
+from amicleaner.core import AMICleaner
+from amicleaner.resources.models import AMI
+
+
+def _ami(ami_id, creation_date):
+    ami = AMI()
+    ami.id = ami_id
+    ami.creation_date = creation_date
+    return ami
+
+
+def _mapped():
+    recent = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    return {
+        "ubuntu": [
+            _ami("ami-1", "2016-01-10T00:00:00.000Z"),
+            _ami("ami-2", "2016-01-12T00:00:00.000Z"),
+            _ami("ami-3", "2016-01-11T00:00:00.000Z"),
+            _ami("ami-4", recent),
+        ],
+        "debian": [_ami("ami-5", "2016-01-10T00:00:00.000Z")],
+        "": [_ami("ami-6", "2016-01-10T00:00:00.000Z")],
+    }
+
+
+def _ids(reductions):
+    return dict(
+        (name, tuple([ami.id for ami in amis] for amis in lists))
+        for name, *lists in reductions
+    )
+
+
+def test_reduce_empty():
+    assert AMIColumns.from_mapped({}).reduce(2, 5) == []
+
+
+def test_reduce_columns():
+    reductions = _ids(AMIColumns.from_mapped(_mapped()).reduce(keep_previous=1, ami_min_days=10))
+
+    assert reductions["ubuntu"] == (["ami-3", "ami-1"], ["ami-2"], ["ami-4"])
+    assert reductions["debian"] == ([], ["ami-5"], [])
+    assert reductions[""] == (["ami-6"], [], [])
+
+
+def test_reduce_columns_matches_reduce_candidates():
+    mapped = _mapped()
+    cleaner = AMICleaner()
+    for keep_previous in (0, 1, 2, 5):
+        for min_days in (-1, 10):
+            reductions = AMIColumns.from_mapped(mapped).reduce(keep_previous, min_days)
+            for name, reduced, kept_previous, kept_min_days in reductions:
+                if not name:
+                    continue
+                expected = cleaner.reduce_candidates(mapped[name], keep_previous, min_days)
+                assert sorted(a.id for a in reduced) == sorted(a.id for a in expected[0])
+                assert sorted(a.id for a in kept_previous) == sorted(a.id for a in expected[1])
+                assert sorted(a.id for a in kept_min_days) == sorted(a.id for a in expected[2])
+
+
+def test_reduce_columns_without_numpy(monkeypatch):
+    expected = _ids(AMIColumns.from_mapped(_mapped()).reduce(2, 10))
+    monkeypatch.setattr(columnar, "numpy", None)
+    assert _ids(AMIColumns.from_mapped(_mapped()).reduce(2, 10)) == expected
+
+
+def test_reduce_columns_with_datetimes():
+    mapped = {"test": [_ami("ami-1", datetime(2016, 1, 10)), _ami("ami-2", datetime(2016, 1, 12))]}
+    reductions = _ids(AMIColumns.from_mapped(mapped).reduce(keep_previous=1))
+    assert reductions["test"] == (["ami-1"], ["ami-2"], [])
+
+
+def test_reduce_columns_without_dates(monkeypatch):
+    mapped = {"test": [_ami("ami-1", None), _ami("ami-2", "2016-01-12T00:00:00.000Z"), _ami("ami-3", None)]}
+    assert _ids(AMIColumns.from_mapped(mapped).reduce(keep_previous=1, ami_min_days=10))["test"] == \
+        (["ami-1", "ami-3"], ["ami-2"], [])
+
+    undated = {"test": [_ami("ami-1", None), _ami("ami-2", None)]}
+    assert len(_ids(AMIColumns.from_mapped(undated).reduce(keep_previous=1, ami_min_days=10))["test"][0]) == 1
+    monkeypatch.setattr(columnar, "numpy", None)
+    assert len(_ids(AMIColumns.from_mapped(undated).reduce(keep_previous=1, ami_min_days=10))["test"][0]) == 1
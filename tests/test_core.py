@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import copy
 from datetime import datetime
 from moto import mock_ec2
 
-from amicleaner.core import AMICleaner, OrphanSnapshotCleaner
-from amicleaner.resources.models import AMI, AWSTag, AWSBlockDevice
+from amicleaner.core import AMICleaner, OrphanSnapshotCleaner, SnapshotIndex, TagIndex
+from amicleaner.resources.models import AMI, AWSTag, AWSBlockDevice, InternTable
 
 
 def test_map_candidates_with_null_arguments():
@@ -180,6 +181,83 @@ def test_map_with_tag_exclusions():
     assert len(grouped_amis.get("web-server")) == 1
 
 
+def _tagged_ami(ami_id, **tags):
+    ami = AMI()
+    ami.id = ami_id
+    for key, value in tags.items():
+        tag = AWSTag()
+        tag.key = key
+        tag.value = value
+        ami.tags.append(tag)
+    return ami
+
+
+def test_tag_index():
+    amis = [
+        _tagged_ami("ami-1", env="prod", role="web"),
+        _tagged_ami("ami-2", env="preprod", role="web"),
+        _tagged_ami("ami-3", team="prod"),
+    ]
+    index = TagIndex.from_amis(amis)
+
+    assert index.ids("role", "web") == {"ami-1", "ami-2"}
+    assert index.ids_with_values({"prod"}) == {"ami-1", "ami-3"}
+    assert index.ids_with_values({"prod"}, ["env"]) == {"ami-1"}
+    assert index.groups(["env", "role"]) == {"ami-1": "prod.web", "ami-2": "preprod.web"}
+    assert index.groups() == {"ami-1": "prod.web", "ami-2": "preprod.web", "ami-3": "prod"}
+
+    index.remove(amis[0])
+    assert index.ids("env", "prod") == set()
+    assert index.groups(["role"]) == {"ami-2": "web"}
+
+
+def test_intern_table():
+    strings = InternTable()
+    payloads = [
+        {
+            "ImageId": "ami-{0}".format(i),
+            "State": "".join(["avail", "able"]),
+            "Tags": [{"Key": "".join(["ro", "le"]), "Value": "web"}],
+            "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {"VolumeType": "".join(["gp", "3"])}}],
+        }
+        for i in range(2)
+    ]
+    originals = [copy.deepcopy(payload) for payload in payloads]
+    images = [strings.intern_image(payload) for payload in payloads]
+
+    assert images[0]["State"] is images[1]["State"]
+    assert images[0]["Tags"][0]["Key"] is images[1]["Tags"][0]["Key"]
+    assert images[0]["BlockDeviceMappings"][0]["Ebs"]["VolumeType"] is \
+        images[1]["BlockDeviceMappings"][0]["Ebs"]["VolumeType"]
+    # the payloads given are not changed
+    assert payloads == originals and images[0] is not payloads[0]
+    assert payloads[0]["State"] is not payloads[1]["State"]
+
+    # every AMI has its own tags, made of the shared strings
+    first, second = [AMI.object_with_json(image).tags[0] for image in images]
+    assert first is not second and first.key is second.key
+    first.value = "api"
+    assert (second.key, second.value) == ("role", "web")
+
+
+def test_map_with_tag_exclusions_exact_match():
+    amis = [
+        _tagged_ami("ami-1", env="prod"),
+        _tagged_ami("ami-2", env="preprod"),
+        _tagged_ami("ami-3", role="web"),
+    ]
+
+    grouping_strategy = {"key": "tags", "values": ["env"], "excluded": ["prod", "dev"]}
+    grouped_amis = AMICleaner().map_candidates(amis, grouping_strategy)
+    assert [ami.id for ami in grouped_amis[""]] == ["ami-1", "ami-3"]
+    assert [ami.id for ami in grouped_amis["preprod"]] == ["ami-2"]
+
+    grouping_strategy = {"key": "tags", "values": ["env"], "excluded": ["<all values>"]}
+    grouped_amis = AMICleaner().map_candidates(amis, grouping_strategy)
+    assert [ami.id for ami in grouped_amis[""]] == ["ami-1", "ami-2"]
+    assert [ami.id for ami in grouped_amis["<no tag>"]] == ["ami-3"]
+
+
 def test_reduce_without_rotation_number():
     # creating tests objects
     first_ami = AMI()
@@ -285,6 +363,85 @@ def test_fetch_snapshots_from_none():
     assert len(cleaner.fetch()) == 0
 
 
+def test_snapshot_index_release():
+    index = SnapshotIndex.from_images_json([
+        {"ImageId": "ami-1", "BlockDeviceMappings": [
+            {"Ebs": {"SnapshotId": "snap-shared"}}, {"Ebs": {"SnapshotId": "snap-1"}}]},
+        {"ImageId": "ami-2", "BlockDeviceMappings": [
+            {"Ebs": {"SnapshotId": "snap-shared"}}, {"VirtualName": "ephemeral0"}]},
+    ])
+
+    assert index.is_used("snap-shared") and index.is_used("snap-1")
+    assert not index.is_used("snap-orphan")
+    assert index.used_by("snap-shared") == {"ami-1", "ami-2"}
+
+    assert index.release("ami-1") == ["snap-1"]
+    assert index.used_by("snap-shared") == {"ami-2"}
+    assert index.release("ami-2") == ["snap-shared"]
+    assert not index.is_used("snap-shared")
+    assert index.release("ami-unknown", ["snap-2"]) == ["snap-2"]
+
+
+def test_remove_amis_keeps_shared_snapshots():
+    class FakeEC2(object):
+        def __init__(self):
+            self.deleted = []
+
+        def deregister_image(self, ImageId):
+            pass
+
+        def delete_snapshot(self, SnapshotId):
+            self.deleted.append(SnapshotId)
+
+    def ami_with_snapshots(ami_id, snapshot_ids):
+        ami = AMI()
+        ami.id = ami_id
+        for snapshot_id in snapshot_ids:
+            block_device = AWSBlockDevice()
+            block_device.snapshot_id = snapshot_id
+            ami.block_device_mappings.append(block_device)
+        return ami
+
+    kept = ami_with_snapshots("ami-kept", ["snap-kept"])
+    first = ami_with_snapshots("ami-1", ["snap-kept", "snap-1", "snap-both"])
+    second = ami_with_snapshots("ami-2", ["snap-both"])
+    index = SnapshotIndex.from_amis([kept, first, second])
+
+    ec2 = FakeEC2()
+    assert AMICleaner(ec2=ec2).remove_amis([first, second], index) == []
+    assert ec2.deleted == ["snap-1", "snap-both"]
+
+
+@mock_ec2
+def test_mark_amis():
+    import boto3
+    from amicleaner.fetch import Fetcher
+    from amicleaner.resources.config import PENDING_DELETE_TAG
+
+    ec2 = boto3.client('ec2')
+    reservation = ec2.run_instances(ImageId="ami-1234abcd", MinCount=1, MaxCount=1)
+    instance_id = reservation["Instances"][0]["InstanceId"]
+    image_ids = [ec2.create_image(InstanceId=instance_id, Name="image-{0}".format(i))["ImageId"]
+                 for i in range(3)]
+
+    fetcher = Fetcher(ec2=ec2)
+    amis = fetcher.fetch_available_amis()
+    cleaner = AMICleaner(ec2=ec2)
+    assert cleaner.mark_amis([amis[image_ids[0]], amis[image_ids[1]]], "2016-01-01T00:00:00Z") == 2
+
+    marked = fetcher.fetch_marked_amis()
+    assert sorted(ami.id for ami in marked) == sorted(image_ids[:2])
+    assert all((PENDING_DELETE_TAG, "2016-01-01T00:00:00Z") in [(tag.key, tag.value) for tag in ami.tags]
+               for ami in marked)
+
+    # already marked AMIs keep their marking date
+    assert cleaner.mark_amis(marked, "2017-01-01T00:00:00Z") == 0
+
+    assert cleaner.remove_amis(marked, SnapshotIndex.from_amis(marked), workers=2) == []
+    assert fetcher.fetch_marked_amis() == []
+    assert list(fetcher.fetch_available_amis()) == [image_ids[2]]
+
+
 """
 @mock_ec2
 def test_fetch_snapshots():
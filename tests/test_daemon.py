@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import boto3
+from moto import mock_ec2, mock_autoscaling
+
+from amicleaner.cli import App
+from amicleaner.core import AMICleaner
+from amicleaner.daemon import Daemon, Metrics
+from amicleaner.engine import Engine
+from amicleaner.fetch import Fetcher
+from amicleaner.utils import parse_args
+
+from .fake_aws import FakeAWS
+
+
+def test_metrics_render():
+    metrics = Metrics()
+    metrics.set("amicleaner_amis_scanned", 3)
+    metrics.set("amicleaner_candidates", 2, group='my "group"')
+    metrics.inc("amicleaner_amis_deleted_total", 2)
+    metrics.inc("amicleaner_amis_deleted_total")
+    metrics.observe("amicleaner_api_call_duration_seconds", 0.2, operation="DescribeImages")
+
+    output = metrics.render()
+    assert "amicleaner_amis_scanned 3" in output
+    assert 'amicleaner_candidates{group="my \\"group\\""} 2' in output
+    assert "amicleaner_amis_deleted_total 3" in output
+    assert 'amicleaner_api_call_duration_seconds_bucket{operation="DescribeImages",le="0.1"} 0' in output
+    assert 'amicleaner_api_call_duration_seconds_bucket{operation="DescribeImages",le="0.25"} 1' in output
+    assert 'amicleaner_api_call_duration_seconds_count{operation="DescribeImages"} 1' in output
+
+    metrics.clear("amicleaner_candidates")
+    assert "amicleaner_candidates{" not in metrics.render()
+
+
+def test_metrics_throttles():
+    metrics = Metrics()
+    response = (None, {"Error": {"Code": "RequestLimitExceeded"}})
+    assert metrics._needs_retry(response=response) is None
+    assert metrics._needs_retry(response=None) is None
+    assert "amicleaner_api_throttles_total{operation=\"\"} 1" in metrics.render()
+
+
+@mock_ec2
+@mock_autoscaling
+def test_daemon_cycles():
+    ec2 = boto3.client('ec2')
+    reservation = ec2.run_instances(ImageId="ami-1234abcd", MinCount=1, MaxCount=1)
+    instance = reservation["Instances"][0]
+    for i in range(3):
+        ec2.create_image(InstanceId=instance.get("InstanceId"), Name="test-ami")
+
+    parser = parse_args(['--keep-previous', '1', '--mapping-key', 'name',
+                         '--mapping-values', 'test-ami', '--daemon',
+                         '--interval', '0', '--metrics-port', '0', '-f',
+                         '--aws-region', ec2.meta.region_name])
+    app = App(parser)
+    daemon = Daemon(app)
+    daemon.run(cycles=2)
+
+    output = daemon.metrics.render()
+    assert "amicleaner_cycles_total 2" in output
+    assert "amicleaner_amis_deleted_total 2" in output
+    assert "amicleaner_amis_scanned 1" in output
+    assert len(app.fetcher.fetch_available_amis()) == 1
+
+
+def test_daemon_counts_deregistered():
+    aws = FakeAWS(seed=1, failure_rate={'DeregisterImage': 1.0}).populate(images=4, groups=1)
+    app = App(parse_args(['--keep-previous', '1', '--mapping-key', 'tags', '--mapping-values', 'role',
+                          '--daemon', '-f']))
+    app._engine = Engine(mapping_strategy=app.mapping_strategy, keep_previous=1,
+                         fetcher=Fetcher(ec2=aws.ec2, autoscaling=aws.asg), cleaner=AMICleaner(ec2=aws.ec2))
+    daemon = Daemon(app)
+    daemon.run_once()
+
+    output = daemon.metrics.render()
+    assert "amicleaner_amis_deleted_total 0" in output
+    assert len(aws.images) == 4
+
+
+def test_daemon_marks():
+    aws = FakeAWS(seed=2).populate(images=4, groups=1)
+    app = App(parse_args(['--keep-previous', '1', '--mapping-key', 'tags', '--mapping-values', 'role',
+                          '--daemon', '--mark', '-f']))
+    app._engine = Engine(mapping_strategy=app.mapping_strategy, keep_previous=1,
+                         fetcher=Fetcher(ec2=aws.ec2, autoscaling=aws.asg), cleaner=AMICleaner(ec2=aws.ec2))
+    daemon = Daemon(app)
+    daemon.run_once()
+
+    # tagged for a later sweep, nothing removed
+    output = daemon.metrics.render()
+    assert "amicleaner_amis_marked_total 3" in output
+    assert "\namicleaner_amis_deleted_total " not in output
+    assert len(aws.images) == 4 and aws.stats["DeleteSnapshot"] == 0
+    assert len(app.fetcher.fetch_marked_amis()) == 3
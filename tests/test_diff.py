@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from amicleaner.cli import App
+from amicleaner.core import AMICleaner
+from amicleaner.diff import RunState, RunStateError, transition_label
+from amicleaner.engine import Engine
+from amicleaner.fetch import Fetcher
+from amicleaner.utils import parse_args
+
+from .fake_aws import FakeAWS
+
+
+def _state(aws):
+    engine = Engine(keep_previous=1, mapping_strategy={"key": "tags", "values": ["role"], "excluded": []},
+                    fetcher=Fetcher(ec2=aws.ec2, autoscaling=aws.asg), cleaner=AMICleaner(ec2=aws.ec2))
+    scanned = list(engine.scan())
+    return RunState.from_results(scanned, engine.plan([r.ami for r in scanned if r.excluded_by is None]))
+
+
+def test_run_state_diff(tmpdir):
+    aws = FakeAWS(seed=5).populate(images=30, groups=3, instances=3)
+    path = str(tmpdir.join("state.json"))
+
+    first = _state(aws)
+    assert len(first) == 30
+    assert RunState.load(path).diff(first)["New candidates"]
+    first.save(path)
+
+    previous = RunState.load(path)
+    assert previous.digest == first.digest
+    assert previous.diff(_state(aws)) == {}
+
+    # a new AMI is the latest of its group, another one is deregistered
+    aws.populate(images=31, groups=3)
+    newest = sorted(aws.images)[-1]
+    gone = sorted(set(aws.images) - set(i['ImageId'] for i in aws.instances))[0]
+    del aws.images[gone]
+
+    changes = previous.diff(_state(aws))
+    assert changes[transition_label(None, "keep previous")] == [newest]
+    assert changes[transition_label("candidate", None)] == [gone]
+    assert len(changes[transition_label("keep previous", "candidate")]) == 1
+
+
+def test_run_state_merge():
+    old = RunState(["ami-1", "ami-2", "ami-3", "ami-5"], [0, 1, 0, 0], ["candidate", "instances"])
+    new = RunState(["ami-2", "ami-3", "ami-4", "ami-5"], [0, 1, 0, 2], ["candidate", "instances", "min day"])
+
+    assert old.diff(new) == {
+        "Gone since the previous run (was candidate)": ["ami-1"],
+        "Now candidates (were kept by instances)": ["ami-2"],
+        "Now protected (by instances)": ["ami-3"],
+        "New candidates": ["ami-4"],
+        "Now protected (by min day)": ["ami-5"],
+    }
+
+
+def test_transition_labels():
+    assert transition_label(None, "candidate") == "New candidates"
+    assert transition_label("candidate", "instances") == "Now protected (by instances)"
+    assert transition_label("instances", "candidate") == "Now candidates (were kept by instances)"
+
+
+def test_invalid_run_state(tmpdir):
+    path = tmpdir.join("state.json")
+    assert len(parse_args(["--diff", str(path)]).diff_state) == 0
+
+    for content in ("{", "[]", '{"version": 2}', '{"version": 1, "ids": ["ami-1"], "statuses": []}',
+                    '{"version": 1, "ids": ["ami-1"], "codes": [1], "statuses": ["candidate"]}'):
+        path.write(content)
+        with pytest.raises(RunStateError):
+            RunState.load(str(path))
+        with pytest.raises(SystemExit):
+            parse_args(["--diff", str(path)])
+
+
+def test_print_diff(tmpdir, capsys):
+    aws = FakeAWS(seed=6).populate(images=6, groups=2)
+    path = tmpdir.join("state.json")
+    for run in range(2):
+        app = App(parse_args(["--diff", str(path), "--keep-previous", "1"]))
+        app._engine = Engine(keep_previous=1, mapping_strategy={"key": "tags", "values": ["role"], "excluded": []},
+                             fetcher=Fetcher(ec2=aws.ec2, autoscaling=aws.asg), cleaner=AMICleaner(ec2=aws.ec2))
+        app.run_cli()
+    # each run stores its state, the first one reports every candidate as new
+    assert len(RunState.load(str(path))) == 6
+    assert "New candidates" in capsys.readouterr().out
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+from amicleaner.core import AMICleaner
+from amicleaner.engine import Engine, ScanResult, PlanResult, RemovalResult
+from amicleaner.fetch import Fetcher
+
+from .fake_aws import FakeAWS
+
+
+def _engine(aws, **kwargs):
+    return Engine(fetcher=Fetcher(ec2=aws.ec2, autoscaling=aws.asg),
+                  cleaner=AMICleaner(ec2=aws.ec2), **kwargs)
+
+
+def test_scan_plan_execute(capsys):
+    aws = FakeAWS(seed=1).populate(images=40, instances=5, groups=4)
+    engine = _engine(aws, keep_previous=2,
+                     mapping_strategy={"key": "tags", "values": ["role"], "excluded": ["app3"]})
+
+    scanned = list(engine.scan())
+    assert len(scanned) == 40
+    assert all(isinstance(r, ScanResult) for r in scanned)
+    in_use = set(i['ImageId'] for i in aws.instances)
+    assert set(r.ami.id for r in scanned if r.excluded_by == "instances") == in_use
+
+    candidates = [r.ami for r in scanned if r.excluded_by is None]
+    plan = list(engine.plan(candidates))
+    assert len(plan) == len(candidates)
+    assert all(isinstance(r, PlanResult) for r in plan)
+
+    report = PlanResult.report(plan)
+    assert all(r.reason == PlanResult.KEPT_BY_MAPPING for r in plan if r.ami.tags[1].value == "app3")
+    assert sorted(len(report["Excluded {0} (by keep previous)".format(group)]) for group in
+                  ("app0", "app1", "app2")) == [2, 2, 2]
+
+    removed = [r.ami for r in plan if r.removed]
+    results = list(engine.execute(removed, engine.snapshot_index, workers=4))
+    assert sorted(r.ami_id for r in results) == sorted(ami.id for ami in removed)
+    assert all(isinstance(r, RemovalResult) and r.deregistered and len(r.deleted_snapshots) == 1
+               for r in results)
+    assert len(aws.images) == 40 - len(removed)
+
+    # nothing is printed by the engine
+    assert capsys.readouterr().out == ""
+
+    # a second evaluation reuses the engine
+    assert [r for r in engine.plan() if r.removed] == []
+
+
+def test_execute_reports_errors():
+    aws = FakeAWS(seed=2, failure_rate={'DeregisterImage': 1.0}, max_attempts=1).populate(images=2)
+    engine = _engine(aws)
+    amis = [r.ami for r in engine.scan()]
+
+    results = list(engine.execute(amis))
+    assert [r.deregistered for r in results] == [False, False]
+    assert len(aws.images) == 2
+
+
+def test_keep_shared():
+    aws = FakeAWS(seed=4).populate(images=30, instances=4)
+    image_ids = sorted(aws.images)
+    in_use = set(i['ImageId'] for i in aws.instances)
+    shared = set(image_ids[i] for i in (3, 17, 29)) - in_use
+    for ami_id in shared:
+        aws.launch_permissions[ami_id] = ["210987654321"]
+
+    engine = _engine(aws, keep_shared=True)
+    scanned = list(engine.scan())
+    assert set(r.ami.id for r in scanned if r.excluded_by == "shared") == shared
+    # only the candidates are checked, then the results are cached
+    assert aws.stats['DescribeImageAttribute'] == 30 - len(in_use)
+    list(engine.scan())
+    assert aws.stats['DescribeImageAttribute'] == 30 - len(in_use)
+
+    # a check that fails keeps the AMI
+    failing = FakeAWS(seed=4, failure_rate={'DescribeImageAttribute': 1.0}, max_attempts=1).populate(images=3)
+    assert _engine(failing).fetcher.fetch_shared_amis(sorted(failing.images)) == set(failing.images)
+
+
+def test_instance_index():
+    aws = FakeAWS(seed=6, page_size=3).populate(images=5, instances=12)
+    aws.instances[0]['Tags'] = [{'Key': 'aws:autoscaling:groupName', 'Value': 'web'}]
+    engine = _engine(aws)
+    list(engine.scan())
+
+    index = engine.instance_index
+    image_ids = [i['ImageId'] for i in aws.instances]
+    assert sorted(index.image_ids()) == sorted(set(image_ids))
+    assert all(index.count(ami_id) == image_ids.count(ami_id) for ami_id in image_ids)
+    assert index.last_launch(image_ids[0]) == max(i['LaunchTime'] for i in aws.instances
+                                                  if i['ImageId'] == image_ids[0])
+    assert index.auto_scaling_groups(image_ids[0]) == {"web"}
+    assert index.count("ami-unknown") == 0
+
+    # instances are fetched page by page, once per evaluation
+    assert aws.stats['DescribeInstances'] == 4
+
+
+def test_snapshot_index_per_scan():
+    aws = FakeAWS(seed=4, page_size=3, always_paginate=('describe_images',)).populate(images=8)
+    engine = _engine(aws)
+
+    list(engine.scan())
+    index = engine.snapshot_index
+    assert engine.snapshot_index is index and index.is_used('snap-{0:017x}'.format(0))
+
+    engine.forget_ami('ami-{0:017x}'.format(0))
+    assert not index.is_used('snap-{0:017x}'.format(0))
+    assert 'ami-{0:017x}'.format(0) not in engine.fetcher.available_amis
+
+    list(engine.scan())
+    assert engine.snapshot_index is not index
+
+    # every page of the account is read to index the snapshots
+    assert AMICleaner(ec2=aws.ec2).remove_amis_from_ids(['ami-{0:017x}'.format(7)]) == []
+    assert len(aws.images) == 7 and 'snap-{0:017x}'.format(7) not in aws.snapshots
+
+
+def test_strings_shared_across_fetches():
+    aws = FakeAWS(seed=7).populate(images=4, groups=2)
+    unique = sorted(aws.images)[0]
+    aws.images[unique]['Tags'].append({'Key': 'build', 'Value': 'only-here'})
+    fetcher = Fetcher(ec2=aws.ec2, autoscaling=aws.asg)
+    first = fetcher.fetch_available_amis()
+    assert 'only-here' in fetcher.strings.strings
+    aws.populate(images=6, groups=2)
+    del aws.images[unique]
+
+    # the new AMIs share the tag values of the AMIs kept from the first fetch
+    amis = fetcher.fetch_available_amis()
+    kept, new = [amis[ami_id] for ami_id in sorted(aws.images)[0:5:4]]
+    assert kept is first[kept.id]
+    assert kept.tags[1].value == new.tags[1].value and kept.tags[1].value is new.tags[1].value
+    # the strings of the deregistered AMI are dropped
+    assert 'only-here' not in fetcher.strings.strings
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from amicleaner.core import AMICleaner
+from amicleaner.engine import Engine
+from amicleaner.fetch import Fetcher
+from amicleaner.history import UsageHistory, DAY
+from amicleaner.utils import parse_args
+
+from .fake_aws import FakeAWS
+
+NOW = 17000 * DAY + 3600
+
+
+def test_usage_history(tmpdir):
+    history = UsageHistory()
+    history.record(["ami-1", "ami-2"], when=NOW - 10 * DAY)
+    history.record(["ami-1", None], when=NOW - DAY)
+    history.record(["ami-1"], when=NOW)
+
+    assert history.last_used("ami-1") == NOW
+    assert history.last_used("ami-3") is None
+    assert history.days_used("ami-1") == 3
+    assert history.days_used("ami-2") == 1
+
+    assert history.used_within("ami-2", 11, now=NOW)
+    assert not history.used_within("ami-2", 10, now=NOW)
+    assert not history.used_within("ami-3", 100, now=NOW)
+    assert history.recently_used(5, now=NOW) == {"ami-1"}
+
+    path = str(tmpdir.join("usage.json"))
+    history.save(path)
+    loaded = UsageHistory.load(path)
+    assert loaded.amis == history.amis and loaded.day == history.day
+
+    # samples of a later day shift the days bitmap
+    loaded.record(["ami-2"], when=NOW + 2 * DAY)
+    assert loaded.days_used("ami-1") == 3
+    assert loaded.days_used("ami-2") == 2
+
+    assert loaded.prune(5, now=NOW + 2 * DAY) == 0
+    assert loaded.prune(1, now=NOW + 2 * DAY) == 1
+    assert list(loaded.amis) == ["ami-2"]
+
+    assert UsageHistory.load(str(tmpdir.join("missing.json"))).amis == {}
+
+
+def test_keep_used_days(tmpdir):
+    path = str(tmpdir.join("usage.json"))
+    aws = FakeAWS(seed=3).populate(images=20, instances=3)
+    in_use = set(i['ImageId'] for i in aws.instances)
+
+    def engine():
+        return Engine(usage_history=UsageHistory.load(path), keep_used_days=7,
+                      fetcher=Fetcher(ec2=aws.ec2, autoscaling=aws.asg), cleaner=AMICleaner(ec2=aws.ec2))
+
+    assert set(r.ami.id for r in engine().scan() if r.excluded_by == "instances") == in_use
+
+    # the instances are gone, their AMIs were used recently
+    del aws.instances[:]
+    scanned = list(engine().scan())
+    assert set(r.ami.id for r in scanned if r.excluded_by == "recently used") == in_use
+    assert len([r for r in scanned if r.excluded_by is None]) == 20 - len(in_use)
+
+
+def test_parse_usage_args(tmpdir):
+    assert parse_args(["--keep-used-days", "3"]) is None
+    assert parse_args(["--sample-usage"]) is None
+    assert parse_args(["--usage-history", "usage.json", "--keep-used-days", "3"]).keep_used_days == 3
+
+    path = tmpdir.join("usage.json")
+    for content in ("{", '{"version": 0, "amis": {}}', '{"version": 1, "amis": {"ami-1": 3}}'):
+        path.write(content)
+        with pytest.raises(SystemExit):
+            parse_args(["--usage-history", str(path)])
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+from amicleaner.core import AMICleaner
+from amicleaner.engine import Engine
+from amicleaner.fetch import Fetcher
+from amicleaner.inventory import Inventory, InventoryWriter
+from amicleaner.utils import parse_args
+
+from .fake_aws import FakeAWS
+
+
+def _engine(aws, **kwargs):
+    return Engine(fetcher=Fetcher(ec2=aws.ec2, autoscaling=aws.asg), cleaner=AMICleaner(ec2=aws.ec2), **kwargs)
+
+
+def test_inventory_file(tmpdir):
+    aws = FakeAWS(seed=1).populate(images=50, snapshots_per_image=2, groups=4)
+    images = [aws.images[ami_id] for ami_id in sorted(aws.images)]
+    images[3]['Tags'] = []
+    images[4]['Name'] = u'app-été'
+
+    path = str(tmpdir.join("inventory.bin"))
+    writer = InventoryWriter(path)
+    for image in images:
+        writer.add(image)
+    writer.close()
+    # tag keys and values are stored once
+    assert len(writer.string_codes) < 50 * 4
+
+    with Inventory.open(path) as inventory:
+        assert len(inventory) == 50
+        for row, image in enumerate(images):
+            ami = inventory.ami(row)
+            assert ami.id == image['ImageId']
+            assert ami.name == image['Name']
+            assert ami.creation_date == image['CreationDate']
+            assert [(t.key, t.value) for t in ami.tags] == [(t['Key'], t['Value']) for t in image['Tags']]
+            assert [b.snapshot_id for b in ami.block_device_mappings] == aws.image_snapshots(image)
+            assert [b.volume_size for b in ami.block_device_mappings] == [8, 8]
+
+        assert inventory.rows({images[0]['ImageId'], "ami-unknown"}) == list(range(1, 50))
+
+        amis = [inventory.ami(row) for row in range(50)]
+        cleaner = AMICleaner()
+        for strategy in ({"key": "tags", "values": ["role"], "excluded": ["app3"]},
+                         {"key": "tags", "values": [], "excluded": []},
+                         {"key": "tags", "values": ["environment"], "excluded": ["<all values>"]},
+                         {"key": "name", "values": ["app1", "app2"]}):
+            expected = cleaner.map_candidates(amis, strategy)
+            mapped = inventory.map_rows(range(50), strategy)
+            assert dict((k, [amis[row].id for row in rows]) for k, rows in mapped.items()) == \
+                dict((k, [ami.id for ami in group]) for k, group in expected.items())
+
+
+def test_plan_inventory(tmpdir):
+    aws = FakeAWS(seed=2, page_size=7).populate(images=60, groups=5, instances=4)
+    options = dict(keep_previous=2, mapping_strategy={"key": "tags", "values": ["role"], "excluded": ["app4"]})
+
+    # the first two AMIs share a snapshot
+    first, second = [aws.images[ami_id] for ami_id in sorted(aws.images)[:2]]
+    shared = aws.image_snapshots(first)[0]
+    second['BlockDeviceMappings'] = first['BlockDeviceMappings']
+
+    expected = sorted((r.ami.id, r.group, r.reason) for r in _engine(aws, **options).plan())
+    engine = _engine(aws, **options)
+    results = list(engine.plan_inventory(str(tmpdir.join("inventory.bin"))))
+    assert sorted((r.ami.id, r.group, r.reason) for r in results) == expected
+    # only the excluded AMIs are built, the spill files are removed
+    assert set(engine.available_amis) == set(aws.images) - set(r.ami.id for r in results)
+    assert tmpdir.listdir() == [tmpdir.join("inventory.bin")]
+    assert engine.snapshot_index.amis_by_snapshot == {shared: {first['ImageId'], second['ImageId']}}
+
+    removed = [r.ami for r in results if r.removed]
+    aws.stats.clear()
+    removals = list(engine.execute(removed, engine.snapshot_index))
+    assert all(r.deregistered for r in removals)
+    assert len(aws.images) == 60 - len(removed)
+    assert aws.stats["DeleteSnapshot"] == sum(len(r.deleted_snapshots) for r in removals)
+
+
+def test_inventory_options():
+    assert parse_args(["--inventory", "amis.inventory", "--daemon"]) is None
+    assert parse_args(["--inventory", "amis.inventory", "--aws-regions", "us-east-1"]) is None
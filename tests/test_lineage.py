@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import copy
+
+from amicleaner.cli import App
+from amicleaner.core import AMICleaner
+from amicleaner.engine import Engine
+from amicleaner.fetch import Fetcher
+from amicleaner.lineage import LineageGraph, source_of
+from amicleaner.resources.config import LINEAGE_TAG
+from amicleaner.resources.models import AMI
+from amicleaner.utils import parse_args
+
+from .fake_aws import FakeAWS
+
+
+def _ami(ami_id, tags=None, **json):
+    json.update({"ImageId": ami_id, "Tags": [{"Key": k, "Value": v} for k, v in (tags or {}).items()]})
+    return AMI.object_with_json(json)
+
+
+def _copy_images(source, target, source_region):
+
+    """ copies every image of source into target, as copy_image does (tags are not copied) """
+
+    for image_id, image in sorted(source.images.items()):
+        copied = copy.deepcopy(image)
+        copied["ImageId"] = image_id.replace("ami-", "ami-c")
+        copied["CreationDate"] = image["CreationDate"].replace("2016", "2017")
+        copied["SourceImageId"] = image_id
+        copied["SourceImageRegion"] = source_region
+        copied["Tags"] = []
+        for block_device in copied["BlockDeviceMappings"]:
+            snapshot_id = block_device["Ebs"]["SnapshotId"].replace("snap-", "snap-c")
+            block_device["Ebs"]["SnapshotId"] = snapshot_id
+            target.snapshots[snapshot_id] = dict(source.snapshots[snapshot_id.replace("snap-c", "snap-")],
+                                                 SnapshotId=snapshot_id)
+            target.snapshot_images.setdefault(snapshot_id, set()).add(copied["ImageId"])
+        target.images[copied["ImageId"]] = copied
+
+
+def test_source_of():
+    assert source_of("eu-west-1", _ami("ami-1")) is None
+    assert source_of("eu-west-1", _ami("ami-2", SourceImageId="ami-1", SourceImageRegion="us-east-1")) == \
+        ("us-east-1", "ami-1")
+    assert source_of("eu-west-1", _ami("ami-2", tags={LINEAGE_TAG: "ami-1"})) == ("eu-west-1", "ami-1")
+    assert source_of("eu-west-1", _ami("ami-2", tags={LINEAGE_TAG: "us-east-1/ami-1"})) == \
+        ("us-east-1", "ami-1")
+
+
+def test_lineage_graph():
+    graph = LineageGraph.from_inventories({
+        "us-east-1": {"ami-1": _ami("ami-1"), "ami-9": _ami("ami-9")},
+        "eu-west-1": {
+            "ami-2": _ami("ami-2", SourceImageId="ami-1", SourceImageRegion="us-east-1"),
+            # copy of a copy
+            "ami-3": _ami("ami-3", tags={LINEAGE_TAG: "ami-2"}),
+            # copy of a deregistered AMI, still a lineage of its own
+            "ami-4": _ami("ami-4", SourceImageId="ami-0", SourceImageRegion="us-east-1"),
+        },
+    })
+
+    root = graph.lineage("us-east-1", "ami-1")
+    assert graph.lineage("eu-west-1", "ami-3") == root
+    assert graph.lineage("us-east-1", "ami-9") != root
+    assert sorted(ami.id for _, ami in graph.lineage_amis("eu-west-1", "ami-2")) == ["ami-1", "ami-2", "ami-3"]
+    assert [ami.id for _, ami in graph.lineage_amis("eu-west-1", "ami-4")] == ["ami-4"]
+    assert len(graph.members()) == 3
+
+
+def _two_regions(instances=2):
+
+    """ west AMIs copied into east, and an engine scanning both regions """
+
+    west = FakeAWS(seed=1).populate(images=12, groups=3, instances=instances)
+    east = FakeAWS(seed=2)
+    _copy_images(west, east, "us-west-2")
+
+    engine = Engine(
+        regions=["us-west-2", "us-east-1"],
+        fetchers={"us-west-2": Fetcher(ec2=west.ec2, autoscaling=west.asg),
+                  "us-east-1": Fetcher(ec2=east.ec2, autoscaling=east.asg)},
+        cleaners={"us-west-2": AMICleaner(ec2=west.ec2), "us-east-1": AMICleaner(ec2=east.ec2)},
+        mapping_strategy={"key": "tags", "values": ["role"], "excluded": []},
+        keep_previous=1,
+    )
+    return west, east, engine
+
+
+def _two_regions_app(options):
+    west, east, engine = _two_regions(instances=0)
+    app = App(parse_args(["--aws-regions", "us-west-2", "us-east-1", "--mapping-key", "tags",
+                          "--mapping-values", "role", "--keep-previous", "1", "-f"] + options))
+    app._engine = engine
+    return west, east, app
+
+
+def test_multi_region_engine():
+    west, east, engine = _two_regions()
+
+    # an AMI only used by an instance of the other region
+    east.instances.append({'InstanceId': 'i-east', 'ImageId': 'ami-c{0:017x}'.format(11),
+                           'State': {'Name': 'running'}, 'Tags': []})
+
+    scanned = list(engine.scan())
+    assert len(scanned) == 24
+    in_use = set(i['ImageId'] for i in west.instances + east.instances)
+    excluded = set(r.ami.id for r in scanned if r.excluded_by)
+    assert 'ami-{0:017x}'.format(11) in excluded
+    assert set(r.ami.id for r in scanned if r.excluded_by == "lineage in use") == \
+        set(ami_id.replace("ami-c", "ami-") if ami_id.startswith("ami-c") else ami_id.replace("ami-", "ami-c")
+            for ami_id in in_use) - in_use
+
+    # copies are untagged, they are grouped and kept through their original AMI
+    plan = list(engine.plan([r.ami for r in scanned if r.excluded_by is None]))
+    removed = set(r.ami.id for r in plan if r.removed)
+    assert removed
+    assert all((ami_id.replace("ami-", "ami-c") in removed) for ami_id in removed if not ami_id.startswith("ami-c"))
+    assert all(r.group == "app{0}".format(int(r.ami.id[-1], 16) % 3) for r in plan)
+
+    results = list(engine.execute([r.ami for r in plan if r.removed], engine.snapshot_index, workers=2))
+    assert all(r.deregistered for r in results)
+    assert len(west.images) + len(east.images) == 24 - len(removed)
+    assert not removed & (set(west.images) | set(east.images))
+
+
+def test_multi_region_scheduled():
+    west, east, app = _two_regions_app(["--max-deletes", "100", "--priority", "oldest"])
+    candidates = app.prepare_candidates(app.fetch_candidates())
+    assert set(ami.region for ami in candidates) == {"us-west-2", "us-east-1"}
+
+    # each AMI is removed in its region
+    assert app.delete_candidates(candidates) == []
+    assert sorted(app.last_removed) == sorted(ami.id for ami in candidates)
+    assert app.last_schedule.failed_amis == []
+    assert len(west.images) == len(east.images) == 3
+
+
+def test_multi_region_mark_sweep():
+    west, east, app = _two_regions_app(["--mark"])
+    candidates = app.prepare_candidates(app.fetch_candidates())
+    assert app.prepare_mark_amis(candidates) == len(candidates)
+    # one tagging call per region
+    assert west.stats["CreateTags"] == east.stats["CreateTags"] == 1
+    assert len(west.images) == len(east.images) == 12
+
+    sweep = App(parse_args(["--aws-regions", "us-west-2", "us-east-1", "--sweep", "-f"]))
+    sweep._engine = app.engine
+    sweep.sweep_marked_amis()
+    assert sorted(sweep.last_removed) == sorted(ami.id for ami in candidates)
+    assert len(west.images) == len(east.images) == 3
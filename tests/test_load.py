@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load tests against the in-memory AWS stand-in, set AMICLEANER_LOAD_SCALE
+to run them on bigger inventories (1 = 10k AMIs)
+"""
+
+import os
+
+from amicleaner.core import AMICleaner, OrphanSnapshotCleaner, SnapshotIndex
+from amicleaner.fetch import Fetcher
+
+from .fake_aws import FakeAWS
+
+SCALE = float(os.environ.get("AMICLEANER_LOAD_SCALE", "1"))
+IMAGES = int(10000 * SCALE)
+
+
+def test_fake_aws_is_deterministic():
+    def run():
+        aws = FakeAWS(seed=3, latency=0.01, throttle_rate=0.2).populate(images=100)
+        for _ in range(50):
+            aws.ec2.describe_images(Owners=['self'])
+        return aws.stats, aws.clock
+
+    assert run() == run()
+
+
+def test_fake_aws_pagination():
+    aws = FakeAWS(page_size=300).populate(images=1000)
+    pages = list(aws.ec2.get_paginator('describe_images').paginate(Owners=['self']))
+    assert [len(p['Images']) for p in pages] == [300, 300, 300, 100]
+    assert len(aws.ec2.describe_images(Owners=['self'])['Images']) == 1000
+
+
+def test_load_fetch_available_amis():
+    aws = FakeAWS(seed=1, latency=0.05, throttle_rate=0.3).populate(images=IMAGES, instances=100)
+    fetcher = Fetcher(ec2=aws.ec2, autoscaling=aws.asg)
+
+    assert len(fetcher.fetch_available_amis()) == IMAGES
+    assert len(fetcher.fetch_instances()) == 100
+    assert aws.stats['DescribeImages'] >= 1
+
+
+def test_load_launch_configurations():
+    aws = FakeAWS(seed=6, latency=0.01, throttle_rate=0.05, page_size=50).populate(images=200)
+    image_ids = sorted(aws.images)
+    for n in range(120):
+        aws.launch_configurations.append({'LaunchConfigurationName': 'lc-{0}'.format(n), 'ImageId': image_ids[n]})
+    for n in range(30):
+        aws.auto_scaling_groups.append({'AutoScalingGroupName': 'asg-{0}'.format(n),
+                                        'LaunchConfigurationName': 'lc-{0}'.format(n),
+                                        'DesiredCapacity': 0 if n < 10 else 2})
+
+    fetcher = Fetcher(ec2=aws.ec2, autoscaling=aws.asg)
+    assert sorted(fetcher.fetch_unattached_lc()) == image_ids[30:120]
+    assert sorted(fetcher.fetch_zeroed_asg_lc()) == image_ids[:10]
+
+    calls = aws.stats['DescribeLaunchConfigurations'] - aws.stats['DescribeLaunchConfigurations.throttled']
+    assert calls == 3
+    calls = aws.stats['DescribeAutoScalingGroups'] - aws.stats['DescribeAutoScalingGroups.throttled']
+    assert calls == 1
+
+    fetcher.invalidate()
+    fetcher.fetch_zeroed_asg_lc()
+    calls = aws.stats['DescribeLaunchConfigurations'] - aws.stats['DescribeLaunchConfigurations.throttled']
+    assert calls == 6
+
+
+def test_load_remove_amis():
+    aws = FakeAWS(seed=2, latency=0.01, throttle_rate=0.05, failure_rate={'DeleteSnapshot': 0.01})
+    aws.populate(images=IMAGES // 5, snapshots_per_image=2)
+    amis = list(Fetcher(ec2=aws.ec2, autoscaling=aws.asg).fetch_available_amis().values())
+
+    cleaner = AMICleaner(ec2=aws.ec2)
+    removed, kept = amis[:len(amis) // 2], amis[len(amis) // 2:]
+    failed = cleaner.remove_amis(removed, SnapshotIndex.from_amis(amis))
+
+    assert failed
+    assert len(aws.images) == len(kept)
+    assert len(aws.snapshots) == 2 * len(kept) + len(failed)
+    assert aws.stats['DeleteSnapshot.throttled'] > 0
+
+
+def test_load_mark_and_sweep():
+    aws = FakeAWS(seed=5, latency=0.01, throttle_rate=0.05)
+    aws.populate(images=IMAGES // 5)
+    fetcher = Fetcher(ec2=aws.ec2, autoscaling=aws.asg)
+    amis = list(fetcher.fetch_available_amis().values())
+
+    cleaner = AMICleaner(ec2=aws.ec2)
+    assert cleaner.mark_amis(amis[:1500]) == 1500
+    assert aws.stats['CreateTags'] - aws.stats['CreateTags.throttled'] == 2
+
+    marked = fetcher.fetch_marked_amis()
+    assert len(marked) == 1500
+    assert cleaner.remove_amis(marked, SnapshotIndex.from_amis(marked), workers=8) == []
+    assert len(aws.images) == len(amis) - 1500
+    assert fetcher.fetch_marked_amis() == []
+
+
+def test_load_orphan_snapshots():
+    aws = FakeAWS(seed=4, latency=0.01, throttle_rate=0.05)
+    aws.populate(images=IMAGES // 5, orphan_snapshots=IMAGES // 10)
+
+    cleaner = OrphanSnapshotCleaner(ec2=aws.ec2)
+    orphans = cleaner.fetch()
+    assert len(orphans) == IMAGES // 10
+    assert cleaner.clean(orphans) == len(orphans)
+    assert cleaner.fetch() == []
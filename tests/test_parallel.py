@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import random
+from datetime import datetime, timedelta
+
+from amicleaner.core import AMICleaner
+from amicleaner.parallel import reduce_groups, shard_groups
+from amicleaner.resources.models import AMI
+
+
+def _mapped(groups=12, seed=1):
+    rand = random.Random(seed)
+    now = datetime.now()
+    mapped = {"": []}
+    count = 0
+    for g in range(groups):
+        amis = []
+        for _ in range(rand.randrange(1, 40)):
+            ami = AMI()
+            ami.id = "ami-{0}".format(count)
+            ami.creation_date = (now - timedelta(days=rand.randrange(0, 30), minutes=count)) \
+                .strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            amis.append(ami)
+            count += 1
+        mapped["group-{0}".format(g)] = amis
+    mapped[""] = mapped["group-0"][:3]
+    return mapped
+
+
+def _ids(reductions):
+    return [(name,) + tuple([ami.id for ami in amis] for amis in lists) for name, *lists in reductions]
+
+
+def test_shard_groups():
+    shards = shard_groups([10, 1, 7, 3, 3], 2)
+    assert sorted(code for shard in shards for code in shard) == [0, 1, 2, 3, 4]
+    assert sorted(sum([10, 1, 7, 3, 3][code] for code in shard) for shard in shards) == [11, 13]
+    assert shard_groups([5], 4) == [[0]]
+
+
+def test_reduce_groups_matches_reduce_candidates():
+    mapped = _mapped()
+    cleaner = AMICleaner()
+
+    for keep_previous, ami_min_days in ((0, -1), (3, -1), (2, 10), (0, 5)):
+        expected = [
+            (name,) + (cleaner.reduce_candidates(amis, keep_previous, ami_min_days) if name else (amis, [], []))
+            for name, amis in mapped.items()
+        ]
+        reductions = reduce_groups(mapped, keep_previous, ami_min_days, processes=2)
+        assert _ids(reductions) == _ids(expected)
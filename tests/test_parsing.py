@@ -75,3 +75,20 @@ def test_models_to_tring():
     assert str(AWSBlockDevice()) is not None
     assert str(AWSEC2Instance()) is not None
     assert str(AWSTag()) is not None
+
+
+def test_ami_lazy_fields():
+    with open("tests/mocks/ami.json") as mock_file:
+        json_to_parse = json.load(mock_file)
+        ami = AMI.object_with_json(json_to_parse)
+        assert "block_device_mappings" not in ami.__dict__
+        assert "tags" not in ami.__dict__
+        assert ami.block_device_mappings[0].snapshot_id == "snap-b4f78391"
+        assert ami.block_device_mappings is ami.block_device_mappings
+        assert ami.public is False
+
+        ami.name = "renamed"
+        ami.tags = []
+        assert ami.name == "renamed"
+        assert ami.tags == []
+        assert json_to_parse["Name"] == "custom-debian-201511040131"
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from amicleaner.cli import App
+from amicleaner.policy import Policy, PolicyError
+from amicleaner.resources.models import AMI, AWSTag
+from amicleaner.utils import parse_args
+
+
+def _ami(ami_id, name, creation_date, **tags):
+    ami = AMI()
+    ami.id = ami_id
+    ami.name = name
+    ami.creation_date = creation_date
+    for key, value in tags.items():
+        tag = AWSTag()
+        tag.key = key
+        tag.value = value
+        ami.tags.append(tag)
+    return ami
+
+
+POLICY = {
+    "protect": {"ami_ids": ["ami-golden"], "tags": {"retention": "forever"}},
+    "defaults": {"keep_previous": 1},
+    "groups": [
+        {"name": "web", "key": "tags", "values": ["env", "role"], "excluded": ["prod"], "min_days": 10},
+        {"key": "name", "patterns": ["^ubuntu-"], "keep_previous": 0},
+    ],
+}
+
+
+def test_policy_errors():
+    with pytest.raises(PolicyError):
+        Policy([])
+    with pytest.raises(PolicyError):
+        Policy({"groups": []})
+    with pytest.raises(PolicyError):
+        Policy({"groups": [{"key": "id"}]})
+    with pytest.raises(PolicyError):
+        Policy({"groups": [{"key": "name"}]})
+
+
+def test_policy_evaluate():
+    recent = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    amis = [
+        _ami("ami-golden", "golden", "2016-01-01T00:00:00.000Z", env="test", role="web"),
+        _ami("ami-forever", "forever", "2016-01-01T00:00:00.000Z", retention="forever"),
+        _ami("ami-1", "web-1", "2016-01-01T00:00:00.000Z", env="test", role="web"),
+        _ami("ami-2", "web-2", "2016-01-02T00:00:00.000Z", env="test", role="web"),
+        _ami("ami-3", "web-3", recent, env="test", role="web"),
+        _ami("ami-prod", "web-prod", "2016-01-02T00:00:00.000Z", env="prod", role="web"),
+        _ami("ami-ubuntu", "ubuntu-1", "2016-01-02T00:00:00.000Z"),
+        _ami("ami-other", "other", "2016-01-02T00:00:00.000Z"),
+    ]
+
+    candidates, report = Policy(POLICY).evaluate(amis)
+
+    def ids(group):
+        return sorted(ami.id for ami in report[group])
+
+    assert sorted(ami.id for ami in candidates) == ["ami-1", "ami-ubuntu"]
+    assert ids("Excluded (by policy protection)") == ["ami-forever", "ami-golden"]
+    assert ids("Excluded (by mapping strategy)") == ["ami-other", "ami-prod"]
+    assert ids("Excluded web:test.web (by min day)") == ["ami-3"]
+    assert ids("Excluded web:test.web (by keep previous)") == ["ami-2"]
+    assert ids("web:test.web") == ["ami-1"]
+    assert ids("^ubuntu-") == ["ami-ubuntu"]
+
+
+def test_policy_from_cli(tmpdir):
+    policy_path = tmpdir.join("policy.json")
+    policy_path.write(json.dumps(POLICY))
+
+    app = App(parse_args(["--policy", str(policy_path)]))
+    amis = [
+        _ami("ami-1", "ubuntu-1", "2016-01-01T00:00:00.000Z"),
+        _ami("ami-2", "ubuntu-2", "2016-01-02T00:00:00.000Z"),
+    ]
+    assert len(app.prepare_candidates(amis)) == 2
+
+
+def test_policy_from_yaml(tmpdir):
+    pytest.importorskip("yaml")
+    policy_path = tmpdir.join("policy.yml")
+    policy_path.write("groups:\n  - key: name\n    values: [ubuntu]\n")
+    assert Policy.load(str(policy_path)).groups[0].values == ["ubuntu"]
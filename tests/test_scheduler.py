@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+from amicleaner.scheduler import DeletionScheduler
+from amicleaner.resources.models import AMI, AWSBlockDevice
+
+
+class FakeClock(object):
+
+    """ every call to the cleaner lasts `step` seconds """
+
+    def __init__(self, step):
+        self.step = step
+        self.now = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self.now
+
+    def advance(self):
+        with self.lock:
+            self.now += self.step
+
+
+class FakeCleaner(object):
+
+    def __init__(self, clock=None, failing=()):
+        self.clock = clock
+        self.failing = set(failing)
+        self.removed = []
+        self.lock = threading.Lock()
+
+    def remove_ami(self, ami, snapshot_index=None):
+        if self.clock is not None:
+            self.clock.advance()
+        if ami.id in self.failing:
+            raise ClientError({'Error': {'Code': 'InvalidAMIID.Unavailable'}}, 'DeregisterImage')
+        with self.lock:
+            self.removed.append(ami.id)
+        return ["snap-" + ami.id] if ami.id.endswith("9") else []
+
+
+def _ami(ami_id, creation_date, size=8):
+    ami = AMI()
+    ami.id = ami_id
+    ami.creation_date = creation_date
+    block_device = AWSBlockDevice()
+    block_device.snapshot_id = "snap-" + ami_id
+    block_device.volume_size = size
+    ami.block_device_mappings.append(block_device)
+    return ami
+
+
+AMIS = [
+    _ami("ami-3", "2016-01-03T00:00:00.000Z", size=100),
+    _ami("ami-1", "2016-01-01T00:00:00.000Z", size=8),
+    _ami("ami-2", "2016-01-02T00:00:00.000Z", size=50),
+    _ami("ami-9", "2016-01-09T00:00:00.000Z", size=8),
+]
+
+
+def test_order():
+    assert [a.id for a in DeletionScheduler(None).order(AMIS)] == ["ami-1", "ami-2", "ami-3", "ami-9"]
+    assert [a.id for a in DeletionScheduler(None, priority="largest").order(AMIS)] == \
+        ["ami-3", "ami-2", "ami-1", "ami-9"]
+
+    groups = {"small": [AMIS[1], AMIS[3]], "big": [AMIS[0], AMIS[2]]}
+    ordered = DeletionScheduler(None, priority="group").order(AMIS, groups, ["big", "small"])
+    assert [a.id for a in ordered] == ["ami-2", "ami-3", "ami-1", "ami-9"]
+
+    with pytest.raises(ValueError):
+        DeletionScheduler(None, priority="newest")
+
+
+def test_run_everything():
+    cleaner = FakeCleaner()
+    summary = DeletionScheduler(cleaner, workers=3).run(AMIS)
+
+    assert sorted(cleaner.removed) == ["ami-1", "ami-2", "ami-3", "ami-9"]
+    assert sorted(summary.deleted) == sorted(cleaner.removed)
+    assert summary.failed_snapshots == ["snap-ami-9"]
+    assert summary.remaining == []
+    assert summary.stopped_by == "completed"
+
+
+def test_run_max_deletes_and_failures():
+    cleaner = FakeCleaner(failing=["ami-1"])
+    summary = DeletionScheduler(cleaner, max_deletes=2).run(AMIS)
+
+    assert cleaner.removed == ["ami-2"]
+    assert summary.failed_amis == ["ami-1"]
+    assert summary.remaining == ["ami-3", "ami-9"]
+    assert summary.stopped_by == "max-deletes"
+
+
+def test_run_max_duration_and_checkpoint(tmpdir):
+    checkpoint = str(tmpdir.join("checkpoint.json"))
+    clock = FakeClock(step=10)
+
+    # each removal lasts 10s, the third one would end after the deadline
+    scheduler = DeletionScheduler(FakeCleaner(clock), max_duration=25, priority="largest",
+                                  checkpoint=checkpoint, clock=clock)
+    summary = scheduler.run(AMIS)
+    assert summary.deleted == ["ami-3", "ami-2"]
+    assert summary.stopped_by == "max-duration"
+    assert summary.elapsed == 20
+
+    with open(checkpoint) as checkpoint_file:
+        assert json.load(checkpoint_file)["remaining"] == ["ami-1", "ami-9"]
+
+    # the next run starts with the AMIs left by the previous one
+    cleaner = FakeCleaner()
+    remaining = [AMIS[0], AMIS[3], AMIS[1]]
+    summary = DeletionScheduler(cleaner, priority="largest", checkpoint=checkpoint).run(remaining)
+    assert cleaner.removed == ["ami-1", "ami-9", "ami-3"]
+    assert summary.remaining == []
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from botocore.exceptions import EndpointConnectionError
+
+from amicleaner.cli import App
+from amicleaner.core import AMICleaner, SnapshotIndex
+from amicleaner.daemon import Daemon
+from amicleaner.engine import Engine
+from amicleaner.fetch import Fetcher
+from amicleaner.utils import parse_args
+from amicleaner.verify import DeletionVerifier
+
+from .fake_aws import FakeAWS
+
+
+class StaleEC2(object):
+
+    """ ec2 client whose first describe_images calls still list the removed images """
+
+    def __init__(self, ec2, images, stale_calls):
+        self.ec2 = ec2
+        self.images = images
+        self.stale_calls = stale_calls
+
+    def describe_images(self, **kwargs):
+        resp = self.ec2.describe_images(**kwargs)
+        if self.stale_calls:
+            self.stale_calls -= 1
+            wanted = set(kwargs["Filters"][0]["Values"])
+            resp["Images"] = resp["Images"] + [image for image in self.images if image["ImageId"] in wanted]
+        return resp
+
+    def describe_snapshots(self, **kwargs):
+        return self.ec2.describe_snapshots(**kwargs)
+
+
+def _remove(aws, count):
+    amis = sorted(Fetcher(ec2=aws.ec2, autoscaling=aws.asg).fetch_available_amis().values(),
+                  key=lambda ami: ami.id)[:count]
+    images = [dict(aws.images[ami.id]) for ami in amis]
+    cleaner = AMICleaner(ec2=aws.ec2)
+    index = SnapshotIndex.from_amis(amis)
+    return images, [cleaner.deregister(ami, index) for ami in amis]
+
+
+def test_verify_removals():
+    aws = FakeAWS(seed=1).populate(images=30, snapshots_per_image=2)
+    images, results = _remove(aws, 25)
+    assert all(result.deregistered for result in results)
+
+    aws.stats.clear()
+    verifier = DeletionVerifier(aws.ec2, batch_size=10, delay=0.01).start()
+    for result in results:
+        verifier.submit(result)
+    report = verifier.close()
+
+    assert report.complete
+    assert (report.verified_amis, report.verified_snapshots) == (25, 50)
+    # ids are described by batches
+    assert aws.stats["DescribeImages"] <= 6 and aws.stats["DescribeSnapshots"] <= 10
+
+
+def test_verify_lingering():
+    aws = FakeAWS(seed=2).populate(images=10)
+    images, results = _remove(aws, 4)
+
+    # an image still listed by the first describe, a snapshot not really deleted
+    ec2 = StaleEC2(aws.ec2, images[:1], stale_calls=1)
+    lingering = results[1].deleted_snapshots[0]
+    aws.snapshots[lingering] = {"SnapshotId": lingering, "State": "completed"}
+
+    verifier = DeletionVerifier(ec2, attempts=3, delay=0.01).start()
+    for result in results:
+        verifier.submit(result)
+    report = verifier.close()
+
+    assert (report.verified_amis, report.verified_snapshots) == (4, 3)
+    assert report.lingering_amis == [] and report.lingering_snapshots == [lingering]
+    assert not report.complete
+
+
+def test_verify_errors():
+    aws = FakeAWS(seed=3).populate(images=4)
+    images, results = _remove(aws, 2)
+
+    class BrokenEC2(object):
+        def describe_images(self, **kwargs):
+            raise EndpointConnectionError(endpoint_url="https://ec2.amazonaws.com")
+
+        def describe_snapshots(self, **kwargs):
+            raise ValueError("unexpected response")
+
+    # the thread keeps going, the ids are reported as lingering
+    verifier = DeletionVerifier(BrokenEC2(), attempts=2, delay=0.01).start()
+    for result in results:
+        verifier.submit(result)
+    report = verifier.close()
+    assert (report.verified_amis, report.verified_snapshots) == (0, 0)
+    assert len(report.lingering_amis) == 2 and len(report.lingering_snapshots) == 2
+
+
+def test_verify_daemon():
+    aws = FakeAWS(seed=4).populate(images=4, groups=1)
+    app = App(parse_args(['--keep-previous', '1', '--mapping-key', 'tags', '--mapping-values', 'role',
+                          '--daemon', '--verify', '-f']))
+    app._engine = Engine(mapping_strategy=app.mapping_strategy, keep_previous=1,
+                         fetcher=Fetcher(ec2=aws.ec2, autoscaling=aws.asg), cleaner=AMICleaner(ec2=aws.ec2))
+    daemon = Daemon(app)
+    daemon.run_once()
+
+    assert app.last_verification.verified_amis == 3
+    assert "amicleaner_lingering_amis 0" in daemon.metrics.render()
+
+
+def test_verify_options():
+    assert parse_args(["--verify"]).verify
+    assert parse_args(["--verify", "--queue", "queue.db"]) is None
+    assert parse_args(["--verify", "--from-ids", "ami-1"]) is None
+    assert parse_args(["--verify", "--max-deletes", "10"]) is None
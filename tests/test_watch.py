@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import json
+import socket
+from datetime import datetime, timedelta
+
+import pytest
+
+from amicleaner.cli import App
+from amicleaner.core import AMICleaner
+from amicleaner.engine import Engine
+from amicleaner.fetch import Fetcher
+from amicleaner.utils import parse_args
+from amicleaner.watch import Watcher, read_feed
+
+from .fake_aws import FakeAWS
+
+STRATEGY = {"key": "tags", "values": ["role"], "excluded": []}
+
+
+def _engine(aws):
+    return Engine(mapping_strategy=STRATEGY, keep_previous=2, fetcher=Fetcher(ec2=aws.ec2, autoscaling=aws.asg),
+                  cleaner=AMICleaner(ec2=aws.ec2))
+
+
+def _image_event(ami_id, state):
+    return {"source": "aws.ec2", "detail-type": "EC2 AMI State Change",
+            "detail": {"ImageId": ami_id, "State": state}}
+
+
+def _instance_event(instance_id, state):
+    return {"source": "aws.ec2", "detail-type": "EC2 Instance State-change Notification",
+            "detail": {"instance-id": instance_id, "state": state}}
+
+
+def _create_image(aws, ami_id, role, minutes):
+    image = dict(aws.images['ami-{0:017x}'.format(0)])
+    image.update({
+        'ImageId': ami_id,
+        'BlockDeviceMappings': [],
+        'CreationDate': (datetime(2016, 1, 1) + timedelta(minutes=minutes)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'Tags': [{'Key': 'role', 'Value': role}],
+    })
+    aws.images[ami_id] = image
+
+
+def test_watcher():
+    aws = FakeAWS(seed=1).populate(images=12, groups=3)
+    watcher = Watcher(_engine(aws))
+
+    queued = watcher.start()
+    assert sorted(r.group for r in queued) == ["app0", "app0", "app1", "app1", "app2", "app2"]
+    assert len(watcher.drain()) == 6 and watcher.drain() == []
+
+    # a new AMI of app0 only reduces app0 again, without a scan
+    aws.stats.clear()
+    _create_image(aws, "ami-new", "app0", 100)
+    assert watcher.handle(_image_event("ami-new", "available")) == {"app0"}
+    oldest_kept = 'ami-{0:017x}'.format(6)
+    assert [r.ami.id for r in watcher.reduce({"app0"})] == [oldest_kept]
+    assert aws.stats["DescribeImages"] == 1
+
+    # started on a queued AMI, it is in use again
+    aws.instances.append({'InstanceId': 'i-new', 'ImageId': oldest_kept, 'State': {'Name': 'running'},
+                          'Tags': []})
+    assert watcher.process(_instance_event("i-new", "running")) == []
+    assert watcher.pending == {}
+    assert watcher.process(_instance_event("i-new", "terminated"))[0].ami.id == oldest_kept
+
+    # deregistered elsewhere
+    watcher.process(_image_event(oldest_kept, "deregistered"))
+    assert watcher.pending == {} and oldest_kept not in watcher.engine.available_amis
+    assert watcher.process({"detail-type": "Unknown"}) == []
+
+
+def test_read_feed(tmpdir):
+    feed = tmpdir.join("events.jsonl")
+    feed.write("\n".join([json.dumps(_image_event("ami-1", "available")), "not json", "[]",
+                          json.dumps(_instance_event("i-1", "running"))]))
+
+    events = list(read_feed(str(feed), follow=False))
+    assert [event["detail-type"] for event in events] == ["EC2 AMI State Change",
+                                                          "EC2 Instance State-change Notification"]
+
+    # a partial line is read once completed
+    feed.write(json.dumps(_image_event("ami-2", "available"))[:10])
+    events = read_feed(str(feed), follow=True, interval=0)
+    assert next(events) is None
+    feed.write(json.dumps(_image_event("ami-2", "available"))[10:] + "\n", mode="a")
+    assert next(events)["detail"]["ImageId"] == "ami-2"
+
+
+def test_read_socket(tmpdir):
+    path = str(tmpdir.join("events.sock"))
+    events = read_feed("unix:" + path, interval=0.05)
+    assert next(events) is None
+
+    # a forwarder sending half a line does not hold back the others
+    slow, fast = socket.socket(socket.AF_UNIX), socket.socket(socket.AF_UNIX)
+    slow.connect(path)
+    fast.connect(path)
+    line = json.dumps(_image_event("ami-1", "available")) + "\n"
+    slow.sendall(line[:10].encode("utf-8"))
+    fast.sendall((json.dumps(_image_event("ami-2", "available")) + "\n").encode("utf-8"))
+    assert next(events)["detail"]["ImageId"] == "ami-2"
+    assert next(events) is None
+
+    slow.sendall(line[10:].encode("utf-8"))
+    assert next(events)["detail"]["ImageId"] == "ami-1"
+    # the last line of a closed connection
+    fast.sendall(json.dumps(_instance_event("i-1", "running")).encode("utf-8"))
+    fast.close()
+    assert next(events)["detail"]["instance-id"] == "i-1"
+    slow.close()
+    events.close()
+    assert not tmpdir.join("events.sock").exists()
+
+    # a file which is not a socket is not removed
+    other = tmpdir.join("other")
+    other.write("data")
+    with pytest.raises(socket.error):
+        next(read_feed("unix:" + str(other), interval=0.05))
+    assert other.read() == "data"
+
+
+def test_remove_queued(capsys):
+    aws = FakeAWS(seed=2).populate(images=6, groups=2)
+    app = App(parse_args(["--watch", "events.jsonl", "--force-delete", "--keep-previous", "2"]))
+    app._engine = _engine(aws)
+
+    watcher = Watcher(app.engine)
+    watcher.start()
+    app.remove_queued(watcher)
+    assert len(aws.images) == 4 and len(watcher.engine.available_amis) == 4
+    assert watcher.queued == set()
+    assert "deregistered" in capsys.readouterr().out
+
+    assert parse_args(["--watch", "events.jsonl", "--aws-regions", "us-east-1", "eu-west-1"]) is None
+
+
+def test_remove_queued_failures():
+    aws = FakeAWS(seed=3, failure_rate={'DeregisterImage': 1.0}).populate(images=6, groups=2)
+    app = App(parse_args(["--watch", "events.jsonl", "--force-delete", "--keep-previous", "2"]))
+    app._engine = _engine(aws)
+
+    watcher = Watcher(app.engine)
+    queued = watcher.start()
+    app.remove_queued(watcher)
+    # kept in the inventory, queued again by the next reduction
+    assert len(aws.images) == 6 and len(watcher.engine.available_amis) == 6
+    assert watcher.queued == set()
+    assert sorted(r.ami.id for r in watcher.reduce(list(watcher.groups))) == sorted(r.ami.id for r in queued)
+
+
+def test_remove_queued_marks():
+    aws = FakeAWS(seed=4).populate(images=6, groups=2)
+    app = App(parse_args(["--watch", "events.jsonl", "--mark", "--force-delete", "--keep-previous", "2"]))
+    app._engine = _engine(aws)
+
+    watcher = Watcher(app.engine)
+    watcher.start()
+    app.remove_queued(watcher)
+    # only tagged, and not marked again
+    assert len(aws.images) == 6 and len(app.fetcher.fetch_marked_amis()) == 2
+    assert len(watcher.queued) == 2 and watcher.reduce(list(watcher.groups)) == []
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from botocore.exceptions import ClientError
+
+from amicleaner.core import AMICleaner, SnapshotIndex
+from amicleaner.fetch import Fetcher
+from amicleaner.resources.models import AMI
+from amicleaner.utils import parse_args
+from amicleaner.workqueue import WorkQueue, QueueDeleter, consume, run
+
+from .fake_aws import FakeAWS
+
+
+class StubEC2(object):
+
+    """
+    ec2 client of the consumer processes, ids containing "bad" fail and
+    those containing "gone" are already removed
+    """
+
+    def deregister_image(self, ImageId):
+        self._call("DeregisterImage", ImageId, "InvalidAMIID.NotFound")
+
+    def delete_snapshot(self, SnapshotId):
+        self._call("DeleteSnapshot", SnapshotId, "InvalidSnapshot.NotFound")
+
+    @staticmethod
+    def _call(operation, resource_id, not_found):
+        if "bad" in resource_id:
+            raise ClientError({"Error": {"Code": "InternalError", "Message": "failed"}}, operation)
+        if "gone" in resource_id:
+            raise ClientError({"Error": {"Code": not_found, "Message": "not found"}}, operation)
+
+
+def stub_client(config=None, region=None):
+    return StubEC2()
+
+
+def test_work_queue(tmpdir):
+    queue = WorkQueue(str(tmpdir.join("queue.db")))
+    batch = queue.put("snapshot", [{"snapshot_id": "snap-{0}".format(i)} for i in range(5)])
+    other = queue.put("snapshot", [{"snapshot_id": "snap-other"}])
+
+    first = queue.claim(1, batch, count=3)
+    assert [payload["snapshot_id"] for _, _, payload in first] == ["snap-0", "snap-1", "snap-2"]
+    assert [payload["snapshot_id"] for _, _, payload in queue.claim(2, batch)] == ["snap-3", "snap-4"]
+    assert queue.claim(3, batch) == []
+    # the claims of another run are left alone
+    assert len(queue.claim(4, other)) == 1
+
+    queue.finish([(first[0][0], "done", {"error": None})])
+    # the other claimed items are left by an interrupted consumer
+    assert queue.release(batch) == 4
+    assert queue.progress(batch) == {"pending": 4, "claimed": 0, "done": 1, "failed": 0}
+    assert queue.progress(other) == {"pending": 0, "claimed": 1, "done": 0, "failed": 0}
+    assert [payload for _, payload, _, _ in queue.results(batch)] == [{"snapshot_id": "snap-0"}]
+
+    # batches left by interrupted runs expire
+    assert queue.expire(ttl=3600) == 0
+    assert queue.expire(ttl=-1) == 5
+    assert queue.claim(1, batch) == []
+    queue.close()
+
+
+def test_consume_removes_amis(tmpdir):
+    path = str(tmpdir.join("queue.db"))
+    aws = FakeAWS(seed=1).populate(images=10)
+    amis = list(Fetcher(ec2=aws.ec2, autoscaling=aws.asg).fetch_available_amis().values())
+
+    deleter = QueueDeleter(path)
+    index = SnapshotIndex.from_amis(amis)
+    batch = deleter.publish("ami", [{"ami_id": ami.id, "snapshot_ids": index.release(ami.id), "kept_snapshots": []}
+                                    for ami in amis[:6]])
+    assert consume(path, 0, batch, client_factory=lambda config, region: aws.ec2) == 6
+
+    queue = WorkQueue(path)
+    results = list(queue.results(batch))
+    queue.close()
+    assert len(results) == 6 and all(state == "done" and len(result["deleted"]) == 1
+                                     for _, _, state, result in results)
+    assert len(aws.images) == 4
+
+
+def test_run_consumer_processes(tmpdir, capsys):
+    path = str(tmpdir.join("queue.db"))
+    progress = []
+    deleter = QueueDeleter(path, processes=3, client_factory=stub_client, progress=progress.append)
+
+    snapshots = ["snap-{0}".format(i) for i in range(200)] + ["snap-bad"]
+    assert deleter.delete_snapshots(snapshots) == ["snap-bad"]
+    assert progress[-1] == {"pending": 0, "claimed": 0, "done": 200, "failed": 1}
+
+    # amis removal through AMICleaner
+    amis = [AMI.object_with_json({"ImageId": ami_id, "BlockDeviceMappings": [
+        {"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": "snap-of-" + ami_id}}]})
+        for ami_id in ("ami-1", "ami-bad", "ami-2")]
+    assert AMICleaner(ec2=StubEC2()).remove_amis(amis, queue=deleter) == []
+    out = capsys.readouterr().out
+    assert "ami-bad deregistration failed" in out and "ami-1 deregistered" in out
+
+    # an empty batch is drained at once
+    assert run(path, deleter.publish("snapshot", []), processes=2, client_factory=stub_client)["pending"] == 0
+
+
+def test_items_run_again(tmpdir):
+    path = str(tmpdir.join("queue.db"))
+    deleter = QueueDeleter(path, processes=1, client_factory=stub_client)
+
+    # deregistered by a previous attempt, the snapshots are still deleted
+    results = deleter.remove_amis([AMI.object_with_json({"ImageId": "ami-gone", "BlockDeviceMappings": [
+        {"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": "snap-1"}},
+        {"DeviceName": "/dev/xvdb", "Ebs": {"SnapshotId": "snap-gone"}}]})])
+    assert [(r.ami_id, r.deregistered, r.deleted_snapshots) for r in results] == \
+        [("ami-gone", True, ["snap-1", "snap-gone"])]
+    assert deleter.delete_snapshots(["snap-gone", "snap-bad"]) == ["snap-bad"]
+
+
+def test_clients_per_region(tmpdir):
+    path = str(tmpdir.join("queue.db"))
+    regions = []
+
+    def client_factory(config, region):
+        regions.append(region)
+        return StubEC2()
+
+    amis = [AMI.object_with_json({"ImageId": "ami-{0}".format(i), "BlockDeviceMappings": []}, region)
+            for i, region in enumerate(["us-east-1", "eu-west-1", "us-east-1"])]
+    deleter = QueueDeleter(path)
+    batch = deleter.publish("ami", [{"ami_id": ami.id, "region": ami.region, "snapshot_ids": []} for ami in amis])
+    assert consume(path, 0, batch, client_factory=client_factory) == 3
+    assert sorted(regions) == ["eu-west-1", "us-east-1"]
+
+
+def test_consumers_options():
+    assert parse_args(["--queue", "queue.db", "--processes", "4", "--workers", "2"]).processes == 4
+    for option in ("--processes", "--workers"):
+        for value in ("0", "-1"):
+            with pytest.raises(SystemExit):
+                parse_args(["--queue", "queue.db", option, value])